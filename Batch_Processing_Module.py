@@ -0,0 +1,191 @@
+# ===========================================================================================
+# Copyright (c)  2024 HealthyPhoton Technology. All rights reserved.
+# Licensed under the MIT License. See LICENSE file in the project root for details.
+# ===========================================================================================
+import argparse
+import datetime
+import logging
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import Data_Calculation_Module
+import Results_Store_Module
+
+FILE_NAME_PATTERN = re.compile(r"^(\d{8}_\d{4})\.(txt|bin)$")  # Half hour raw files written by OpenFlux.py
+
+
+def period_start(timestamp):
+    """
+    Start of the averaging period (Data_Calculation_Module.AVERAGING_PERIOD) that contains the timestamp
+    :param timestamp: datetime
+    :return: datetime
+    """
+    return Data_Calculation_Module.period_start(timestamp)
+
+
+def find_raw_files(data_dir, start=None, end=None):
+    """
+    List the raw data files of a folder in timestamp order, a binary file is preferred over a text file of the same name
+    :param data_dir: folder with OpenFLux_data files
+    :param start: first period to include, datetime or None
+    :param end: last period to include (exclusive), datetime or None
+    :return: list of (period, file path)
+    """
+    raw_files = {}
+    for name in sorted(os.listdir(data_dir)):
+        match = FILE_NAME_PATTERN.match(name)
+        if not match:
+            continue
+        file_time = datetime.datetime.strptime(match.group(1), "%Y%m%d_%H%M")
+        if (start and file_time < start) or (end and file_time >= end):
+            continue
+        if match.group(1) not in raw_files or match.group(2) == "bin":
+            raw_files[match.group(1)] = (period_start(file_time), os.path.join(data_dir, name))
+    return sorted(raw_files.values())
+
+
+def processed_periods(output_dir):
+    """
+    Periods that already have a result in the results store or EC_FLUX.csv, so an interrupted run can resume
+    :param output_dir: result folder
+    :return: set of datetime
+    """
+    if Data_Calculation_Module.RESULTS_FORMAT == "sqlite":
+        database_path = Results_Store_Module.store_path(output_dir)
+        if not os.path.exists(database_path):
+            return set()
+        with Results_Store_Module.ResultsStore(database_path) as store:
+            timestamps = store.timestamps()
+    else:
+        import pandas as pd
+        result_file_path = os.path.join(output_dir, 'EC_FLUX.csv')
+        if not os.path.exists(result_file_path):
+            return set()
+        timestamps = pd.read_csv(result_file_path, usecols=['TIMESTAMP'])['TIMESTAMP'].astype(str)
+    periods = set()
+    for timestamp in timestamps:
+        try:
+            periods.add(period_start(datetime.datetime.strptime(timestamp, Data_Calculation_Module.TIMESTAMP_FORMAT)))
+        except (TypeError, ValueError):
+            continue
+    return periods
+
+
+def calculate_file(file_path, planar_fit=None, spectra_averages=None, lag_history=None):
+    """
+    Worker task, calculates one file and returns the result instead of writing it
+    :param file_path:
+    :param planar_fit: PlanarFit of the result folder
+    :param spectra_averages: SpectraAverages of the result folder
+    :param lag_history: LagHistory of the result folder
+    :return: (result_data, cross_cov_results) or None if the file could not be processed
+    """
+    try:
+        return Data_Calculation_Module.calculate_flux(file_path, planar_fit=planar_fit,
+                                                      spectra_averages=spectra_averages, lag_history=lag_history)
+    except Exception as e:
+        logging.error(f"Failed to calculate {file_path}: {e}")
+        return None
+
+
+def convert_file(task):
+    """
+    Worker task, converts one raw data file between the text and binary formats
+    :param task: (file path, "bin" or "txt")
+    :return: converted file path or None
+    """
+    file_path, target = task
+    try:
+        if target == "bin":
+            return Data_Calculation_Module.convert_text_to_binary(file_path)
+        return Data_Calculation_Module.convert_binary_to_text(file_path)
+    except Exception as e:
+        logging.error(f"Failed to convert {file_path}: {e}")
+        return None
+
+
+def run_batch_conversion(data_dir, target, start=None, end=None, workers=None):
+    """
+    Convert the raw data files of a folder to the text or binary format, the original files are kept
+    :param data_dir: folder with OpenFLux_data files
+    :param target: "bin" or "txt"
+    :param start: first period to include, datetime or None
+    :param end: last period to include (exclusive), datetime or None
+    :param workers: number of worker processes, all cores by default
+    :return: number of files converted
+    """
+    source = "txt" if target == "bin" else "bin"
+    tasks = []
+    for name in sorted(os.listdir(data_dir)):
+        match = FILE_NAME_PATTERN.match(name)
+        if not match or match.group(2) != source:
+            continue
+        file_time = datetime.datetime.strptime(match.group(1), "%Y%m%d_%H%M")
+        if (start and file_time < start) or (end and file_time >= end):
+            continue
+        if not os.path.exists(os.path.join(data_dir, f"{match.group(1)}.{target}")):
+            tasks.append((os.path.join(data_dir, name), target))
+    print(f"{len(tasks)} files to convert to {target}")
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=Data_Calculation_Module.configure_logging) as executor:
+        converted = sum(result is not None for result in executor.map(convert_file, tasks, chunksize=4))
+    return converted
+
+
+def run_batch_calculation(data_dir, output_dir, start=None, end=None, workers=None):
+    """
+    Calculate the flux of all raw files in a folder with a process pool.
+    Workers only calculate, the results are written by this process in timestamp order, so the result
+    files are never appended to concurrently and an interrupted run leaves an ordered prefix behind.
+    All files use the planar fit and the spectra averages stored in output_dir when the run starts.
+    :param data_dir: folder with OpenFLux_data files
+    :param output_dir: result folder for EC_FLUX.csv and cross_covariance_results.txt
+    :param start: first period to include, datetime or None
+    :param end: last period to include (exclusive), datetime or None
+    :param workers: number of worker processes, all cores by default
+    :return: number of periods calculated
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    done = processed_periods(output_dir)
+    pending = [file_path for period, file_path in find_raw_files(data_dir, start, end) if period not in done]
+    print(f"{len(pending)} files to calculate, {len(done)} periods already in {output_dir}")
+
+    calculated = 0
+    task = partial(calculate_file, planar_fit=Data_Calculation_Module.load_planar_fit(output_dir),
+                   spectra_averages=Data_Calculation_Module.load_spectra_averages(output_dir=output_dir),
+                   lag_history=Data_Calculation_Module.load_lag_history(output_dir))
+    with ProcessPoolExecutor(max_workers=workers, initializer=Data_Calculation_Module.configure_logging) as executor:
+        for file_path, result in zip(pending, executor.map(task, pending, chunksize=4)):
+            if result is None:
+                print(f"Skipped {file_path}")
+                continue
+            result_data, cross_cov_results = result
+            Data_Calculation_Module.save_flux_results(result_data, cross_cov_results, output_dir)
+            calculated += 1
+    logging.info(f"Batch calculation finished, {calculated} periods calculated.")
+    return calculated
+
+
+def parse_date(text):
+    return datetime.datetime.fromisoformat(text)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recalculate EC fluxes of archived OpenFlux raw data files")
+    parser.add_argument("data_dir", help="folder with the half hour raw files, e.g. ./OpenFLux_data")
+    parser.add_argument("--output", default=Data_Calculation_Module.ec_flux_dir, help="result folder")
+    parser.add_argument("--start", type=parse_date, help="first period, e.g. 2024-05-01")
+    parser.add_argument("--end", type=parse_date, help="end of the range (exclusive), e.g. 2024-06-01")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--convert", choices=["bin", "txt"], help="convert the raw files to this format instead")
+    args = parser.parse_args()
+
+    Data_Calculation_Module.configure_logging()
+    if args.convert:
+        run_batch_conversion(args.data_dir, args.convert, args.start, args.end, args.workers)
+    else:
+        run_batch_calculation(args.data_dir, args.output, args.start, args.end, args.workers)
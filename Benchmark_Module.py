@@ -0,0 +1,391 @@
+# ===========================================================================================
+# Copyright (c)  2024 HealthyPhoton Technology. All rights reserved.
+# Licensed under the MIT License. See LICENSE file in the project root for details.
+# ===========================================================================================
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import Data_Calculation_Module
+import Results_Store_Module
+import Stationarity_Module
+
+BENCHMARK_FREQUENCIES = [10, 20, 50]  # Sampling frequencies to benchmark unit:Hz
+BENCHMARK_DURATIONS = [0.5, 24]  # Raw file lengths to benchmark unit:hour
+INJECTED_LAG = 0.3  # Delay of the concentration behind the vertical wind unit:s
+WIND_STD = 0.3  # Standard deviation of w unit:m/s
+INTEGRAL_TIME_SCALE = 1.0  # Autocorrelation time of the synthetic turbulence unit:s
+CONCENTRATION_GAIN = 2.0  # c = 20 + gain * w(t - lag) + noise, so cov(w, c) = gain * WIND_STD ** 2
+HEAT_GAIN = 0.5  # sonic_temp = 21 + gain * w(t) + noise, so cov(w, T) = gain * WIND_STD ** 2
+NOISE_STD = 0.5  # Uncorrelated scalar noise
+SPIKE_SHARE = 0.001  # Share of the samples of every channel replaced by spikes in the despike stage
+STAGES = ["import_time", "read_raw_arrays", "read_raw_data_reference", "despike", "rotate_coordinates", "lag_loop",
+          "lag_loop_narrowed", "lag_loop_reference", "calculate_turbulent_steady_state", "block_stationarity",
+          "calculate_scalar_fluxes", "run_data_calculation", "save_data_to_local"]
+# Cold imports of the "import_time" stage: the logger and the calculation worker / batch processes start with these
+IMPORT_MODULES = ["Data_Calculation_Module", "Calculation_Worker_Module", "Batch_Processing_Module", "OpenFlux"]
+IMPORT_REPEATS = 5  # Fresh interpreters per module, the median is reported
+
+
+def correlated_noise(n, sampling_frequency, rng):
+    """
+    Gaussian noise with an exponential autocorrelation of INTEGRAL_TIME_SCALE, normalised to unit variance.
+    Filtered in the frequency domain so 24 h at 50 Hz is generated in one step.
+    :param n: number of samples
+    :param sampling_frequency: unit:Hz
+    :param rng: numpy Generator
+    :return: array of length n
+    """
+    frequencies = np.fft.rfftfreq(n, 1 / sampling_frequency)
+    spectrum = np.fft.rfft(rng.standard_normal(n)) / (1 + 2j * np.pi * frequencies * INTEGRAL_TIME_SCALE)
+    noise = np.fft.irfft(spectrum, n)
+    return (noise - noise.mean()) / noise.std()
+
+
+def generate_turbulence(duration, sampling_frequency, lag=INJECTED_LAG, start="2024-01-01 00:00", seed=0):
+    """
+    Synthetic raw data in the OpenFLux_data layout with a known flux, lag and heat flux
+    :param duration: unit:hour
+    :param sampling_frequency: unit:Hz
+    :param lag: delay of the concentration behind w unit:s
+    :param start: first timestamp
+    :param seed:
+    :return: (DataFrame with TIMESTAMP and RAW_DATA_COLUMNS, dict of the expected values)
+    """
+    rng = np.random.default_rng(seed)
+    n = int(duration * 3600 * sampling_frequency)
+    lag_samples = int(round(lag * sampling_frequency))
+    w = WIND_STD * correlated_noise(n, sampling_frequency, rng)
+    u = 3 + correlated_noise(n, sampling_frequency, rng)
+    v = 0.5 + 0.5 * correlated_noise(n, sampling_frequency, rng)
+    concentration = 20 + CONCENTRATION_GAIN * np.roll(w, lag_samples) + NOISE_STD * rng.standard_normal(n)
+    sonic_temp = 21 + HEAT_GAIN * w + NOISE_STD * rng.standard_normal(n)
+
+    timestamps = pd.date_range(start, periods=n, freq=pd.Timedelta(seconds=1 / sampling_frequency))
+    data = pd.DataFrame({
+        'TIMESTAMP': timestamps.strftime(Data_Calculation_Module.TIMESTAMP_FORMAT).str[:-4],
+        'real_time_concentration': concentration * Data_Calculation_Module.CONCENTRATION_DIVISOR,
+        'ambient_temperature': 20.0,
+        'transmittance': 90.0,
+        'u_axis_speed': u,
+        'v_axis_speed': v,
+        'w_axis_speed': w,
+        'sonic_temp': sonic_temp,
+        'ht8x00_age': 0.0,
+        'ht8x00_flag': 0,
+        'wind_age': 0.0,
+        'wind_flag': 0,
+    }, columns=['TIMESTAMP'] + Data_Calculation_Module.RAW_DATA_COLUMNS)
+
+    primary, heat = Data_Calculation_Module.SCALARS[0], Data_Calculation_Module.SCALARS[1]
+    expected = {
+        'flux': CONCENTRATION_GAIN * WIND_STD ** 2 * primary['molar_mass'] * primary['unit_factor'],
+        'sonic_temp_flux': HEAT_GAIN * WIND_STD ** 2 * heat['molar_mass'] * heat['unit_factor'],
+        # A concentration that lags w by d samples peaks at lag -d, see calculate_cross_covariance
+        'lag': -lag_samples,
+        'turbulent_steady_state': 0,
+    }
+    return data, expected
+
+
+def reference_cross_covariance(w_prime, c_prime, max_lag):
+    """
+    The original per-lag np.cov loop, kept as the numerical reference of calculate_cross_covariance
+    :param w_prime:
+    :param c_prime:
+    :param max_lag: unit:samples
+    :return: list of covariances, index 0 is lag -max_lag
+    """
+    results = []
+    for lag in range(-max_lag, max_lag + 1):
+        if lag < 0:
+            results.append(np.cov(w_prime[:lag], c_prime[-lag:])[0, 1])
+        elif lag > 0:
+            results.append(np.cov(w_prime[lag:], c_prime[:-lag])[0, 1])
+        else:
+            results.append(np.cov(w_prime, c_prime)[0, 1])
+    return results
+
+
+def measure(function, *args, memory=True):
+    """
+    Run function once for the time and, if memory is set, once more under tracemalloc for the peak memory
+    :param function:
+    :param args:
+    :param memory:
+    :return: (result, seconds, peak traced bytes or None)
+    """
+    start = time.perf_counter()
+    result = function(*args)
+    seconds = time.perf_counter() - start
+    peak = None
+    if memory:
+        tracemalloc.start()
+        function(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, seconds, peak
+
+
+def save_to_local(openflux, data, data_dir):
+    """
+    Feed every row through OpenFlux.save_data_to_local into a fresh folder and close the file
+    :param openflux: the imported OpenFlux module
+    :param data: DataFrame from generate_turbulence
+    :param data_dir:
+    :return: number of rows written
+    """
+    shutil.rmtree(data_dir, ignore_errors=True)
+    os.makedirs(data_dir)
+    openflux.file_path = data_dir
+    openflux.last_file_time = None
+    openflux.current_file = None
+    columns = list(data.columns)
+    for row in data.itertuples(index=False, name=None):
+        record = dict(zip(columns, row))
+        record['time'] = record.pop('TIMESTAMP')
+        openflux.save_data_to_local(record)
+    openflux.raw_writer.close()
+    return len(data)
+
+
+def benchmark_imports(modules=IMPORT_MODULES, repeats=IMPORT_REPEATS):
+    """
+    Cold import time of every module in fresh interpreters and whether the import loaded pandas
+    :param modules: module names
+    :param repeats: interpreters per module
+    :return: list of result dicts in the layout of benchmark_case
+    """
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    results = []
+    for module in modules:
+        script = (f"import sys, time; started = time.perf_counter(); import {module}; "
+                  f"print(time.perf_counter() - started, 'pandas' in sys.modules)")
+        seconds, agreement = [], ""
+        for _ in range(repeats):
+            process = subprocess.run([sys.executable, "-c", script], cwd=package_dir, capture_output=True, text=True)
+            if process.returncode:
+                error = (process.stderr.strip().splitlines() or ["failed"])[-1]
+                agreement = f"skipped, {module} cannot be imported ({error})"
+                break
+            import_seconds, pandas_loaded = process.stdout.strip().splitlines()[-1].split()
+            seconds.append(float(import_seconds))
+            agreement = "imports pandas" if pandas_loaded == "True" else "without pandas"
+        results.append({'stage': f"import {module}", 'frequency': "-", 'hours': "-", 'samples': "-",
+                        'seconds': float(np.median(seconds)) if seconds else None, 'samples_per_second': None,
+                        'peak_mb': None, 'agreement': agreement})
+    return results
+
+
+def benchmark_case(duration, sampling_frequency, work_dir, stages=STAGES, memory=True):
+    """
+    Generate one synthetic file and benchmark the selected stages on it
+    :param duration: unit:hour
+    :param sampling_frequency: unit:Hz
+    :param work_dir: folder for the raw and result files
+    :param stages: subset of STAGES
+    :param memory: also measure the peak memory
+    :return: list of result dicts, one per stage
+    """
+    data, expected = generate_turbulence(duration, sampling_frequency)
+    n = len(data)
+    max_lag = int(Data_Calculation_Module.LAG_TIME.total_seconds() * sampling_frequency)
+    filename = f"benchmark_{sampling_frequency}Hz_{duration}h.txt"
+    os.makedirs(os.path.join(work_dir, "OpenFLux_data"), exist_ok=True)
+    data.to_csv(os.path.join(work_dir, "OpenFLux_data", filename), index=False)
+
+    u, v, w = data['u_axis_speed'].values, data['v_axis_speed'].values, data['w_axis_speed'].values
+    u2, v2, w2 = Data_Calculation_Module.rotate_coordinates(u, v, w)
+    w_prime = w2 - np.mean(w2)
+    scalars = np.column_stack([data['real_time_concentration'].values / Data_Calculation_Module.CONCENTRATION_DIVISOR,
+                               data['sonic_temp'].values])
+    scalar_primes = scalars - np.mean(scalars, axis=0)
+    c_prime = scalar_primes[:, 0]
+    cross_covariance = Data_Calculation_Module.calculate_cross_covariance(w_prime, scalar_primes, max_lag)
+
+    channels = ['u_axis_speed', 'v_axis_speed', 'w_axis_speed', 'real_time_concentration', 'sonic_temp']
+    # The float64 arrays the calculation works on, the reference for the peak memory
+    raw_mb = n * len(channels) * 8 / 1e6
+    results = []
+    for stage in stages:
+        agreement = ""
+        if stage == "read_raw_arrays":
+            path = os.path.join(work_dir, "OpenFLux_data", filename)
+            (_, values), seconds, peak = measure(Data_Calculation_Module.read_raw_arrays, [path], channels,
+                                                 memory=memory)
+            difference = np.max(np.abs(values - data[channels].to_numpy(dtype=np.float64)))
+            agreement = f"max |diff| {difference:.1e}, raw arrays {raw_mb:.1f} MB"
+        elif stage == "read_raw_data_reference":
+            path = os.path.join(work_dir, "OpenFLux_data", filename)
+            _, seconds, peak = measure(Data_Calculation_Module.read_raw_data, path, memory=memory)
+            agreement = f"raw arrays {raw_mb:.1f} MB"
+        elif stage == "despike":
+            values = data[channels].to_numpy(dtype=np.float64)
+            rng = np.random.default_rng(1)
+            spikes = rng.random(values.shape) < SPIKE_SHARE
+            spiky = values + spikes * np.sign(rng.standard_normal(values.shape)) * 10 * values.std(axis=0)
+            block_length = Data_Calculation_Module.DESPIKE_BLOCK.total_seconds() * sampling_frequency
+            (_, counts), seconds, peak = measure(Data_Calculation_Module.despike, spiky, block_length, memory=memory)
+            agreement = f"{int(counts.sum())} replaced, {int(spikes.sum())} injected"
+        elif stage == "rotate_coordinates":
+            _, seconds, peak = measure(Data_Calculation_Module.rotate_coordinates, u, v, w, memory=memory)
+        elif stage == "lag_loop":
+            result, seconds, peak = measure(Data_Calculation_Module.calculate_cross_covariance, w_prime, c_prime,
+                                            max_lag, memory=memory)
+            lag = int(np.argmax(np.abs(result))) - max_lag
+            agreement = (f"lag {lag / sampling_frequency:+.2f} s "
+                         f"(expected {expected['lag'] / sampling_frequency:+.2f} s)")
+        elif stage == "lag_loop_narrowed":
+            # The window of a site whose lag history knows the lag
+            history = Data_Calculation_Module.LagHistory()
+            for period in range(Data_Calculation_Module.LAG_HISTORY_MIN_PERIODS):
+                history.add_period(str(period), 'concentration', expected['lag'] / sampling_frequency)
+            low, high, _ = Data_Calculation_Module.lag_search_windows(
+                Data_Calculation_Module.SCALARS[:1], max_lag, sampling_frequency, history)
+            result, seconds, peak = measure(Data_Calculation_Module.calculate_cross_covariance, w_prime, c_prime,
+                                            max_lag, "auto", np.arange(low[0], high[0] + 1), memory=memory)
+            lag = int(np.nanargmax(np.abs(result))) - max_lag
+            agreement = f"lag {lag / sampling_frequency:+.2f} s, {high[0] - low[0] + 1} of {2 * max_lag + 1} lags"
+        elif stage == "lag_loop_reference":
+            reference, seconds, peak = measure(reference_cross_covariance, w_prime, c_prime, max_lag, memory=memory)
+            difference = np.max(np.abs(cross_covariance[:, 0] - np.array(reference)))
+            agreement = f"max |diff| to calculate_cross_covariance {difference:.1e}"
+        elif stage == "calculate_turbulent_steady_state":
+            flux = (cross_covariance[:, 0] * Data_Calculation_Module.SCALARS[0]['molar_mass']
+                    * Data_Calculation_Module.SCALARS[0]['unit_factor'])
+            result, seconds, peak = measure(Data_Calculation_Module.calculate_turbulent_steady_state, flux, w_prime,
+                                            c_prime, sampling_frequency, memory=memory)
+            agreement = f"class {result[1]} (the legacy test compares the unscaled 5 minute covariance)"
+        elif stage == "block_stationarity":
+            lags = np.full(scalar_primes.shape[1], expected['lag'])
+            length = Stationarity_Module.block_length(n, Data_Calculation_Module.stationarity_block_length(
+                sampling_frequency))
+
+            def stationarity():
+                moments = Stationarity_Module.block_moments(
+                    *Data_Calculation_Module.lagged_pairs(w_prime, scalar_primes, lags), length)
+                return Stationarity_Module.steady_state_test(moments)
+
+            result, seconds, peak = measure(stationarity, memory=memory)
+            agreement = (f"class {result['steady_state'][0]} (expected {expected['turbulent_steady_state']}), "
+                         f"deviation {result['deviation'][0]:.1%}, blocks "
+                         f"{Stationarity_Module.flag_string(result['block_flags'][:, 0])}")
+        elif stage == "calculate_scalar_fluxes":
+            scalar_settings = Data_Calculation_Module.SCALARS[:2]
+            result, seconds, peak = measure(Data_Calculation_Module.calculate_scalar_fluxes, cross_covariance,
+                                            w_prime, scalar_primes, scalar_settings, sampling_frequency, memory=memory)
+            agreement = (f"class {result['steady_state'][0]} (expected {expected['turbulent_steady_state']}), "
+                         f"flux error {result['flux'][0] / expected['flux'] - 1:+.2%}")
+        elif stage == "run_data_calculation":
+            result_dir = os.path.join(work_dir, "EC_FLUX")
+            shutil.rmtree(result_dir, ignore_errors=True)
+            os.makedirs(result_dir)
+            current_dir = os.getcwd()
+            os.chdir(work_dir)
+            try:
+                _, seconds, peak = measure(Data_Calculation_Module.run_data_calculation, filename, "", max_lag,
+                                           sampling_frequency, memory=memory)
+            finally:
+                os.chdir(current_dir)
+            if Data_Calculation_Module.RESULTS_FORMAT == "sqlite":
+                with Results_Store_Module.ResultsStore(Results_Store_Module.store_path(result_dir)) as store:
+                    row = store.query().iloc[0]
+            else:
+                row = pd.read_csv(os.path.join(result_dir, "EC_FLUX.csv")).iloc[0]
+            agreement = (f"flux error {row['flux'] / expected['flux'] - 1:+.2%}, "
+                         f"sonic_temp_flux error {row['sonic_temp_flux'] / expected['sonic_temp_flux'] - 1:+.2%}")
+            if peak is not None:
+                agreement += f", peak {peak / 1e6 / raw_mb:.1f} x the raw arrays ({raw_mb:.1f} MB)"
+        elif stage == "save_data_to_local":
+            try:
+                import OpenFlux
+            except ImportError as e:
+                results.append({'stage': stage, 'frequency': sampling_frequency, 'hours': duration, 'samples': n,
+                                'seconds': None, 'samples_per_second': None, 'peak_mb': None,
+                                'agreement': f"skipped, OpenFlux cannot be imported ({e})"})
+                continue
+            data_dir = os.path.join(work_dir, "save_data_to_local")
+            _, seconds, peak = measure(save_to_local, OpenFlux, data, data_dir, memory=memory)
+            written = pd.concat([Data_Calculation_Module.read_raw_data(os.path.join(data_dir, name))
+                                 for name in sorted(os.listdir(data_dir))], ignore_index=True)
+            difference = np.max(np.abs(written['w_axis_speed'].values.astype(float) - w))
+            agreement = f"{len(written)} rows read back, max |diff| w {difference:.1e}"
+        else:
+            raise ValueError(f"Unknown benchmark stage {stage}")
+
+        results.append({'stage': stage, 'frequency': sampling_frequency, 'hours': duration, 'samples': n,
+                        'seconds': seconds, 'samples_per_second': n / seconds if seconds else None,
+                        'peak_mb': peak / 1e6 if peak is not None else None, 'agreement': agreement})
+    return results
+
+
+def print_report(results):
+    """
+    Print the benchmark results as a table
+    :param results: list of result dicts from benchmark_case
+    :return:
+    """
+    print(f"{'stage':<34}{'Hz':>4}{'hours':>7}{'samples':>10}{'seconds':>10}{'samples/s':>13}{'peak MB':>9}  agreement")
+    for result in results:
+        seconds = f"{result['seconds']:.4f}" if result['seconds'] is not None else "-"
+        throughput = f"{result['samples_per_second']:.3g}" if result['samples_per_second'] else "-"
+        peak = f"{result['peak_mb']:.1f}" if result['peak_mb'] is not None else "-"
+        print(f"{result['stage']:<34}{result['frequency']:>4}{result['hours']:>7}{result['samples']:>10}"
+              f"{seconds:>10}{throughput:>13}{peak:>9}  {result['agreement']}")
+
+
+def run_benchmarks(frequencies=BENCHMARK_FREQUENCIES, durations=BENCHMARK_DURATIONS, stages=STAGES, work_dir=None,
+                   memory=True):
+    """
+    Benchmark every combination of sampling frequency and file length
+    :param frequencies: unit:Hz
+    :param durations: unit:hour
+    :param stages: subset of STAGES
+    :param work_dir: folder for the generated files, a temporary folder that is removed afterwards by default
+    :param memory: also measure the peak memory
+    :return: list of result dicts
+    """
+    temporary = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix="openflux_benchmark_")
+    results = []
+    if "import_time" in stages:
+        results = benchmark_imports()
+        print_report(results)
+        stages = [stage for stage in stages if stage != "import_time"]
+    try:
+        for duration in durations:
+            for sampling_frequency in frequencies:
+                case_results = benchmark_case(duration, sampling_frequency, work_dir, stages, memory)
+                print_report(case_results)
+                results.extend(case_results)
+    finally:
+        if temporary:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the OpenFlux calculation and logging hot paths "
+                                                 "on synthetic turbulence with a known flux and lag")
+    parser.add_argument("--frequencies", type=int, nargs="+", default=BENCHMARK_FREQUENCIES, help="unit:Hz")
+    parser.add_argument("--durations", type=float, nargs="+", default=BENCHMARK_DURATIONS, help="file length unit:hour")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--work-dir", help="keep the generated files in this folder")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc peak memory pass")
+    parser.add_argument("--json", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    Data_Calculation_Module.configure_logging()
+    all_results = run_benchmarks(args.frequencies, args.durations, args.stages, args.work_dir, not args.no_memory)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as file:
+            json.dump(all_results, file, indent=2)
@@ -0,0 +1,207 @@
+# ===========================================================================================
+# Copyright (c)  2024 HealthyPhoton Technology. All rights reserved.
+# Licensed under the MIT License. See LICENSE file in the project root for details.
+# ===========================================================================================
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import time
+
+import Batch_Processing_Module
+import Data_Calculation_Module
+import Results_Store_Module
+
+CALCULATION_QUEUE_DIR = os.path.join(".", "calculation_queue")  # One JSON file per pending job, kept across restarts
+FAILED_JOBS_DIR = "failed"  # Sub folder of the queue for jobs that used up their attempts
+MAX_ATTEMPTS = 3  # Calculation attempts per raw file
+RETRY_DELAY = 60  # unit:s, multiplied by the number of failed attempts
+POLL_INTERVAL = 5  # unit:s, the worker also wakes up as soon as a job is submitted
+RECOVERY_WINDOW = datetime.timedelta(days=1)  # Unprocessed raw files this recent are queued again at start up
+WORKER_NICE = 10  # Lower priority of the worker process so the logger threads win the CPU
+
+_wake_event = None  # Set by submit_job to wake the worker process
+
+
+def _job_path(queue_dir, raw_file_path):
+    return os.path.join(queue_dir, os.path.basename(raw_file_path) + ".json")
+
+
+def _write_job(job_path, job):
+    # Written to a temporary file and renamed, so a crash never leaves a half written job
+    temporary_path = job_path + ".tmp"
+    with open(temporary_path, "w", encoding="utf-8") as file:
+        json.dump(job, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary_path, job_path)
+
+
+def submit_job(raw_file_path, queue_dir=CALCULATION_QUEUE_DIR):
+    """
+    Queue a finished raw data file for calculation, a file that is already queued is not queued twice
+    :param raw_file_path: closed half hour raw data file
+    :param queue_dir:
+    :return: job file path
+    """
+    os.makedirs(queue_dir, exist_ok=True)
+    job_path = _job_path(queue_dir, raw_file_path)
+    if not os.path.exists(job_path):
+        _write_job(job_path, {"file": os.path.abspath(raw_file_path), "attempts": 0, "next_attempt": 0,
+                              "submitted": time.time()})
+    if _wake_event is not None:
+        _wake_event.set()
+    return job_path
+
+
+def pending_jobs(queue_dir=CALCULATION_QUEUE_DIR):
+    """
+    Queued job files in submission order (the raw file names sort by time)
+    :param queue_dir:
+    :return: list of job file paths
+    """
+    if not os.path.isdir(queue_dir):
+        return []
+    return [os.path.join(queue_dir, name) for name in sorted(os.listdir(queue_dir)) if name.endswith(".json")]
+
+
+def recover_missing_periods(data_dir, output_dir=None, queue_dir=CALCULATION_QUEUE_DIR, window=RECOVERY_WINDOW,
+                            now=None):
+    """
+    Queue the recent raw files whose period has no result yet, e.g. the half hour that was being logged
+    when the logger crashed. The current period is left alone, it is still being written.
+    :param data_dir: raw data folder
+    :param output_dir: result folder, Data_Calculation_Module.ec_flux_dir by default
+    :param queue_dir:
+    :param window: only files this recent are considered
+    :param now: datetime, now by default
+    :return: list of queued raw file paths
+    """
+    if not os.path.isdir(data_dir):
+        return []
+    now = now or datetime.datetime.now()
+    done = Batch_Processing_Module.processed_periods(output_dir or Data_Calculation_Module.ec_flux_dir)
+    current_period = Batch_Processing_Module.period_start(now)
+    queued = []
+    for period, raw_file_path in Batch_Processing_Module.find_raw_files(data_dir, now - window):
+        if period in done or period >= current_period:
+            continue
+        submit_job(raw_file_path, queue_dir)
+        queued.append(raw_file_path)
+    return queued
+
+
+def _result_exists(output_dir, timestamp):
+    # A job that was interrupted after saving its result must not add the period to the planar fit and
+    # spectra averages a second time (nor a second row to EC_FLUX.csv)
+    if Data_Calculation_Module.RESULTS_FORMAT == "sqlite":
+        database_path = Results_Store_Module.store_path(output_dir)
+        if not os.path.exists(database_path):
+            return False
+        with Results_Store_Module.ResultsStore(database_path, period=Data_Calculation_Module.AVERAGING_PERIOD) as store:
+            return store.contains(timestamp)
+    result_file_path = os.path.join(output_dir, "EC_FLUX.csv")
+    if not os.path.exists(result_file_path):
+        return False
+    import pandas as pd
+    return timestamp in set(pd.read_csv(result_file_path, usecols=["TIMESTAMP"])["TIMESTAMP"].astype(str))
+
+
+def run_job(job_path, output_dir=None):
+    """
+    Calculate and save one queued file. A failed job is kept with a later retry time, and moved to the
+    failed folder after MAX_ATTEMPTS, a period rejected for its gaps is dropped.
+    :param job_path:
+    :param output_dir: result folder, Data_Calculation_Module.ec_flux_dir by default
+    :return: True if the job is finished (done or given up), False if it will be retried
+    """
+    output_dir = output_dir or Data_Calculation_Module.ec_flux_dir
+    with open(job_path, encoding="utf-8") as file:
+        job = json.load(file)
+    try:
+        result_data, cross_cov_results = Data_Calculation_Module.calculate_flux(job["file"], output_dir=output_dir)
+        if not _result_exists(output_dir, result_data["TIMESTAMP"]):
+            Data_Calculation_Module.save_flux_results(result_data, cross_cov_results, output_dir)
+        os.remove(job_path)
+        logging.info(f"Calculated {job['file']}")
+        return True
+    except Data_Calculation_Module.PeriodRejected as e:
+        # Too little data, a retry would give the same answer
+        os.remove(job_path)
+        logging.warning(str(e))
+        return True
+    except Exception as e:
+        job["attempts"] += 1
+        job["error"] = f"{type(e).__name__}: {e}"
+        logging.error(f"Calculation of {job['file']} failed (attempt {job['attempts']}): {e}")
+        if job["attempts"] >= MAX_ATTEMPTS:
+            failed_dir = os.path.join(os.path.dirname(job_path), FAILED_JOBS_DIR)
+            os.makedirs(failed_dir, exist_ok=True)
+            _write_job(os.path.join(failed_dir, os.path.basename(job_path)), job)
+            os.remove(job_path)
+            return True
+        job["next_attempt"] = time.time() + RETRY_DELAY * job["attempts"]
+        _write_job(job_path, job)
+        return False
+
+
+def run_worker(stop_event, wake_event, queue_dir=CALCULATION_QUEUE_DIR, output_dir=None):
+    """
+    Calculation worker process, runs the queued jobs that are due until stop_event is set
+    :param stop_event: multiprocessing.Event
+    :param wake_event: multiprocessing.Event set when a job is submitted
+    :param queue_dir:
+    :param output_dir:
+    :return:
+    """
+    Data_Calculation_Module.configure_logging()
+    if hasattr(os, "nice"):
+        os.nice(WORKER_NICE)
+    try:
+        while not stop_event.is_set():
+            wake_event.clear()
+            for job_path in pending_jobs(queue_dir):
+                if stop_event.is_set():
+                    break
+                try:
+                    with open(job_path, encoding="utf-8") as file:
+                        next_attempt = json.load(file).get("next_attempt", 0)
+                except (OSError, ValueError):
+                    continue
+                if next_attempt <= time.time():
+                    run_job(job_path, output_dir)
+            wake_event.wait(POLL_INTERVAL)
+    except KeyboardInterrupt:
+        # Ctrl+C reaches the whole process group, unfinished jobs stay queued for the next start
+        pass
+
+
+def start_worker(stop_event, queue_dir=CALCULATION_QUEUE_DIR, output_dir=None):
+    """
+    Start the calculation worker process, before the logger threads so nothing is forked mid-operation
+    :param stop_event: multiprocessing.Event that stops the worker
+    :param queue_dir:
+    :param output_dir:
+    :return: the worker process
+    """
+    global _wake_event
+    _wake_event = multiprocessing.Event()
+    worker = multiprocessing.Process(target=run_worker, args=(stop_event, _wake_event, queue_dir, output_dir),
+                                     name="calculation_worker", daemon=True)
+    worker.start()
+    return worker
+
+
+def stop_worker(worker, stop_event, timeout=30):
+    """
+    Stop the worker after its current job, queued jobs are kept for the next start
+    :param worker: process from start_worker
+    :param stop_event: the multiprocessing.Event given to start_worker
+    :param timeout: unit:s
+    :return:
+    """
+    stop_event.set()
+    if _wake_event is not None:
+        _wake_event.set()
+    worker.join(timeout)
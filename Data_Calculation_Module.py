@@ -37,12 +37,26 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 # ---------------------------------------------------------------------------
  
-import pandas as pd
+# The calculation only needs NumPy. pandas, which takes seconds to import on a Raspberry Pi, is imported by the
+# functions that read or write CSV files, so the logger and the calculation workers start without it
 import numpy as np
 from datetime import datetime, timedelta
 import os
 import logging
+import time
 import re
+import json
+import contextlib
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+import Metrics_Module
+import Results_Store_Module
+import Spectral_Module
+import Stationarity_Module
 
 
 
@@ -50,25 +64,137 @@ import re
 # 常量设置
 SAMPLING_FREQUENCY = 10  # Sample frequence unit:Hz
 LAG_TIME = timedelta(seconds=1)  # Lag time unit:s
+MAX_LAG = int(LAG_TIME.total_seconds() * SAMPLING_FREQUENCY)  # Lag search window unit:samples
+CONCENTRATION_DIVISOR = 16  # Raw analyzer reading to concentration
+# Scalars whose flux is calculated, the first one is reported in the flux / concentration_mean columns.
+# column: raw data column, divisor: raw reading to concentration, flux = cov(w', c') * molar_mass * unit_factor,
+# lag_search: search the lag window (closed-path gas) or use lag 0 (sonic temperature),
+# default_lag: lag of a weak peak until the lag history of the site knows the lag unit:s,
+# response_time: first order response time of the analyzer for the spectral correction unit:s, 0 for none
+SCALARS = [
+    {'name': 'concentration', 'column': 'real_time_concentration', 'divisor': CONCENTRATION_DIVISOR,
+     'molar_mass': 16, 'unit_factor': 1e-3, 'lag_search': True, 'default_lag': 0.0,
+     'response_time': 0.0},  # mg/(m^2 s) for CH4
+    {'name': 'sonic_temp', 'column': 'sonic_temp', 'divisor': 1,
+     'molar_mass': 1, 'unit_factor': 1, 'lag_search': False, 'default_lag': 0.0,
+     'response_time': 0.0},  # Kinematic heat flux, K m/s
+]
+HEAT_SCALAR = 'sonic_temp'  # Scalar whose flux is the kinematic heat flux, for z/L and the reference cospectrum
+# Lag history of a site, the detected lags of the scalars with lag search are kept in LAG_HISTORY_FILE of the result
+# folder. A tube lag hardly changes, so once LAG_HISTORY_MIN_PERIODS are known the lag is only searched within
+# LAG_HISTORY_WINDOW of their median. A peak below LAG_PEAK_MIN_SNR standard errors of a zero covariance
+# (sigma_w * sigma_c / sqrt(n)) takes the median, or default_lag before that, instead of a maximum of the noise
+LAG_HISTORY_FILE = "lag_history.json"
+LAG_HISTORY_SIZE = 336  # Detected lags kept per scalar, a week of half hours unit:periods
+LAG_HISTORY_MIN_PERIODS = 12  # unit:periods
+LAG_HISTORY_WINDOW = timedelta(seconds=0.3)  # Half width of the narrowed search unit:s
+LAG_PEAK_MIN_SNR = 4.0  # unit:standard errors
+# Averaging period, periods start at multiples of it since midnight, so it divides a day (e.g. 10, 15, 30 or 60 min).
+# Raw files roll over at the period boundaries and the steady state sub-periods are a sixth of it.
+AVERAGING_PERIOD = timedelta(minutes=30)
+# Rolling fluxes (RollingFluxAccumulator): the flux of the trailing AVERAGING_PERIOD every ROLLING_FLUX_STEP
+ROLLING_FLUX_STEP = timedelta(minutes=5)  # A multiple of the sub-period AVERAGING_PERIOD / 6
+# Time alignment, the samples are put on the exact 1 / SAMPLING_FREQUENCY grid of their averaging period before
+# anything else, gaps up to ALIGN_MAX_GAP are interpolated
+ALIGN_MAX_GAP = timedelta(seconds=5)  # A longer gap between two samples rejects the period
+ALIGN_MIN_COVERAGE = 90.0  # Periods with fewer measured grid points are rejected unit:%
+# Despiking, a value further than DESPIKE_THRESHOLD robust standard deviations (MAD / 0.6745) from the median of
+# its block is a spike and is replaced by linear interpolation, like invalid (non numeric) values
+DESPIKE_BLOCK = timedelta(minutes=5)  # Block length for the median and MAD unit:s
+DESPIKE_THRESHOLD = 7  # unit:robust standard deviations
+DESPIKE_FLAG_LIMITS = (0.01, 0.05)  # Replaced share of the worst channel above which spike_flag is 1 / 2
+# Coordinate rotation, "double" rotates every period on its own mean wind, "planar_fit" uses a tilt plane fitted
+# to the mean winds of many periods (Wilczak et al. 2001) and falls back to "double" until enough periods are stored
+ROTATION_METHOD = "double"
+PLANAR_FIT_FILE = "planar_fit.json"  # Fit cache in the result folder
+PLANAR_FIT_REFIT_INTERVAL = timedelta(days=7)  # Refit the plane when the fit is this much older than the data
+PLANAR_FIT_MIN_PERIODS = 48  # Periods needed before the plane is used
+PLANAR_FIT_MIN_WIND = 0.5  # Periods with a lower mean horizontal wind do not enter the fit unit:m/s
+RAW_DATA_COLUMNS = ['real_time_concentration', 'ambient_temperature', 'transmittance',
+                    'u_axis_speed', 'v_axis_speed', 'w_axis_speed', 'sonic_temp',
+                    'ht8x00_age', 'ht8x00_flag', 'wind_age', 'wind_flag']  # Raw file columns after TIMESTAMP
+RESULTS_FORMAT = "sqlite"  # "sqlite": results store EC_FLUX.sqlite (export with Results_Store_Module.py), "csv": append
+BINARY_FILE_MAGIC = b'OFLXBIN1'  # First bytes of a binary raw data file
+BINARY_FILE_EXTENSION = '.bin'
+RAW_READ_CHUNK_ROWS = 16384  # Rows parsed at a time by read_raw_arrays, bounds the memory of the text parser
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
 BASE_DIR = r'.' # path
 raw_data_dir = os.path.join(BASE_DIR, "RawData")  # RawData folder name
 ec_flux_dir = os.path.join(BASE_DIR, "EC_FLUX")  # Result folder name
+rolling_flux_dir = os.path.join(ec_flux_dir, "rolling")  # Results of the rolling windows
+LOG_FILE = 'data_calculation.log'  # Log file of configure_logging
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
 # air_density = 1.225  # 空气密度, kg/m^3（常见的标准值）
 
-# Creating a Logger
-logging.basicConfig(filename='data_calculation.log', level=logging.INFO,
-                    format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Make sure the EC_FLUX folder exists
-if not os.path.exists(ec_flux_dir):
-    os.makedirs(ec_flux_dir)
-#
-# # 确保 RawData 文件夹存在
-# if not os.path.exists(raw_data_dir):
-#     os.makedirs(raw_data_dir)
+# Importing the module changes nothing outside it, the programs set up the paths and the logging explicitly
+def configure_paths(base_dir=None, result_dir=None):
+    """
+    Set the data and result folders and create the result folder
+    :param base_dir: folder of OpenFLux_data and RawData, BASE_DIR by default
+    :param result_dir: result folder, EC_FLUX in base_dir by default
+    :return: result folder
+    """
+    global BASE_DIR, raw_data_dir, ec_flux_dir, rolling_flux_dir
+    BASE_DIR = base_dir or BASE_DIR
+    raw_data_dir = os.path.join(BASE_DIR, "RawData")
+    ec_flux_dir = result_dir or os.path.join(BASE_DIR, "EC_FLUX")
+    rolling_flux_dir = os.path.join(ec_flux_dir, "rolling")
+    # # 确保 RawData 文件夹存在
+    # if not os.path.exists(raw_data_dir):
+    #     os.makedirs(raw_data_dir)
+    os.makedirs(ec_flux_dir, exist_ok=True)
+    logging.debug(f"Raw Data path: {raw_data_dir}")
+    logging.debug(f"EC FLUX path: {ec_flux_dir}")
+    return ec_flux_dir
 
-print(f"Raw Data path: {raw_data_dir}")
-print(f"EC FLUX path: {ec_flux_dir}")
+
+def configure_logging(log_file=LOG_FILE, level=logging.INFO):
+    """
+    Log to a file through the root logger, does nothing when the program has configured the logging already.
+    Also the initializer of worker processes, which do not inherit it when they are spawned.
+    :param log_file:
+    :param level:
+    :return:
+    """
+    logging.basicConfig(filename=log_file, level=level, format=LOG_FORMAT)
+
+
+@contextlib.contextmanager
+def locked_file(file_path):
+    """
+    Hold an exclusive lock on file_path + ".lock" while a state file of the result folder (planar fit, lag
+    history, spectra) is read, updated and replaced. The writers are the logger threads, the calculation
+    worker and the batch and ingest processes, the lock serialises them across threads and processes.
+    :param file_path: state file
+    :return:
+    """
+    with open(file_path + '.lock', 'a+b') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        else:
+            lock_file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def write_json_atomic(file_path, content):
+    """Write a JSON file to a temporary file and replace the file with it, readers never see a partial file"""
+    with open(file_path + '.tmp', 'w', encoding='utf-8') as file:
+        json.dump(content, file)
+    os.replace(file_path + '.tmp', file_path)
 
 
 # 二次坐标转化
@@ -93,9 +219,379 @@ def rotate_coordinates(u, v, w):
     return u2, v2, w2
 
 
+def calculate_cross_covariance(w_prime, c_prime, max_lag=MAX_LAG, method="auto", lags=None):
+    """
+    Calculate the covariance of w_prime and c_prime for every lag in [-max_lag, max_lag] in one pass.
+    For lag L the samples w_prime[k + L] and c_prime[k] are paired, which is the same alignment the
+    original np.cov loop used, and each lag is normalised with its own segment means and n - 1.
+    :param w_prime: vertical wind fluctuation
+    :param c_prime: concentration fluctuation, or an (n, k) array with one scalar per column
+    :param max_lag: lag search window unit:samples
+    :param method: "fft", "direct" or "auto" (fft for wide lag windows)
+    :param lags: only calculate these lags (e.g. the window around the expected lag), the others are NaN
+    :return: covariance array of length 2 * max_lag + 1 (shape (2 * max_lag + 1, k) for 2-D c_prime),
+             index 0 is lag -max_lag
+    """
+    w = np.asarray(w_prime, dtype=np.float64)
+    c = np.asarray(c_prime, dtype=np.float64)
+    n = len(w)
+    max_lag = int(min(max_lag, n - 2))
+    all_lags = np.arange(-max_lag, max_lag + 1)
+    lags = all_lags if lags is None else np.intersect1d(lags, all_lags)
+    # Broadcast the per-lag w terms over the scalar columns
+    w_axis = (slice(None),) + (None,) * (c.ndim - 1)
+
+    if method == "auto":
+        method = "fft" if len(lags) > 65 else "direct"
+
+    # Sum of products w[k + L] * c[k] for every lag
+    if method == "fft":
+        n_fft = 1 << int(np.ceil(np.log2(2 * n)))
+        spectrum = np.fft.rfft(w, n_fft)[w_axis] * np.conj(np.fft.rfft(c, n_fft, axis=0))
+        sum_wc = np.fft.irfft(spectrum, n_fft, axis=0)[lags % n_fft]
+    else:
+        sum_wc = np.empty((len(lags),) + c.shape[1:])
+        for i, lag in enumerate(lags):
+            if lag >= 0:
+                sum_wc[i] = w[lag:] @ c[:n - lag]
+            else:
+                sum_wc[i] = w[:n + lag] @ c[-lag:]
+
+    # Segment sums from cumulative sums, w uses [max(L, 0), n + min(L, 0)) and c uses [max(-L, 0), n - max(L, 0))
+    cum_w = np.zeros(n + 1)
+    np.cumsum(w, out=cum_w[1:])
+    cum_c = np.zeros((n + 1,) + c.shape[1:])
+    np.cumsum(c, axis=0, out=cum_c[1:])
+    length = n - np.abs(lags)
+    w_start = np.maximum(lags, 0)
+    c_start = np.maximum(-lags, 0)
+    sum_w = (cum_w[w_start + length] - cum_w[w_start])[w_axis]
+    sum_c = cum_c[c_start + length] - cum_c[c_start]
+    length = length[w_axis]
+
+    covariance = (sum_wc - sum_w * sum_c / length) / (length - 1)
+    if len(lags) == len(all_lags):
+        return covariance
+    full = np.full((len(all_lags),) + c.shape[1:], np.nan)
+    full[lags + max_lag] = covariance
+    return full
+
+
+def double_rotation_matrix(u_mean, v_mean, w_mean):
+    """
+    Rotation matrix of the double rotation in rotate_coordinates, rows give u2, v2 and w2 from (u, v, w)
+    :param u_mean: unit：m/s
+    :param v_mean: unit：m/s
+    :param w_mean: unit：m/s
+    :return: 3x3 rotation matrix
+    """
+    theta_z = np.arctan2(v_mean, u_mean)
+    cos_z, sin_z = np.cos(theta_z), np.sin(theta_z)
+    theta_y = np.arctan2(w_mean, u_mean * cos_z + v_mean * sin_z)
+    cos_y, sin_y = np.cos(theta_y), np.sin(theta_y)
+    return np.array([[cos_z * cos_y, sin_z * cos_y, sin_y],
+                     [-sin_z, cos_z, 0.0],
+                     [-cos_z * sin_y, -sin_z * sin_y, cos_y]])
+
+
+def rotation_angles(matrix):
+    """
+    Yaw, pitch and roll of a rotation matrix written as roll(x) @ pitch(y) @ yaw(z), the double rotation
+    has a roll of 0
+    :param matrix: 3x3 rotation matrix, rows give u2, v2 and w2
+    :return: (yaw, pitch, roll) unit:degree
+    """
+    yaw = np.arctan2(matrix[0, 1], matrix[0, 0])
+    pitch = np.arcsin(np.clip(matrix[0, 2], -1.0, 1.0))
+    roll = np.arctan2(matrix[1, 2], matrix[2, 2])
+    return tuple(float(np.degrees(angle)) for angle in (yaw, pitch, roll))
+
+
+class PlanarFit:
+    """
+    Planar fit tilt plane w_mean = b0 + b1 * u_mean + b2 * v_mean over the stored period mean winds.
+    The normal equation sums are kept, so a refit only adds the periods stored since the last one. The mean
+    wind of every period in the sums is kept by its TIMESTAMP, so a recalculated period replaces its contribution.
+    """
+
+    def __init__(self, sums=None, count=0, coefficients=None, fitted_period=None, last_period=None, periods=None):
+        self.sums = np.zeros((3, 4)) if sums is None else np.asarray(sums, dtype=np.float64)  # [X'X | X'w]
+        self.count = count
+        self.coefficients = None if coefficients is None else np.asarray(coefficients, dtype=np.float64)
+        self.fitted_period = fitted_period  # TIMESTAMP of the last period in the fit
+        self.last_period = last_period  # TIMESTAMP of the latest period added
+        self.periods = dict(periods or {})  # TIMESTAMP: [u_mean, v_mean, w_mean] of the periods in the sums
+
+    def add_period(self, timestamp, u_mean, v_mean, w_mean):
+        """
+        Add the raw mean wind of one period, low wind periods are skipped. A period that is already in the sums
+        (a rerun) is taken out first.
+        :param timestamp: TIMESTAMP of the period
+        :param u_mean: unit:m/s
+        :param v_mean: unit:m/s
+        :param w_mean: unit:m/s
+        :return:
+        """
+        self.last_period = max(timestamp, self.last_period or timestamp)
+        previous = self.periods.pop(timestamp, None)
+        if previous is not None:
+            self._add_sums(*previous, sign=-1)
+        if np.hypot(u_mean, v_mean) < PLANAR_FIT_MIN_WIND or not np.isfinite([u_mean, v_mean, w_mean]).all():
+            return
+        self._add_sums(u_mean, v_mean, w_mean)
+        self.periods[timestamp] = [float(u_mean), float(v_mean), float(w_mean)]
+
+    def _add_sums(self, u_mean, v_mean, w_mean, sign=1):
+        x = np.array([1.0, u_mean, v_mean])
+        self.sums[:, :3] += sign * np.outer(x, x)
+        self.sums[:, 3] += sign * x * w_mean
+        self.count += sign
+
+    def refit_due(self):
+        """The plane is refitted once enough periods are stored and then every PLANAR_FIT_REFIT_INTERVAL"""
+        if self.count < PLANAR_FIT_MIN_PERIODS:
+            return False
+        if self.coefficients is None or self.fitted_period is None:
+            return True
+        age = timestamp_to_milliseconds(self.last_period) - timestamp_to_milliseconds(self.fitted_period)
+        return timedelta(milliseconds=age) >= PLANAR_FIT_REFIT_INTERVAL
+
+    def fit(self):
+        """Solve the normal equations for b0, b1 and b2"""
+        self.coefficients = np.linalg.lstsq(self.sums[:, :3], self.sums[:, 3], rcond=None)[0]
+        self.fitted_period = self.last_period
+
+    def tilt_matrix(self):
+        """
+        Rotation into the fitted plane, rows are the new x, y and z axes with z normal to the plane
+        :return: 3x3 matrix
+        """
+        _, b1, b2 = self.coefficients
+        k = np.array([-b1, -b2, 1.0]) / np.sqrt(b1 ** 2 + b2 ** 2 + 1)
+        j = np.array([0.0, k[2], -k[1]]) / np.hypot(k[1], k[2])
+        return np.array([np.cross(j, k), j, k])
+
+    def rotation_matrix(self, u_mean, v_mean, w_mean):
+        """
+        Planar fit rotation of one period: tilt into the plane, then turn x into the mean wind
+        :param u_mean: unit:m/s
+        :param v_mean: unit:m/s
+        :param w_mean: unit:m/s
+        :return: 3x3 rotation matrix, rows give u2, v2 and w2 from (u, v, w - b0)
+        """
+        tilt = self.tilt_matrix()
+        u_plane, v_plane, _ = tilt @ np.array([u_mean, v_mean, w_mean - self.coefficients[0]])
+        yaw = np.arctan2(v_plane, u_plane)
+        cos_yaw, sin_yaw = np.cos(yaw), np.sin(yaw)
+        return np.array([[cos_yaw, sin_yaw, 0.0], [-sin_yaw, cos_yaw, 0.0], [0.0, 0.0, 1.0]]) @ tilt
+
+    def to_dict(self):
+        return {'sums': self.sums.tolist(), 'count': self.count,
+                'coefficients': None if self.coefficients is None else self.coefficients.tolist(),
+                'fitted_period': self.fitted_period, 'last_period': self.last_period, 'periods': self.periods}
+
+
+_planar_fit_cache = {}  # Fit file path: (modification time, PlanarFit)
+
+
+def load_planar_fit(output_dir=None):
+    """
+    Cached planar fit of a result folder, re-read only when the file has changed
+    :param output_dir: result folder, ec_flux_dir by default
+    :return: PlanarFit, empty if there is no fit file yet
+    """
+    fit_path = os.path.join(output_dir or ec_flux_dir, PLANAR_FIT_FILE)
+    if not os.path.exists(fit_path):
+        return PlanarFit()
+    modified = os.path.getmtime(fit_path)
+    cached = _planar_fit_cache.get(fit_path)
+    if cached is None or cached[0] != modified:
+        with open(fit_path, encoding='utf-8') as file:
+            cached = (modified, PlanarFit(**json.load(file)))
+        _planar_fit_cache[fit_path] = cached
+    return cached[1]
+
+
+def update_planar_fit(result_data, output_dir=None):
+    """
+    Add a saved period to the planar fit of its result folder and refit the plane when it is due
+    :param result_data: EC_FLUX.csv row with the raw u_mean, v_mean and w_mean
+    :param output_dir: result folder, ec_flux_dir by default
+    :return: PlanarFit
+    """
+    fit_path = os.path.join(output_dir or ec_flux_dir, PLANAR_FIT_FILE)
+    with locked_file(fit_path):
+        # Read under the lock, the cached fit may miss an update of another process
+        planar_fit = PlanarFit()
+        if os.path.exists(fit_path):
+            with open(fit_path, encoding='utf-8') as file:
+                planar_fit = PlanarFit(**json.load(file))
+        planar_fit.add_period(result_data['TIMESTAMP'], result_data['u_mean'], result_data['v_mean'],
+                              result_data['w_mean'])
+        if planar_fit.refit_due():
+            planar_fit.fit()
+            logging.info(f"Planar fit refitted on {planar_fit.count} periods, b = {planar_fit.coefficients.tolist()}")
+        write_json_atomic(fit_path, planar_fit.to_dict())
+    return planar_fit
+
+
+def period_rotation(u_mean, v_mean, w_mean, planar_fit=None, output_dir=None):
+    """
+    Rotation of one period by ROTATION_METHOD, rotated winds are matrix @ (u, v, w - offset)
+    :param u_mean: raw mean wind unit:m/s
+    :param v_mean: unit:m/s
+    :param w_mean: unit:m/s
+    :param planar_fit: PlanarFit, loaded from the result folder by default
+    :param output_dir: result folder, ec_flux_dir by default
+    :return: (matrix, w offset, method used)
+    """
+    if ROTATION_METHOD == "planar_fit":
+        planar_fit = planar_fit if planar_fit is not None else load_planar_fit(output_dir)
+        if planar_fit.coefficients is not None:
+            return planar_fit.rotation_matrix(u_mean, v_mean, w_mean), planar_fit.coefficients[0], "planar_fit"
+    return double_rotation_matrix(u_mean, v_mean, w_mean), 0.0, "double"
+
+
+class LagHistory:
+    """
+    Detected lags of the last LAG_HISTORY_SIZE periods of a site per scalar, the expected lag is their median.
+    """
+
+    def __init__(self, lags=None):
+        # Scalar name: [[TIMESTAMP, lag unit:s], ...] in timestamp order
+        self.lags = {name: [list(entry) for entry in entries] for name, entries in (lags or {}).items()}
+
+    def add_period(self, timestamp, name, lag):
+        """
+        Add the detected lag of a scalar, a recalculated period replaces its lag
+        :param timestamp: TIMESTAMP of the period
+        :param name: scalar name
+        :param lag: unit:s
+        :return:
+        """
+        entries = [entry for entry in self.lags.get(name, []) if entry[0] != timestamp] + [[timestamp, float(lag)]]
+        self.lags[name] = sorted(entries)[-LAG_HISTORY_SIZE:]
+
+    def expected_lag(self, name):
+        """Median detected lag of a scalar unit:s, None until LAG_HISTORY_MIN_PERIODS are known"""
+        entries = self.lags.get(name, [])
+        if len(entries) < LAG_HISTORY_MIN_PERIODS:
+            return None
+        return float(np.median([lag for _, lag in entries]))
+
+    def to_dict(self):
+        return {'lags': self.lags}
+
+
+_lag_history_cache = {}  # History file path: (modification time, LagHistory)
+
+
+def load_lag_history(output_dir=None):
+    """
+    Cached lag history of a result folder, re-read only when the file has changed
+    :param output_dir: result folder, ec_flux_dir by default
+    :return: LagHistory, empty if there is no history file yet
+    """
+    history_path = os.path.join(output_dir or ec_flux_dir, LAG_HISTORY_FILE)
+    if not os.path.exists(history_path):
+        return LagHistory()
+    modified = os.path.getmtime(history_path)
+    cached = _lag_history_cache.get(history_path)
+    if cached is None or cached[0] != modified:
+        with open(history_path, encoding='utf-8') as file:
+            cached = (modified, LagHistory(**json.load(file)))
+        _lag_history_cache[history_path] = cached
+    return cached[1]
+
+
+def update_lag_history(result_data, output_dir=None, scalar_settings=SCALARS):
+    """
+    Add the detected lags of a saved period to the lag history of its result folder, default lags are left out
+    :param result_data: EC_FLUX.csv row with the lag and lag_source columns of build_result_data
+    :param output_dir: result folder, ec_flux_dir by default
+    :param scalar_settings:
+    :return: LagHistory
+    """
+    history_path = os.path.join(output_dir or ec_flux_dir, LAG_HISTORY_FILE)
+    with locked_file(history_path):
+        lag_history = LagHistory()
+        if os.path.exists(history_path):
+            with open(history_path, encoding='utf-8') as file:
+                lag_history = LagHistory(**json.load(file))
+        # The first scalar of the period has the lag / lag_source columns, see build_result_data
+        present = [setting for setting in scalar_settings if f"{setting['name']}_mean" in result_data]
+        for i, setting in enumerate(present):
+            prefix = "" if i == 0 else f"{setting['name']}_"
+            if result_data.get(f"{prefix}lag_source") == "detected":
+                lag_history.add_period(result_data['TIMESTAMP'], setting['name'], result_data[f"{prefix}lag"])
+        write_json_atomic(history_path, lag_history.to_dict())
+    return lag_history
+
+
+def lag_search_windows(scalar_settings=SCALARS, max_lag=MAX_LAG, sampling_frequency=SAMPLING_FREQUENCY,
+                       lag_history=None):
+    """
+    Lag search window and default lag of every scalar: [-max_lag, max_lag] and default_lag until the history
+    knows the lag, then LAG_HISTORY_WINDOW around the expected lag, which is also the default. Scalars without
+    lag search have the window [0, 0].
+    :param scalar_settings:
+    :param max_lag: unit:samples
+    :param sampling_frequency: unit:Hz
+    :param lag_history: LagHistory of the site, none by default
+    :return: (low, high, default) int arrays per scalar unit:samples
+    """
+    half_width = int(round(LAG_HISTORY_WINDOW.total_seconds() * sampling_frequency))
+    windows = []
+    for setting in scalar_settings:
+        if not setting['lag_search']:
+            windows.append((0, 0, 0))
+            continue
+        expected = lag_history.expected_lag(setting['name']) if lag_history is not None else None
+        if expected is None:
+            default = int(np.clip(round(setting['default_lag'] * sampling_frequency), -max_lag, max_lag))
+            windows.append((-max_lag, max_lag, default))
+        else:
+            default = int(np.clip(round(expected * sampling_frequency), -max_lag, max_lag))
+            windows.append((max(default - half_width, -max_lag), min(default + half_width, max_lag), default))
+    windows = np.array(windows, dtype=int).reshape(len(scalar_settings), 3)
+    return windows[:, 0], windows[:, 1], windows[:, 2]
+
+
+def rotate_wind_in_place(wind, matrix, w_offset=0.0, chunk_rows=RAW_READ_CHUNK_ROWS):
+    """
+    Rotate the (u, v, w) rows of wind to matrix @ (u, v, w - offset) in place, chunk by chunk so the only
+    temporary is one chunk
+    :param wind: (n, 3) float64 array, may be a column view of a larger array
+    :param matrix: rotation matrix from period_rotation
+    :param w_offset: unit:m/s
+    :param chunk_rows:
+    :return: wind
+    """
+    wind[:, 2] -= w_offset
+    for start in range(0, len(wind), chunk_rows):
+        chunk = wind[start:start + chunk_rows]
+        chunk[...] = chunk @ matrix.T
+    return wind
+
+
+def rotation_record(u_mean, v_mean, w_mean, matrix, method):
+    """
+    EC_FLUX.csv columns of the rotation: raw mean wind, method and angles
+    :param u_mean: raw mean wind unit:m/s
+    :param v_mean: unit:m/s
+    :param w_mean: unit:m/s
+    :param matrix: rotation matrix used
+    :param method: "double" or "planar_fit"
+    :return: dict
+    """
+    yaw, pitch, roll = rotation_angles(matrix)
+    return {'u_mean': float(u_mean), 'v_mean': float(v_mean), 'w_mean': float(w_mean), 'rotation': method,
+            'rotation_yaw': yaw, 'rotation_pitch': pitch, 'rotation_roll': roll}
+
+
 def extract_lagged_data_and_calculate_cov(lag, data, sampling_frequency):
     """
-    Extracts the aligned data according to the given time lag and returns the covariance of w_prime and c_prime for the first 5 minutes after alignment
+    Extracts the aligned data according to the given time lag and returns the covariance of w_prime and c_prime for the first sub-period (AVERAGING_PERIOD / 6) after alignment
 
     :param lag: time lag
     :param data:
@@ -112,8 +608,9 @@ def extract_lagged_data_and_calculate_cov(lag, data, sampling_frequency):
         aligned_w_prime = data['w_prime']
         aligned_c_prime = data['c_prime']
 
-    five_minutes_data_w = aligned_w_prime[:int(5 * 60 * sampling_frequency)]
-    five_minutes_data_c = aligned_c_prime[:int(5 * 60 * sampling_frequency)]
+    sub_period_length = stationarity_block_length(sampling_frequency)
+    five_minutes_data_w = aligned_w_prime[:sub_period_length]
+    five_minutes_data_c = aligned_c_prime[:sub_period_length]
 
     return np.cov(five_minutes_data_w, five_minutes_data_c)[0, 1]
 
@@ -130,7 +627,7 @@ def calculate_turbulent_steady_state(cross_cov_results, w_prime, c_prime, sampli
     max_index = np.argmax(cross_cov_results)
     max_lag = max_index - len(cross_cov_results) // 2  # 确定最大值对应的lag
 
-    # 提取经过lag对齐后的原始数据的前5分钟数据，并计算协方差
+    # 提取经过lag对齐后的原始数据的第一个子时段数据，并计算协方差
     previous_flux_mean = extract_lagged_data_and_calculate_cov(max_lag, {'w_prime': w_prime, 'c_prime': c_prime},
                                                                sampling_frequency)
     raw_flux = cross_cov_results[max_index]
@@ -157,141 +654,1367 @@ def calculate_friction_velocity(u_prime, w_prime):
     return u_star
 
 
-def save_cross_covariance_results(time_data, cross_cov_results, output_path):
+def save_cross_covariance_results(time_data, cross_cov_results, output_path, lag_step=1 / SAMPLING_FREQUENCY):
     """
-    Save the covariance results to a txt file
-    :param time_data:
-    :param cross_cov_results:
+    Append the covariance results of one period to a tab separated txt file
+    :param time_data: TIMESTAMP of the period
+    :param cross_cov_results: lagged covariances, left unchanged
     :param output_path:
+    :param lag_step: lag between two values unit:s
     :return:
     """
-    headers = [f"{round((i - len(cross_cov_results) // 2) * 0.1, 1)}s" for i in range(len(cross_cov_results))]
-    headers.insert(0, "time")  # 在开头插入 "time"
-    cross_cov_results.insert(0, time_data)
-    cross_cov_results = np.reshape(cross_cov_results ,[1,-1])
-    df = pd.DataFrame(cross_cov_results,   columns=headers)
-    if not os.path.exists(output_path):
-        df.to_csv(output_path, sep='\t', index=True, header=True, mode='w')
-    else:
-        df.to_csv(output_path, sep='\t', index=True, header=False, mode='a')
+    values = [repr(float(value)) for value in cross_cov_results]
+    with open(output_path, 'a', encoding='utf-8') as file:
+        if file.tell() == 0:
+            file.write("\t" + "\t".join(Results_Store_Module.cross_covariance_header(len(values), lag_step)) + "\n")
+        # Rows keep the index column 0 of the former one row DataFrame appends
+        file.write("0\t" + str(time_data) + "\t" + "\t".join(values) + "\n")
 
 
-def run_data_calculation(filename="flag_file.txt",extra_data_path=""):
+def scalar_lags(cross_covariance, scalar_settings=SCALARS, windows=None, noise=None):
     """
-    main function，calculation EC flux each half hour
-    :param filename:
-    :return:
+    Pick the lag and flux of every scalar, the maximum absolute covariance in its lag search window (lag 0 for
+    scalars without lag search). A peak below LAG_PEAK_MIN_SNR times the noise takes the default lag.
+    :param cross_covariance: (2 * max_lag + 1, k) lagged covariances from calculate_cross_covariance
+    :param scalar_settings: one SCALARS entry per column
+    :param windows: (low, high, default) from lag_search_windows, the whole lag window and default_lag by default
+    :param noise: standard error of a zero covariance of every scalar, sigma_w * sigma_c / sqrt(n), None to
+                  always take the peak
+    :return: (cross_cov_results (lags, k) in flux units, lag of every scalar unit:samples, flux of every scalar,
+             lag_source of every scalar: "detected", "default" or "fixed" without lag search)
     """
-    logging.info("Starting data calculation module.")
-    print("Starting data calculation module.")
+    k = len(scalar_settings)
+    max_lag = len(cross_covariance) // 2
+    lags = np.arange(-max_lag, max_lag + 1)
+    low, high, default = windows if windows is not None else lag_search_windows(scalar_settings, max_lag)
+    factors = flux_factors(scalar_settings)
+    cross_cov_results = cross_covariance * factors
+    inside = (lags[:, None] >= low) & (lags[:, None] <= high) & np.isfinite(cross_cov_results)
+    candidates = np.where(inside, np.abs(cross_cov_results), -1.0)
+    lag_index = np.argmax(candidates, axis=0)
+    weak = np.zeros(k, dtype=bool)
+    if noise is not None:
+        peak = candidates[lag_index, np.arange(k)]
+        weak = (low < high) & ~(peak >= LAG_PEAK_MIN_SNR * np.asarray(noise) * np.abs(factors))
+    lag_index = np.where(weak, default + max_lag, lag_index)
+    lag_source = np.where(low == high, "fixed", np.where(weak, "default", "detected"))
+    return cross_cov_results, lags[lag_index], cross_cov_results[lag_index, np.arange(k)], lag_source
 
-    # Verify that the original data file exists
-    flag_file_path = os.path.join(BASE_DIR,"OpenFLux_data",filename)
-    # flag_file_path = os.path.join("./", "OpenFLux数据保存", filename)
 
-    if not os.path.exists(flag_file_path):
-        print(f"Flag bit file does not exist, end of program {flag_file_path}")
-        return
+def flux_factors(scalar_settings=SCALARS):
+    """Covariance to flux factor of every scalar, molar mass times unit factor"""
+    return np.array([setting['molar_mass'] * setting['unit_factor'] for setting in scalar_settings])
+
 
+def stationarity_block_length(sampling_frequency=SAMPLING_FREQUENCY):
+    """Samples of one steady state sub-period of a full averaging period"""
+    return int(round(AVERAGING_PERIOD.total_seconds() * sampling_frequency / Stationarity_Module.STATIONARITY_BLOCKS))
 
-    if True:
 
-        # ==========================================================================================
-        # Read raw data
-        # ==========================================================================================
-        data = pd.read_csv(flag_file_path, delimiter=',')
-        data.dropna(inplace=True)
-        data.iloc[:, 1:] = data.iloc[:, 1:].apply(pd.to_numeric, errors='coerce').fillna(0)
-        logging.info(f"data length is {len(data)}")
+def lagged_pairs(w_prime, scalar_primes, lags):
+    """
+    w' paired with every scalar at its lag: row i holds scalar_primes[i] and w_prime[i + lag], NaN where the
+    lag leaves no partner. The rows stay in scalar time, so the sub-periods are the same for every lag.
+    :param w_prime:
+    :param scalar_primes: (n, k)
+    :param lags: lag of every scalar unit:samples
+    :return: (w pairs (n, k), scalar_primes (n, k))
+    """
+    w_prime = np.asarray(w_prime, dtype=np.float64)
+    n = len(w_prime)
+    pairs = np.full((n, len(lags)), np.nan)
+    for i, lag in enumerate(int(lag) for lag in lags):
+        if 0 <= lag < n:
+            pairs[:n - lag, i] = w_prime[lag:]
+        elif -n < lag < 0:
+            pairs[-lag:, i] = w_prime[:n + lag]
+    return pairs, np.asarray(scalar_primes).reshape(n, -1)
+
+
+def wind_block_moments(wind_prime, length):
+    """
+    Block moments of the rotated wind paired with w, for the friction velocity and the integral turbulence test
+    :param wind_prime: (n, 3) rotated (u', v', w')
+    :param length: rows per block
+    :return: Stationarity_Module.block_moments of x = (u', v', w') and y = (w', w', w')
+    """
+    wind_prime = np.asarray(wind_prime, dtype=np.float64)
+    return Stationarity_Module.block_moments(wind_prime, np.broadcast_to(wind_prime[:, 2:], wind_prime.shape), length)
+
+
+def scalar_flux_results(cross_cov_results, lag, flux, lag_source, moments, scalar_settings=SCALARS):
+    """
+    Steady state test of every scalar from the block moments of its lag aligned pairs
+    :param cross_cov_results: (lags, k) in flux units
+    :param lag: lag of every scalar unit:samples
+    :param flux: flux of every scalar
+    :param lag_source: "detected", "default" or "fixed" for every scalar, see scalar_lags
+    :param moments: Stationarity_Module block moments of (w', c') at the lag of every scalar, (blocks, k)
+    :param scalar_settings:
+    :return: dict of cross_cov_results, and per scalar lag (samples), flux, lag_source, block_flux (blocks, k),
+             steady_state_deviation, steady_state (0, 1 or 2) and block_flags (blocks, k)
+    """
+    stationarity = Stationarity_Module.steady_state_test(moments)
+    return {'cross_cov_results': cross_cov_results, 'lag': lag, 'flux': flux, 'lag_source': lag_source,
+            'block_flux': stationarity['block_covariance'] * flux_factors(scalar_settings),
+            'steady_state_deviation': stationarity['deviation'], 'steady_state': stationarity['steady_state'],
+            'block_flags': stationarity['block_flags']}
+
+
+def calculate_scalar_fluxes(cross_covariance, w_prime, scalar_primes, scalar_settings=SCALARS,
+                            sampling_frequency=SAMPLING_FREQUENCY, windows=None):
+    """
+    Pick the flux of every scalar at its lag and test its steady state, all scalars in one batched pass.
+    The steady state compares the mean covariance of the STATIONARITY_BLOCKS sub-periods after lag alignment
+    with the covariance of the whole period, all from one pass of block sums.
+    :param cross_covariance: (2 * max_lag + 1, k) lagged covariances from calculate_cross_covariance
+    :param w_prime: vertical wind fluctuation
+    :param scalar_primes: (n, k) scalar fluctuations matching w_prime
+    :param scalar_settings: one SCALARS entry per column
+    :param sampling_frequency: unit:Hz
+    :param windows: lag search windows from lag_search_windows, the whole lag window by default
+    :return: dict of scalar_flux_results
+    """
+    # Standard error of a zero covariance, a weaker peak takes the default lag
+    noise = np.sqrt(np.var(w_prime) * np.var(scalar_primes, axis=0) / len(w_prime))
+    cross_cov_results, lag, flux, lag_source = scalar_lags(cross_covariance, scalar_settings, windows, noise)
+    length = Stationarity_Module.block_length(len(w_prime), stationarity_block_length(sampling_frequency))
+    moments = Stationarity_Module.block_moments(*lagged_pairs(w_prime, scalar_primes, lag), length)
+    return scalar_flux_results(cross_cov_results, lag, flux, lag_source, moments, scalar_settings)
+
+
+def turbulence_quality(fluxes, wind_moments, z_over_l, scalar_settings=SCALARS):
+    """
+    Integral turbulence characteristic of w and the overall quality flags, from the block moments
+    :param fluxes: result of calculate_scalar_fluxes
+    :param wind_moments: block moments of the rotated wind from wind_block_moments
+    :param z_over_l: stability parameter of the period
+    :param scalar_settings:
+    :return: dict of EC_FLUX.csv columns: itc_w (deviation from the model unit:%), itc_flag (-1 outside the
+             model), quality_flag, steady_state_blocks and itc_blocks (class of every sub-period, "-" without
+             data), and <name>_quality_flag / <name>_steady_state_blocks for further scalars
+    """
+    period = Stationarity_Module.wind_statistics(Stationarity_Module.combine_moments(wind_moments))
+    blocks = Stationarity_Module.wind_statistics(wind_moments)
+    itc, itc_class = Stationarity_Module.integral_turbulence_test(period['sigma_w'], period['friction_velocity'],
+                                                                  z_over_l)
+    _, block_itc = Stationarity_Module.integral_turbulence_test(blocks['sigma_w'], blocks['friction_velocity'],
+                                                                z_over_l)
+    block_itc = np.where(blocks['count'] > 1, block_itc, -1)
+    flags = Stationarity_Module.quality_flag(fluxes['steady_state'], itc_class)
+    columns = {'itc_w': float(itc * 100), 'itc_flag': int(itc_class), 'quality_flag': int(flags[0]),
+               'steady_state_blocks': Stationarity_Module.flag_string(fluxes['block_flags'][:, 0]),
+               'itc_blocks': Stationarity_Module.flag_string(block_itc)}
+    for i, setting in enumerate(scalar_settings[1:], 1):
+        columns[f"{setting['name']}_quality_flag"] = int(flags[i])
+        columns[f"{setting['name']}_steady_state_blocks"] = Stationarity_Module.flag_string(fluxes['block_flags'][:, i])
+    return columns
+
+
+def build_result_data(timestamp, friction_velocity, wind_means, scalar_means, fluxes, scalar_settings=SCALARS,
+                      sampling_frequency=SAMPLING_FREQUENCY):
+    """
+    One EC_FLUX.csv row, the first scalar keeps the flux / concentration_mean / turbulent_steady_state / lag (s) /
+    lag_source columns and every further scalar adds <name>_flux, <name>_mean, <name>_lag (s),
+    <name>_lag_source and <name>_steady_state
+    :param timestamp:
+    :param friction_velocity:
+    :param wind_means: rotated (u2, v2, w2) means
+    :param scalar_means: mean of every scalar
+    :param fluxes: result of calculate_scalar_fluxes
+    :param scalar_settings:
+    :param sampling_frequency: unit:Hz
+    :return: dict
+    """
+    result_data = {
+        'TIMESTAMP': format_timestamp(timestamp),
+        'flux': float(fluxes['flux'][0]),
+        'friction_velocity': float(friction_velocity),
+        f"{scalar_settings[0]['name']}_mean": float(scalar_means[0]),
+        'u2_mean': float(wind_means[0]),
+        'v2_mean': float(wind_means[1]),
+        'w2_mean': float(wind_means[2]),
+        'turbulent_steady_state': int(fluxes['steady_state'][0]),
+        'lag': float(fluxes['lag'][0] / sampling_frequency),
+        'lag_source': str(fluxes['lag_source'][0])
+    }
+    for i, setting in enumerate(scalar_settings[1:], 1):
+        result_data[f"{setting['name']}_flux"] = float(fluxes['flux'][i])
+        result_data[f"{setting['name']}_mean"] = float(scalar_means[i])
+        result_data[f"{setting['name']}_lag"] = float(fluxes['lag'][i] / sampling_frequency)
+        result_data[f"{setting['name']}_lag_source"] = str(fluxes['lag_source'][i])
+        result_data[f"{setting['name']}_steady_state"] = int(fluxes['steady_state'][i])
+    return result_data
+
+
+def load_spectra_averages(scalar_settings=SCALARS, sampling_frequency=SAMPLING_FREQUENCY, output_dir=None):
+    """
+    Stability class averages of the spectra stored in a result folder
+    :param scalar_settings:
+    :param sampling_frequency: unit:Hz
+    :param output_dir: result folder, ec_flux_dir by default
+    :return: Spectral_Module.SpectraAverages
+    """
+    return Spectral_Module.SpectraAverages.load(
+        os.path.join(output_dir or ec_flux_dir, Spectral_Module.SPECTRA_AVERAGE_FILE), sampling_frequency,
+        [setting['name'] for setting in scalar_settings])
+
+
+def spectral_correction(fluxes, friction_velocity, scalar_means, scalar_settings=SCALARS,
+                        sampling_frequency=SAMPLING_FREQUENCY, spectra_averages=None, spectra=None):
+    """
+    Stability and spectral correction of one period. The reference cospectrum is the average w-T cospectrum
+    of the stability class, or the w-T cospectrum of the period itself while the class has too few periods.
+    :param fluxes: result of calculate_scalar_fluxes
+    :param friction_velocity: unit:m/s
+    :param scalar_means: mean of every scalar
+    :param scalar_settings:
+    :param sampling_frequency: unit:Hz
+    :param spectra_averages: Spectral_Module.SpectraAverages or None
+    :param spectra: (power, cospectra) of the period from Spectral_Module.binned_spectra, or None
+    :return: dict of EC_FLUX.csv columns: z_over_L, stability_class, spectral_correction and flux_corrected,
+             and <name>_spectral_correction / <name>_flux_corrected for further scalars with a response time
+    """
+    names = [setting['name'] for setting in scalar_settings]
+    z_over_l = float('nan')
+    reference = None
+    if HEAT_SCALAR in names:
+        heat = names.index(HEAT_SCALAR)
+        heat_factor = scalar_settings[heat]['molar_mass'] * scalar_settings[heat]['unit_factor']
+        z_over_l = Spectral_Module.obukhov_stability(friction_velocity, fluxes['flux'][heat] / heat_factor,
+                                                     scalar_means[heat])
+        if spectra_averages is not None:
+            reference = spectra_averages.mean_cospectrum(Spectral_Module.stability_class(z_over_l), HEAT_SCALAR)
+        if reference is None and spectra is not None:
+            reference = spectra[1][heat]
+    stability = Spectral_Module.stability_class(z_over_l)
+    factors = Spectral_Module.correction_factors(
+        reference, sampling_frequency, [setting.get('response_time', 0.0) for setting in scalar_settings])
+
+    columns = {'z_over_L': z_over_l, 'stability_class': stability,
+               'spectral_correction': float(factors[0]), 'flux_corrected': float(fluxes['flux'][0] * factors[0])}
+    for i, setting in enumerate(scalar_settings[1:], 1):
+        if setting.get('response_time', 0.0) > 0:
+            columns[f"{setting['name']}_spectral_correction"] = float(factors[i])
+            columns[f"{setting['name']}_flux_corrected"] = float(fluxes['flux'][i] * factors[i])
+    return columns
+
+
+class PeriodRejected(ValueError):
+    """Raised for a period whose raw data has too long gaps or covers too little of the averaging period"""
+
+
+def parse_timestamps(timestamps):
+    """
+    Vectorised timestamp_to_milliseconds for a whole TIMESTAMP column
+    :param timestamps: TIMESTAMP strings (text files) or int milliseconds (binary files)
+    :return: float64 array of milliseconds since 1970-01-01, NaN for unreadable timestamps
+    """
+    if isinstance(timestamps, np.ndarray) and np.issubdtype(timestamps.dtype, np.number):
+        return timestamps.astype(np.float64)
+    import pandas as pd
+    timestamps = pd.Series(timestamps)
+    if pd.api.types.is_numeric_dtype(timestamps):
+        return timestamps.to_numpy(dtype=np.float64)
+    parsed = pd.to_datetime(timestamps, format=TIMESTAMP_FORMAT, errors='coerce')
+    return ((parsed - pd.Timestamp(1970, 1, 1)) / pd.Timedelta(milliseconds=1)).to_numpy(dtype=np.float64)
+
+
+def period_start(timestamp, period=AVERAGING_PERIOD):
+    """
+    Start of the averaging period that contains the timestamp
+    :param timestamp: datetime
+    :param period: timedelta
+    :return: datetime
+    """
+    day_start = datetime.combine(timestamp.date(), datetime.min.time())
+    return day_start + ((timestamp - day_start) // period) * period
 
-        if extra_data_path:
-            extra_data = pd.read_csv(extra_data_path, delimiter=',')
-            openflux_rawdata_data =pd.concat([data,extra_data])
+
+def align_to_grid(milliseconds, values, sampling_frequency, max_gap=ALIGN_MAX_GAP, period=AVERAGING_PERIOD):
+    """
+    Put the samples on the exact 1 / sampling_frequency grid of their averaging period, so a sample index is a
+    time again. The samples are sorted by time and go to the nearest grid point, a grid point that is hit twice
+    keeps its first sample and the missing grid points between the first and the last sample are linearly
+    interpolated. Samples that are already in order, unique and without gaps, the normal case, are not copied:
+    the aligned array is then values itself.
+    :param milliseconds: timestamps of the samples
+    :param values: (n, k) float64 array of the samples
+    :param sampling_frequency: unit:Hz
+    :param max_gap: gap the calculation still accepts, timedelta, only reported here
+    :param period: averaging period, timedelta
+    :return: (aligned (m, k) array from the first to the last sample, position of the first sample in time order,
+              dict with coverage (measured grid points of the averaging periods the samples fall in unit:%),
+              longest_gap (between two samples unit:s), filled_samples, duplicate_samples and rejected)
+    """
+    milliseconds = np.asarray(milliseconds)
+    values = np.asarray(values, dtype=np.float64)
+    first_sample = 0
+    if np.any(milliseconds[1:] < milliseconds[:-1]):
+        order = np.argsort(milliseconds, kind='stable')
+        first_sample = order[0]
+        milliseconds = milliseconds[order]
+        values = values[order]
+    sample_count = len(milliseconds)
+    step = 1000 / sampling_frequency
+    period_length = period // timedelta(milliseconds=1)
+    origin = milliseconds[0] // period_length * period_length
+    slots = np.rint((milliseconds - origin) / step).astype(np.int64)
+    del milliseconds
+    # Sorted slots, a repeated slot is a later sample of the same grid point
+    first = np.ones(len(slots), dtype=bool)
+    first[1:] = slots[1:] != slots[:-1]
+    if not first.all():
+        slots = slots[first]
+        values = values[first]
+
+    gaps = np.diff(slots) - 1
+    filled = int(gaps.sum())
+    if filled:
+        present = slots - slots[0]
+        aligned = np.empty((present[-1] + 1, values.shape[1]))
+        aligned[present] = values
+        # Linear interpolation between the samples on both sides of every missing grid point, all channels at once
+        missing = np.setdiff1d(np.arange(len(aligned)), present, assume_unique=True)
+        right = np.searchsorted(present, missing)
+        weight = ((missing - present[right - 1]) / (present[right] - present[right - 1]))[:, None]
+        aligned[missing] = values[right - 1] * (1 - weight) + values[right] * weight
+
+    # A file that ends with the first sample of the next period still counts as one period
+    period_slots = period_length / step
+    periods = max(1, int(np.ceil((slots[-1] + 1 - sampling_frequency) / period_slots)))
+    coverage = min(100.0, 100 * len(slots) / (periods * period_slots))
+    longest_gap = int(gaps.max(initial=0)) / sampling_frequency
+    quality = {'coverage': round(coverage, 2), 'longest_gap': longest_gap, 'filled_samples': filled,
+               'duplicate_samples': sample_count - len(slots),
+               'rejected': bool(longest_gap > max_gap.total_seconds() or coverage < ALIGN_MIN_COVERAGE)}
+    return (aligned if filled else values), first_sample, quality
+
+
+def spike_mask(values, block_length, threshold=DESPIKE_THRESHOLD):
+    """
+    Spikes and NaN values of a block-wise median/MAD despiking. The series is cut into blocks of block_length
+    samples (the tail uses the last block_length samples), the statistics are taken one block at a time, so the
+    temporaries are the size of a block.
+    :param values: (n, k) float64 array, one channel per column
+    :param block_length: unit:samples
+    :param threshold: unit:robust standard deviations
+    :return: (n, k) bool array
+    """
+    n = len(values)
+    block_length = int(min(max(block_length, 1), n))
+    starts = np.arange(n // block_length) * block_length
+    if n % block_length:
+        starts = np.append(starts, n - block_length)
+    replaced = np.isnan(values)
+    median_function = np.nanmedian if replaced.any() else np.median
+    for i, start in enumerate(starts):
+        block = values[start:start + block_length]
+        median = median_function(block, axis=0)
+        limit = threshold * median_function(np.abs(block - median), axis=0) / 0.6745
+        # The block statistics apply to the samples from i * block_length on, the tail block to the rest
+        rows = slice(i * block_length, n if i == len(starts) - 1 else (i + 1) * block_length)
+        with np.errstate(invalid='ignore'):
+            # A constant block (MAD 0) has no spikes
+            replaced[rows] |= (np.abs(values[rows] - median) > limit) & (limit > 0)
+    return replaced
+
+
+def interpolate_spikes(values, replaced):
+    """
+    Replace the marked samples in place by linear interpolation between the neighbouring valid samples of
+    their channel
+    :param values: (n, k) float64 array
+    :param replaced: (n, k) bool array from spike_mask
+    :return: values
+    """
+    positions = np.arange(len(values))
+    for channel in range(values.shape[1]):
+        bad = replaced[:, channel]
+        if bad.any() and not bad.all():
+            values[bad, channel] = np.interp(positions[bad], positions[~bad], values[~bad, channel])
+    return values
+
+
+def despike(values, block_length, threshold=DESPIKE_THRESHOLD, in_place=False):
+    """
+    Block-wise median/MAD despiking of all channels at once, spikes and NaN values are replaced by linear
+    interpolation, see spike_mask and interpolate_spikes
+    :param values: (n, k) array, one channel per column
+    :param block_length: unit:samples
+    :param threshold: unit:robust standard deviations
+    :param in_place: replace the spikes in values (a float64 array) instead of a copy
+    :return: (despiked values, number of replaced samples per channel)
+    """
+    values = np.asarray(values, dtype=np.float64) if in_place else np.array(values, dtype=np.float64)
+    if len(values) == 0:
+        return values, np.zeros(values.shape[1], dtype=int)
+    replaced = spike_mask(values, block_length, threshold)
+    return interpolate_spikes(values, replaced), replaced.sum(axis=0)
+
+
+def spike_quality(channel_names, spike_counts, sample_count):
+    """
+    EC_FLUX.csv columns of the despiking: spikes_<channel> per channel and spike_flag (0, 1 or 2)
+    :param channel_names: short channel names, e.g. u, v, w, concentration
+    :param spike_counts: replaced samples per channel
+    :param sample_count:
+    :return: dict
+    """
+    quality = {f"spikes_{name}": int(count) for name, count in zip(channel_names, spike_counts)}
+    share = max(spike_counts, default=0) / sample_count if sample_count else 1.0
+    quality['spike_flag'] = 0 if share <= DESPIKE_FLAG_LIMITS[0] else 1 if share <= DESPIKE_FLAG_LIMITS[1] else 2
+    return quality
+
+
+class FluxAccumulator:
+    """
+    Online flux calculation of one averaging period fed one combined sample at a time by the writer thread.
+    Keeps running sums and co-moments of (u, v, w) and the scalars, the sums of the lagged pairs of (u, v, w)
+    with every scalar over the lag window and a ring buffer of the last max_lag samples, so the result is
+    available as soon as the period closes without reading the raw file back. All sums are kept per steady
+    state sub-period (by the sample index of the scalar), which gives the stationarity and ITC tests of
+    run_data_calculation. The rotation (double or planar fit) is linear once the period means are known,
+    so it is applied to the moments at the end and reproduces run_data_calculation.
+    The samples are put on the sampling grid like in calculate_flux (align_to_grid): a repeated or earlier grid
+    point is a duplicate, gaps up to ALIGN_MAX_GAP are interpolated and a period with a longer gap or a coverage
+    below ALIGN_MIN_COVERAGE is rejected.
+    The samples are despiked like in calculate_flux before they enter the sums: they are held back in DESPIKE_BLOCK
+    blocks and a block is despiked together with its neighbours once the next block is complete, so its
+    statistics and interpolations are those of the whole period.
+    The despiked samples of the period are also kept (about 0.7 MB for half an hour at 10 Hz) for the binned
+    spectra, which feed the stability class averages of the spectral correction like calculate_flux does.
+    """
+
+    # Sums kept per block, the first axis of every array
+    _SUMS = ('_block_count', '_sum', '_sum_products', '_pair_count', '_pair_wind', '_pair_scalar', '_lagged_sum')
+
+    def __init__(self, sampling_frequency=SAMPLING_FREQUENCY, max_lag=MAX_LAG, scalar_settings=SCALARS,
+                 blocks=Stationarity_Module.STATIONARITY_BLOCKS, output_dir=None):
+        """
+        :param sampling_frequency: unit:Hz
+        :param max_lag: unit:samples
+        :param scalar_settings:
+        :param blocks: number of sum blocks
+        :param output_dir: result folder of the site with its planar fit, lag history and spectra averages,
+                           ec_flux_dir by default
+        """
+        self._output_dir = output_dir
+        self._sampling_frequency = sampling_frequency
+        self._max_lag = max_lag
+        self._scalar_settings = scalar_settings
+        self._columns = ['u_axis_speed', 'v_axis_speed', 'w_axis_speed'] + [s['column'] for s in scalar_settings]
+        self._divisors = np.array([1.0, 1.0, 1.0] + [s['divisor'] for s in scalar_settings])
+        self._block_length = stationarity_block_length(sampling_frequency)
+        self._blocks = blocks
+        self._despike_length = int(DESPIKE_BLOCK.total_seconds() * sampling_frequency)
+        self._step = 1000 / sampling_frequency  # Grid step unit:ms
+        self._max_fill = int(ALIGN_MAX_GAP.total_seconds() * sampling_frequency)  # unit:samples
+        self.reset()
+
+    def reset(self):
+        """Start a new averaging period"""
+        lag_count = 2 * self._max_lag + 1
+        variables = len(self._columns)
+        blocks = self._blocks
+        self.timestamp = None
+        self.count = 0
+        self._run = 0  # Samples since the start or a gap, lagged pairs do not span a gap
+        self._shift = None
+        self._block_count = np.zeros(blocks)
+        self._sum = np.zeros((blocks, variables))
+        self._sum_products = np.zeros((blocks, variables, variables))
+        # Pairs x[k + L], c[k] for x in (u, v, w) and every scalar c, in the block of k: their number,
+        # the sums of x and of c and the sum of x * c
+        self._pair_count = np.zeros((blocks, lag_count))
+        self._pair_wind = np.zeros((blocks, lag_count, 3))
+        self._pair_scalar = np.zeros((blocks, lag_count, variables - 3))
+        self._lagged_sum = np.zeros((blocks, lag_count, 3, variables - 3))
+        self._ring = np.zeros((self._max_lag + 1, variables))
+        self._ring_block = np.zeros(self._max_lag + 1, dtype=int)
+        # Raw samples of the last despiked block, the block waiting for its despiking and the block being filled
+        self._despike_rows = np.empty((3 * self._despike_length, variables))
+        self._despike_filled = 0
+        self._despike_done = 0  # Leading rows that are despiked and in the sums already
+        self.spike_counts = np.zeros(variables, dtype=int)
+        # Despiked samples of the period for the spectra
+        self._series = np.empty((int(AVERAGING_PERIOD.total_seconds() * self._sampling_frequency), variables))
+        # Time alignment: grid origin (period start unit:ms), last grid point and its raw values
+        self._origin = None
+        self._last_slot = None
+        self._last_values = None
+        self._measured = 0
+        self._filled = 0
+        self._duplicates = 0
+        self._longest_gap = 0  # unit:samples
+
+    def _block(self, index):
+        """Sub-period of sample indexes, the last one takes the samples after a full period"""
+        return np.minimum(index // self._block_length, self._blocks - 1)
+
+    def _raw_values(self, data):
+        """
+        :param data: dict with u_axis_speed, v_axis_speed, w_axis_speed and the scalar columns
+        :return: raw values (before the divisors), None for an incomplete sample
+        """
+        try:
+            values = np.array([data[column] for column in self._columns], dtype=np.float64)
+        except (KeyError, TypeError, ValueError):
+            return None
+        return values if np.all(np.isfinite(values)) else None
+
+    def add_sample(self, data):
+        """
+        Add one combined sample as built by OpenFlux.write_data, incomplete samples are skipped like dropna
+        :param data: dict with time, u_axis_speed, v_axis_speed, w_axis_speed and the scalar columns
+        :return:
+        """
+        values = self._raw_values(data)
+        if values is None:
+            return
+        try:
+            milliseconds = timestamp_to_milliseconds(data['time'])
+        except (KeyError, TypeError, ValueError):
+            return
+        if self._origin is None:
+            period_length = AVERAGING_PERIOD // timedelta(milliseconds=1)
+            self._origin = milliseconds // period_length * period_length
+            self.timestamp = data['time']
+        slot = int(np.rint((milliseconds - self._origin) / self._step))
+        if self._last_slot is not None:
+            if slot <= self._last_slot:
+                self._duplicates += 1
+                return
+            gap = slot - self._last_slot - 1
+            self._longest_gap = max(self._longest_gap, gap)
+            if 0 < gap <= self._max_fill:
+                weight = np.arange(1, gap + 1)[:, None] / (gap + 1)
+                for filled in self._last_values * (1 - weight) + values * weight:
+                    self._hold(filled)
+                self._filled += gap
+        self._last_slot, self._last_values = slot, values
+        self._measured += 1
+        self._hold(values)
+
+    def _hold(self, values):
+        """
+        Hold a sample back for the despiking, a complete block is despiked once the block after it is complete
+        :param values: raw values on the grid
+        :return:
+        """
+        self._despike_rows[self._despike_filled] = values
+        self._despike_filled += 1
+        if self._despike_filled - self._despike_done == 2 * self._despike_length:
+            self._despike_block(self._despike_done + self._despike_length)
+
+    def alignment_quality(self):
+        """
+        Time alignment of the period so far, the columns of align_to_grid
+        :return: dict with coverage, longest_gap, filled_samples, duplicate_samples and rejected
+        """
+        if self._last_slot is None:
+            return {'coverage': 0.0, 'longest_gap': 0.0, 'filled_samples': 0, 'duplicate_samples': 0,
+                    'rejected': True}
+        period_slots = (AVERAGING_PERIOD // timedelta(milliseconds=1)) / self._step
+        periods = max(1, int(np.ceil((self._last_slot + 1 - self._sampling_frequency) / period_slots)))
+        coverage = min(100.0, 100 * self._measured / (periods * period_slots))
+        longest_gap = self._longest_gap / self._sampling_frequency
+        return {'coverage': round(coverage, 2), 'longest_gap': longest_gap, 'filled_samples': self._filled,
+                'duplicate_samples': self._duplicates,
+                'rejected': bool(longest_gap > ALIGN_MAX_GAP.total_seconds() or coverage < ALIGN_MIN_COVERAGE)}
+
+    def _despike_block(self, end):
+        """
+        Despike the held back rows up to end with their neighbours and add them to the sums
+        :param end: row after the last row to add
+        :return:
+        """
+        length = self._despike_length
+        window = self._despike_rows[:self._despike_filled]
+        replaced = spike_mask(window, length)
+        rows = slice(self._despike_done, end)
+        despiked = interpolate_spikes(window.copy(), replaced)[rows]
+        self.spike_counts += replaced[rows].sum(axis=0)
+        despiked /= self._divisors
+        if self.count + len(despiked) > len(self._series):
+            self._series = np.concatenate((self._series, np.empty_like(self._series)))
+        self._series[self.count:self.count + len(despiked)] = despiked
+        self._add_values(despiked)
+        # The despiked block stays as the neighbour of the next one
+        if end > length:
+            kept = self._despike_filled - (end - length)
+            self._despike_rows[:kept] = self._despike_rows[end - length:self._despike_filled]
+            self._despike_filled, self._despike_done = kept, length
         else:
-            openflux_rawdata_data = data
-        openflux_rawdata_data['real_time_concentration']=openflux_rawdata_data['real_time_concentration']  /16
-        # ==========================================================================================
-        # Process data
-        # ==========================================================================================
-        # Initialise the filtered_data
-        filtered_data = openflux_rawdata_data.copy()
-        filtered_data['u2_axis_speed'] = None
-        filtered_data['v2_axis_speed'] = None
-        filtered_data['w2_axis_speed'] = None
-        # Rotation wind direction
-        u2, v2, w2 = rotate_coordinates(filtered_data['u_axis_speed'], filtered_data['v_axis_speed'], filtered_data['w_axis_speed'])
-        filtered_data[ 'u2_axis_speed'] = u2
-        filtered_data[ 'v2_axis_speed'] = v2
-        filtered_data[ 'w2_axis_speed'] = w2
-
-
-
-        # Calculate variable detrends use average value
-        u_prime = filtered_data['u2_axis_speed'].values - np.nanmean(filtered_data['u2_axis_speed'].values)
-        v_prime = filtered_data['v2_axis_speed'].values - np.nanmean(filtered_data['v2_axis_speed'].values)
-        w_prime = filtered_data['w2_axis_speed'].values- np.nanmean(filtered_data['w2_axis_speed'].values)
-        c_prime = filtered_data['real_time_concentration'].values - np.nanmean(filtered_data['real_time_concentration'].values)
-
-        # Time lag and calculate raw flux
-
-        cross_cov_results = []
-        for lag in range(-SAMPLING_FREQUENCY, SAMPLING_FREQUENCY + 1):
-            if lag < 0:
-
-                cov = np.cov(w_prime[:lag],c_prime[-lag:])
-            elif lag > 0:
-
-                cov = np.cov(w_prime[lag:], c_prime[:-lag])
-            else:
+            self._despike_done = end
+
+    def _add_values(self, values):
+        """
+        Add samples to the sums, one sample from the rolling windows or a despiked block
+        :param values: (m, variables) values divided by the divisors
+        :return:
+        """
+        if not len(values):
+            return
+        if self._shift is None:
+            # Sums are taken around the first sample to avoid cancellation in the co-moments
+            self._shift = values[0].copy()
+        x = values - self._shift
+        if len(x) == 1:
+            self._add_row(x[0])
+        else:
+            self._add_rows(x)
 
-                cov = np.cov(w_prime , c_prime )
-            cross_cov_results.append(cov[0,1]* 16e-3)
+    def _add_row(self, x):
+        """
+        Add a single shifted sample to the sums for all lags
+        :param x: (variables,) shifted values
+        :return:
+        """
+        n = self.count
+        block = self._block(n)
 
-        #  Get the maximum value as raw flux
-        index = np.argmax(abs(np.array(cross_cov_results)))
-        raw_flux =cross_cov_results[index]
+        self._block_count[block] += 1
+        self._sum[block] += x
+        self._sum_products[block] += np.outer(x, x)
 
-        # Calculate u*
+        ring_size = self._max_lag + 1
+        self._ring[n % ring_size] = x
+        self._ring_block[n % ring_size] = block
+        steps = np.arange(min(self._run, self._max_lag) + 1)
+        past = self._ring[(n - steps) % ring_size]
+        # Positive lags pair the new wind sample with past scalars, in the block of the scalar
+        past_blocks = self._ring_block[(n - steps) % ring_size]
+        positive = self._max_lag + steps
+        self._pair_count[past_blocks, positive] += 1
+        self._pair_wind[past_blocks, positive] += x[:3]
+        self._pair_scalar[past_blocks, positive] += past[:, 3:]
+        self._lagged_sum[past_blocks, positive] += x[None, :3, None] * past[:, None, 3:]
+        # Negative lags pair past wind samples with the new scalar
+        negative = self._max_lag - steps[1:]
+        self._pair_count[block, negative] += 1
+        self._pair_wind[block, negative] += past[1:, :3]
+        self._pair_scalar[block, negative] += x[3:]
+        self._lagged_sum[block, negative] += past[1:, :3, None] * x[None, None, 3:]
+        self.count = n + 1
+        self._run += 1
 
-        friction_velocity = (np.cov(u_prime,w_prime)[0,1]**2+np.cov(v_prime,w_prime)[0,1]**2)**0.25
+    def _add_rows(self, x):
+        """
+        Add a block of shifted samples to the sums for all lags at once
+        :param x: (m, variables) shifted values
+        :return:
+        """
+        m = len(x)
+        n = self.count
+        blocks = self._block(np.arange(n, n + m))
+        for block in np.unique(blocks):
+            block_rows = x[blocks == block]
+            self._block_count[block] += len(block_rows)
+            self._sum[block] += block_rows.sum(axis=0)
+            self._sum_products[block] += block_rows.T @ block_rows
 
-        # Calculate average value
-        concentration_mean = np.mean(filtered_data['real_time_concentration'].values)
-        u2_mean = np.mean(filtered_data['u2_axis_speed'].values)
-        v2_mean = np.mean(filtered_data['v2_axis_speed'].values)
-        w2_mean = np.mean(filtered_data['w2_axis_speed'].values)
+        # Pairs x[k + L], c[k] with a new sample and the last samples of the run before them, every pair is added
+        # when its later sample arrives: positive lags pair new wind samples with earlier (or the same) scalars,
+        # negative lags earlier wind samples with new scalars. A pair belongs to the block of its scalar.
+        ring_size = self._max_lag + 1
+        context = min(self._run, self._max_lag)
+        past = (n - context + np.arange(context)) % ring_size
+        rows = np.concatenate((self._ring[past], x))
+        row_blocks = np.concatenate((self._ring_block[past], blocks))
+        new = np.arange(context, context + m)[:, None]
+        steps = np.arange(ring_size)
+        wind_index = np.concatenate((np.repeat(new, ring_size, axis=1), new - steps[1:]), axis=1)
+        scalar_index = np.concatenate((new - steps, np.repeat(new, self._max_lag, axis=1)), axis=1)
+        lag_index = np.broadcast_to(np.r_[self._max_lag + steps, self._max_lag - steps[1:]], wind_index.shape)
+        valid = (wind_index >= 0) & (scalar_index >= 0)
+        wind = rows[wind_index[valid], :3]
+        scalars = rows[scalar_index[valid], 3:]
+        # One weighted bincount per sum, much faster than np.add.at
+        lag_count = 2 * self._max_lag + 1
+        slots = row_blocks[scalar_index[valid]] * lag_count + lag_index[valid]
 
-        #  Turbulent steady state
-        previous_flux_mean, turbulent_steady_state = calculate_turbulent_steady_state(cross_cov_results, w_prime,
-                                                                                      c_prime, SAMPLING_FREQUENCY)
+        def pair_sum(weights):
+            return np.bincount(slots, weights, self._blocks * lag_count).reshape(self._blocks, lag_count)
 
+        self._pair_count += pair_sum(None)
+        for i in range(3):
+            self._pair_wind[:, :, i] += pair_sum(wind[:, i])
+            for j in range(scalars.shape[1]):
+                self._lagged_sum[:, :, i, j] += pair_sum(wind[:, i] * scalars[:, j])
+        for j in range(scalars.shape[1]):
+            self._pair_scalar[:, :, j] += pair_sum(scalars[:, j])
 
+        self._ring[np.arange(n, n + m)[-ring_size:] % ring_size] = x[-ring_size:]
+        self._ring_block[np.arange(n, n + m)[-ring_size:] % ring_size] = blocks[-ring_size:]
+        self.count = n + m
+        self._run += m
 
-        # Record the final result in a new CSV file
-        result_file_path = os.path.join(ec_flux_dir, 'EC_FLUX.csv')
-        result_data = pd.DataFrame({
-            'TIMESTAMP': [filtered_data['TIMESTAMP'].iloc[0]],
-            'flux': [raw_flux], # mg/(m^2 s) for CH4
-            'friction_velocity': [friction_velocity],
-            'concentration_mean': [concentration_mean],
-            'u2_mean': [u2_mean],
-            'v2_mean': [v2_mean],
-            'w2_mean': [w2_mean],
-            'turbulent_steady_state': [turbulent_steady_state]
-        })
+    def finish(self):
+        """
+        Calculate the result of the period from the accumulated moments and start a new period
+        :return: (result_data, cross_cov_results) in the layout of save_flux_results, None if not enough data
+        """
+        if self._despike_filled > self._despike_done:
+            self._despike_block(self._despike_filled)
+        alignment = self.alignment_quality()
+        if self.count <= 2 * self._max_lag + 1:
+            self.reset()
+            return None
+        if alignment.pop('rejected'):
+            logging.warning(f"Online period {self.timestamp} rejected: coverage {alignment['coverage']} % (minimum "
+                            f"{ALIGN_MIN_COVERAGE} %), longest gap {alignment['longest_gap']} s (maximum "
+                            f"{ALIGN_MAX_GAP.total_seconds()} s)")
+            self.reset()
+            return None
+        names = ['u', 'v', 'w'] + [setting['name'] for setting in self._scalar_settings]
+        quality = spike_quality(names, self.spike_counts, self.count)
+        quality.update(alignment)
+        result_data, cross_cov_results = self._result({name: getattr(self, name) for name in self._SUMS},
+                                                      self.timestamp, series=self._series[:self.count],
+                                                      quality=quality)
+        self.reset()
+        return result_data, cross_cov_results
 
+    def _result(self, sums, timestamp, totals=None, series=None, quality=None):
+        """
+        Result of a period from its block sums
+        :param sums: dict of the _SUMS arrays of the blocks of the period in time order
+        :param timestamp: TIMESTAMP of the period
+        :param totals: dict of the same sums over the whole period, the sum of the blocks by default
+        :param series: (n, variables) samples of the period for the binned spectra, None for no spectra
+        :param quality: despiking and alignment columns, placed after the rotation like in calculate_flux
+        :return: (result_data, cross_cov_results), result_data holds the spectra under "spectra" like calculate_flux
+        """
+        if totals is None:
+            totals = {name: value.sum(axis=0) for name, value in sums.items()}
+        n = totals['_block_count']
+        total = totals['_sum']
+        means = self._shift + total / n
+        rotation, w_offset, rotation_method = period_rotation(*means[:3], output_dir=self._output_dir)
+        covariance = (totals['_sum_products'] - np.outer(total, total) / n) / (n - 1)
+        wind_covariance = rotation @ covariance[:3, :3] @ rotation.T
+        wind_means = rotation @ (means[:3] - np.array([0.0, 0.0, w_offset]))
+
+        # Lagged covariances of the period from the pair sums of all blocks
+        count = totals['_pair_count'][:, None, None]
+        sum_x = totals['_pair_wind']
+        sum_c = totals['_pair_scalar']
+        lagged_covariance = (totals['_lagged_sum'] - sum_x[:, :, None] * sum_c[:, None, :] / count) / (count - 1)
+        cross_covariance = np.einsum('j,ljk->lk', rotation[2], lagged_covariance)
+        windows = lag_search_windows(self._scalar_settings, self._max_lag, self._sampling_frequency,
+                                     load_lag_history(self._output_dir))
+        noise = np.sqrt(wind_covariance[2, 2] * np.diagonal(covariance)[3:] / n)
+        cross_cov_results, lag, flux, lag_source = scalar_lags(cross_covariance, self._scalar_settings, windows, noise)
+
+        # Block moments of w' and every scalar at its lag, and of the rotated wind
+        index = self._max_lag + lag
+        scalars = np.arange(len(lag))
+        moments = Stationarity_Module.moments_from_sums(
+            sums['_pair_count'][:, index], sums['_pair_wind'][:, index] @ rotation[2],
+            sums['_pair_scalar'][:, index, scalars],
+            np.einsum('j,bkjk->bk', rotation[2], sums['_lagged_sum'][:, index]))
+        fluxes = scalar_flux_results(cross_cov_results, lag, flux, lag_source, moments, self._scalar_settings)
+        wind_sum = sums['_sum'][:, :3] @ rotation.T
+        wind_products = np.einsum('ij,bjk,lk->bil', rotation, sums['_sum_products'][:, :3, :3], rotation)
+        wind_moments = Stationarity_Module.moments_from_sums(
+            np.repeat(sums['_block_count'][:, None], 3, axis=1), wind_sum, np.repeat(wind_sum[:, 2:], 3, axis=1),
+            wind_products[:, :, 2], np.diagonal(wind_products, axis1=1, axis2=2))
+        friction_velocity = (wind_covariance[0, 2] ** 2 + wind_covariance[1, 2] ** 2) ** 0.25
+
+        spectra = None
+        if series is not None:
+            # Rotated w and the scalars of the period, detrended like in calculate_flux
+            w_rotated = series[:, :3] @ rotation[2] - rotation[2, 2] * w_offset
+            spectra = Spectral_Module.binned_spectra(w_rotated - w_rotated.mean(), series[:, 3:] - means[3:], lag,
+                                                     self._sampling_frequency)
+
+        result_data = build_result_data(timestamp, friction_velocity, wind_means, means[3:], fluxes,
+                                        self._scalar_settings, self._sampling_frequency)
+        result_data.update(rotation_record(*means[:3], rotation, rotation_method))
+        result_data.update(quality or {})
+        result_data.update(spectral_correction(
+            fluxes, friction_velocity, means[3:], self._scalar_settings, self._sampling_frequency,
+            load_spectra_averages(self._scalar_settings, self._sampling_frequency, self._output_dir), spectra))
+        result_data.update(turbulence_quality(fluxes, wind_moments, result_data['z_over_L'], self._scalar_settings))
+        if spectra is not None:
+            result_data['spectra'] = {'sampling_frequency': self._sampling_frequency,
+                                      'stability': result_data['stability_class'],
+                                      'names': [setting['name'] for setting in self._scalar_settings],
+                                      'power': spectra[0], 'cospectra': spectra[1]}
+        return result_data, list(fluxes['cross_cov_results'][:, 0])
+
+
+class RollingFluxAccumulator(FluxAccumulator):
+    """
+    Online flux of the trailing averaging period every step, e.g. every 5 minutes for leak detection.
+    The samples are summed in clock aligned sub-period blocks (AVERAGING_PERIOD / STATIONARITY_BLOCKS) held in a
+    ring of one block more than the window. A block is complete max_lag samples into the next one, when its
+    lagged pairs are all in: its sums are then added to the window totals, and the sums of the block that left
+    the window were subtracted when its slot was taken by a new block. A result costs the calculation on the
+    totals and the six window blocks, however long the window, and the samples are never revisited. The lagged
+    pairs at the window edges use the samples next to the window; a block without samples breaks the pairs
+    like a new file. The samples are not despiked, which would hold every window back by a despiking block.
+    """
+
+    def __init__(self, step=ROLLING_FLUX_STEP, sampling_frequency=SAMPLING_FREQUENCY, max_lag=MAX_LAG,
+                 scalar_settings=SCALARS, period=AVERAGING_PERIOD, output_dir=None):
+        window_blocks = Stationarity_Module.STATIONARITY_BLOCKS
+        block = period / window_blocks
+        if step <= timedelta(0) or step % block:
+            raise ValueError(f"The rolling step {step} is not a multiple of the sub-period {block}")
+        self._window_blocks = window_blocks
+        self._step_blocks = step // block
+        self._block_milliseconds = block // timedelta(milliseconds=1)
+        self._window_samples = period.total_seconds() * sampling_frequency
+        FluxAccumulator.__init__(self, sampling_frequency, max_lag, scalar_settings, window_blocks + 1, output_dir)
+
+    def reset(self):
+        """Drop all blocks, e.g. after the clock went back"""
+        FluxAccumulator.reset(self)
+        self._totals = {name: np.zeros(getattr(self, name).shape[1:]) for name in self._SUMS}
+        self._slot_block = np.full(self._blocks, -1)  # Block number held by every slot
+        self._in_totals = np.zeros(self._blocks, dtype=bool)
+        self._current_block = None
+        self._pending_block = None  # Last block, waiting for the lagged pairs of its last samples
+        self._pending_until = 0
+
+    def _block(self, index):
+        return np.full(np.shape(index), self._current_block % self._blocks)
+
+    def add_sample(self, data):
+        """
+        Add one combined sample
+        :param data: dict with time and the columns of FluxAccumulator.add_sample
+        :return: list of (result_data, cross_cov_results) of the windows completed by this sample, mostly empty
+        """
+        try:
+            block = timestamp_to_milliseconds(data['time']) // self._block_milliseconds
+        except (KeyError, TypeError, ValueError):
+            return []
+        results = []
+        if self._current_block is not None and block < self._current_block:
+            self.reset()
+        if self._current_block is None:
+            self._start_block(block)
+            self._current_block = block
+        elif block > self._current_block:
+            if self._pending_block is not None:
+                results += self._complete_block()
+            self._start_block(self._current_block + 1)
+            self._pending_block, self._pending_until = self._current_block, self.count + self._max_lag
+            if block > self._current_block + 1:
+                # A block without samples, the last block is complete and no lagged pairs span the gap
+                results += self._complete_block()
+                self._run = 0
+                for new_block in range(max(self._current_block + 2, block - self._blocks + 1), block + 1):
+                    self._start_block(new_block)
+            self._current_block = block
+        values = self._raw_values(data)
+        if values is not None:
+            self._add_values(values[None] / self._divisors)
+        if self._pending_block is not None and self.count >= self._pending_until:
+            results += self._complete_block()
+        return results
+
+    def finish(self):
+        """
+        Complete the block waiting for its lagged pairs and the block being filled (e.g. at the end of a replay),
+        so a window ending with them is calculated, and drop all blocks. The last samples have no later
+        partners, a window ending at a block that was cut short has a lower coverage.
+        :return: list of (result_data, cross_cov_results) like add_sample
+        """
+        results = self._complete_block() if self._pending_block is not None else []
+        if self._current_block is not None and self._block_count[self._current_block % self._blocks]:
+            # The slot of the next block holds the block that leaves the window
+            self._start_block(self._current_block + 1)
+            self._pending_block = self._current_block
+            results += self._complete_block()
+        self.reset()
+        return results
+
+    def _start_block(self, block):
+        """Take the slot of the block, the sums of the block it held leave the window totals"""
+        slot = block % self._blocks
+        for name in self._SUMS:
+            sums = getattr(self, name)
+            if self._in_totals[slot]:
+                self._totals[name] -= sums[slot]
+            sums[slot] = 0
+        self._slot_block[slot] = block
+        self._in_totals[slot] = False
+
+    def _complete_block(self):
+        """
+        Add the pending block to the window totals and calculate the window it ends at a step
+        :return: list with the (result_data, cross_cov_results) of the window, empty without a step or coverage
+        """
+        block = self._pending_block
+        self._pending_block = None
+        slot = block % self._blocks
+        for name in self._SUMS:
+            self._totals[name] += getattr(self, name)[slot]
+        self._in_totals[slot] = True
+        if (block + 1) % self._step_blocks:
+            return []
+        coverage = 100 * self._totals['_block_count'] / self._window_samples
+        if coverage < ALIGN_MIN_COVERAGE or self._totals['_block_count'] <= 2 * self._max_lag + 1:
+            return []
+        # Blocks never started in the window (after a gap) hold zeros
+        slots = np.arange(block - self._window_blocks + 1, block + 1) % self._blocks
+        window_start = (block - self._window_blocks + 1) * self._block_milliseconds
+        result_data, cross_cov_results = self._result(
+            {name: getattr(self, name)[slots] for name in self._SUMS}, format_timestamp(window_start),
+            {name: value.copy() for name, value in self._totals.items()})
+        result_data['window_end'] = format_timestamp((block + 1) * self._block_milliseconds)
+        result_data['coverage'] = round(float(coverage), 2)
+        return [(result_data, cross_cov_results)]
+
+
+def save_flux_results(result_data, cross_cov_results, output_dir=None, update_fit=True, period=AVERAGING_PERIOD):
+    """
+    Save one period result and its cross-covariance curve, in the results store (a rerun period replaces
+    its row) or appended to EC_FLUX.csv and cross_covariance_results.txt with RESULTS_FORMAT = "csv"
+    :param result_data: dict of EC_FLUX.csv columns, starting with TIMESTAMP, binned spectra under "spectra"
+                        go to the spectra NPZ files
+    :param cross_cov_results: list of lagged covariances
+    :param output_dir: result folder, ec_flux_dir by default
+    :param update_fit: add the period to the planar fit (ROTATION_METHOD "planar_fit") and its detected lags to
+                       the lag history, False for the overlapping rolling windows
+    :param period: the rows of the results store are keyed by the start of this period, ROLLING_FLUX_STEP for
+                   the rolling windows
+    :return:
+    """
+    started = time.perf_counter()
+    output_dir = output_dir or ec_flux_dir
+    os.makedirs(output_dir, exist_ok=True)
+    spectra = result_data.get('spectra')
+    row = {key: value for key, value in result_data.items() if key != 'spectra'}
+    if RESULTS_FORMAT == "sqlite":
+        with Results_Store_Module.ResultsStore(Results_Store_Module.store_path(output_dir), period=period) as store:
+            store.upsert(row, cross_cov_results, 1 / SAMPLING_FREQUENCY)
+    else:
+        import pandas as pd
+        result_file_path = os.path.join(output_dir, 'EC_FLUX.csv')
+        result_df = pd.DataFrame({key: [value] for key, value in row.items()})
         if not os.path.exists(result_file_path):
-            result_data.to_csv(result_file_path, index=False, mode='w', header=True)
+            result_df.to_csv(result_file_path, index=False, mode='w', header=True)
         else:
-            result_data.to_csv(result_file_path, index=False, mode='a', header=False)
+            with open(result_file_path, encoding='utf-8') as file:
+                columns = file.readline().strip().split(',')
+            if set(result_df.columns) <= set(columns):
+                result_df.reindex(columns=columns).to_csv(result_file_path, index=False, mode='a', header=False)
+            else:
+                # New result columns (e.g. after an upgrade), the file is rewritten once with the extended header
+                previous = Results_Store_Module.read_results_csv(result_file_path)
+                pd.concat([previous, result_df], ignore_index=True).to_csv(result_file_path, index=False, mode='w',
+                                                                           header=True)
+        save_cross_covariance_results(result_data['TIMESTAMP'], cross_cov_results,
+                                      os.path.join(output_dir, 'cross_covariance_results.txt'))
+    if update_fit and ROTATION_METHOD == "planar_fit" and 'u_mean' in result_data:
+        update_planar_fit(result_data, output_dir)
+    if update_fit:
+        update_lag_history(result_data, output_dir)
+    if spectra is not None:
+        with locked_file(os.path.join(output_dir, Spectral_Module.SPECTRA_AVERAGE_FILE)):
+            Spectral_Module.save_period_spectra(output_dir, result_data['TIMESTAMP'], spectra)
+    Metrics_Module.observe("calculation_stage_seconds", time.perf_counter() - started, stage="write")
 
-        # Save the cross-covariance results to cross_covariance_results.txt
-        output_file_path = os.path.join(ec_flux_dir, 'cross_covariance_results.txt')
-        save_cross_covariance_results(filtered_data['TIMESTAMP'].iloc[0], cross_cov_results, output_file_path)
 
-        logging.info("Data calculation completed and results saved.")
-    else:
-        print("No matching files found in RawData folder")
+# ==========================================================================================
+# Binary raw data files
+# A file is the magic bytes, a uint32 header length, a JSON header with the schema and sampling frequency
+# (padded to 8 bytes) and then fixed size records of an int64 timestamp (ms) and one value per column.
+# ==========================================================================================
+def timestamp_to_milliseconds(timestamp):
+    """
+    Convert a raw data TIMESTAMP string to milliseconds since 1970-01-01 (local time, no time zone)
+    :param timestamp: e.g. 2024-01-01 00:00:00.10
+    :return: int
+    """
+    delta = datetime.strptime(timestamp, TIMESTAMP_FORMAT) - datetime(1970, 1, 1)
+    return delta // timedelta(milliseconds=1)
+
+
+def format_timestamp(timestamp):
+    """
+    Format a millisecond timestamp like the TIMESTAMP column of the text files, strings are returned unchanged
+    :param timestamp: int milliseconds or str
+    :return: str
+    """
+    if isinstance(timestamp, str):
+        return timestamp
+    return (datetime(1970, 1, 1) + timedelta(milliseconds=int(timestamp))).strftime(TIMESTAMP_FORMAT)[:-4]
+
+
+def binary_record_dtype(columns=RAW_DATA_COLUMNS, float_dtype='<f8'):
+    """
+    NumPy dtype of one binary record
+    :param columns: value column names
+    :param float_dtype: '<f8' or '<f4'
+    :return: structured dtype
+    """
+    return np.dtype([('TIMESTAMP', '<i8')] + [(column, float_dtype) for column in columns])
+
+
+def binary_file_header(columns=RAW_DATA_COLUMNS, sampling_frequency=SAMPLING_FREQUENCY, float_dtype='<f8'):
+    """
+    Header bytes of a binary raw data file
+    :param columns: value column names
+    :param sampling_frequency: unit:Hz
+    :param float_dtype: '<f8' or '<f4'
+    :return: bytes
+    """
+    schema = json.dumps({
+        'sampling_frequency': sampling_frequency,
+        'columns': [[name, dtype.str] for name, (dtype, _) in binary_record_dtype(columns, float_dtype).fields.items()]
+    }).encode('utf-8')
+    schema += b' ' * (-(len(BINARY_FILE_MAGIC) + 4 + len(schema)) % 8)
+    return BINARY_FILE_MAGIC + np.uint32(len(schema)).tobytes() + schema
+
+
+def encode_binary_record(data, dtype):
+    """
+    Encode one combined sample as a binary record, missing values are stored as NaN
+    :param data: dict with time and the value columns
+    :param dtype: record dtype from binary_record_dtype
+    :return: bytes
+    """
+    record = np.zeros(1, dtype=dtype)
+    record['TIMESTAMP'] = timestamp_to_milliseconds(data['time'])
+    for column in dtype.names[1:]:
+        value = data.get(column)
+        record[column] = np.nan if value is None else value
+    return record.tobytes()
+
+
+def read_binary_header(file_path):
+    """
+    Read the header of a binary raw data file
+    :param file_path:
+    :return: (record dtype, sampling frequency, data offset)
+    """
+    with open(file_path, 'rb') as file:
+        magic = file.read(len(BINARY_FILE_MAGIC))
+        if magic != BINARY_FILE_MAGIC:
+            raise ValueError(f"{file_path} is not an OpenFlux binary raw data file")
+        header_length = int(np.frombuffer(file.read(4), dtype='<u4')[0])
+        schema = json.loads(file.read(header_length).decode('utf-8'))
+    dtype = np.dtype([(name, dtype) for name, dtype in schema['columns']])
+    return dtype, schema['sampling_frequency'], len(BINARY_FILE_MAGIC) + 4 + header_length
+
+
+def read_binary_data(file_path):
+    """
+    Memory-map a binary raw data file, the columns are NumPy views on the file with no parsing step.
+    A record left incomplete by an interrupted write is ignored.
+    :param file_path:
+    :return: structured array, e.g. data['w_axis_speed']
+    """
+    dtype, _, offset = read_binary_header(file_path)
+    count = (os.path.getsize(file_path) - offset) // dtype.itemsize
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(file_path, dtype=dtype, mode='r', offset=offset, shape=(count,))
+
+
+def read_raw_data(file_path):
+    """
+    Read a raw data file in text or binary format into a DataFrame
+    :param file_path:
+    :return: DataFrame with TIMESTAMP and the value columns
+    """
+    import pandas as pd
+    if file_path.endswith(BINARY_FILE_EXTENSION):
+        records = read_binary_data(file_path)
+        return pd.DataFrame({name: records[name] for name in records.dtype.names})
+    return pd.read_csv(file_path, delimiter=',')
+
+
+def raw_data_columns(file_path):
+    """
+    Column names of a raw data file in text or binary format, without reading the data
+    :param file_path:
+    :return: list starting with TIMESTAMP
+    """
+    if file_path.endswith(BINARY_FILE_EXTENSION):
+        return list(read_binary_header(file_path)[0].names)
+    with open(file_path, encoding='utf-8') as file:
+        return file.readline().strip().split(',')
+
+
+def count_raw_rows(file_path):
+    """
+    Upper bound of the samples in a raw data file for preallocation: the records of a binary file, the lines
+    of a text file counted in 1 MB blocks
+    :param file_path:
+    :return: int
+    """
+    if file_path.endswith(BINARY_FILE_EXTENSION):
+        dtype, _, offset = read_binary_header(file_path)
+        return max(os.path.getsize(file_path) - offset, 0) // dtype.itemsize
+    lines = 1
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            lines += block.count(b'\n')
+    return lines
+
+
+def raw_data_chunks(file_path, columns, chunk_rows=RAW_READ_CHUNK_ROWS, strict=True):
+    """
+    Read the TIMESTAMP and the given value columns of a raw data file in chunks of chunk_rows rows, the other
+    columns are not parsed. Text files are parsed with explicit float64 dtypes (strict) or, for files with values
+    that are not numbers, converted column by column with those values as NaN. Binary files are sliced from the
+    memory map.
+    :param file_path:
+    :param columns: value columns
+    :param chunk_rows:
+    :param strict: raise ValueError for a text value that is not a number instead of converting it to NaN
+    :return: generator of (milliseconds (m,) float64 with NaN for unreadable timestamps, values (m, k) float64,
+             missing (m,) bool: rows with an empty or None value, the gaps of the logger)
+    """
+    if file_path.endswith(BINARY_FILE_EXTENSION):
+        records = read_binary_data(file_path)
+        for start in range(0, len(records), chunk_rows):
+            chunk = records[start:start + chunk_rows]
+            values = np.empty((len(chunk), len(columns)))
+            for i, column in enumerate(columns):
+                values[:, i] = chunk[column]
+            yield chunk['TIMESTAMP'].astype(np.float64), values, np.isnan(values).any(axis=1)
+        return
+
+    import pandas as pd
+    dtype = {'TIMESTAMP': str}
+    if strict:
+        dtype.update(dict.fromkeys(columns, np.float64))
+    with pd.read_csv(file_path, delimiter=',', usecols=['TIMESTAMP'] + list(columns), dtype=dtype,
+                     na_values=['None'], chunksize=chunk_rows) as reader:
+        for chunk in reader:
+            values = np.empty((len(chunk), len(columns)))
+            missing = np.zeros(len(chunk), dtype=bool)
+            for i, column in enumerate(columns):
+                series = chunk[column]
+                if strict:
+                    values[:, i] = series.to_numpy()
+                else:
+                    missing |= series.isna().to_numpy()
+                    values[:, i] = pd.to_numeric(series, errors='coerce').to_numpy(dtype=np.float64)
+            if strict:
+                missing = np.isnan(values).any(axis=1)
+            yield parse_timestamps(chunk['TIMESTAMP']), values, missing
+
+
+def read_raw_arrays(file_paths, columns, chunk_rows=RAW_READ_CHUNK_ROWS):
+    """
+    Read the given columns of one or more raw data files into one preallocated float64 array, chunk by chunk,
+    so the memory is the array plus one chunk. Rows with a missing value or an unreadable timestamp are left
+    out like gaps, values that are not numbers become NaN and are interpolated by the despiking.
+    :param file_paths: raw data files in text or binary format, read in this order
+    :param columns: value columns
+    :param chunk_rows:
+    :return: (milliseconds (n,) float64, values (n, k) float64)
+    """
+    rows = sum(count_raw_rows(file_path) for file_path in file_paths)
+    milliseconds = np.empty(rows)
+    values = np.empty((rows, len(columns)))
+    count = 0
+    for file_path in file_paths:
+        file_start = count
+        for strict in (True, False):
+            count = file_start
+            try:
+                for chunk_milliseconds, chunk_values, missing in raw_data_chunks(file_path, columns, chunk_rows,
+                                                                                  strict):
+                    keep = ~(missing | np.isnan(chunk_milliseconds))
+                    kept = int(keep.sum())
+                    milliseconds[count:count + kept] = chunk_milliseconds[keep]
+                    values[count:count + kept] = chunk_values[keep]
+                    count += kept
+                break
+            except ValueError:
+                if not strict:
+                    raise
+                logging.warning(f"{file_path} has values that are not numbers, they are read as NaN")
+    return milliseconds[:count], values[:count]
+
+
+def convert_text_to_binary(text_path, binary_path=None, float_dtype='<f8'):
+    """
+    Convert a text raw data file to the binary format, unreadable values are stored as NaN
+    :param text_path:
+    :param binary_path: same name with .bin by default
+    :param float_dtype: '<f8' or '<f4'
+    :return: binary_path
+    """
+    import pandas as pd
+    binary_path = binary_path or os.path.splitext(text_path)[0] + BINARY_FILE_EXTENSION
+    data = pd.read_csv(text_path, delimiter=',')
+    columns = [column for column in data.columns if column != 'TIMESTAMP']
+    timestamps = pd.to_datetime(data['TIMESTAMP'], format=TIMESTAMP_FORMAT, errors='coerce')
+    # Rows with an unreadable timestamp are dropped
+    data = data[timestamps.notna().values]
+    records = np.zeros(len(data), dtype=binary_record_dtype(columns, float_dtype))
+    records['TIMESTAMP'] = timestamps.dropna().values.astype('datetime64[ms]').astype(np.int64)
+    for column in columns:
+        records[column] = pd.to_numeric(data[column], errors='coerce').values
+    with open(binary_path, 'wb') as file:
+        file.write(binary_file_header(columns, SAMPLING_FREQUENCY, float_dtype))
+        file.write(records.tobytes())
+    return binary_path
+
+
+def convert_binary_to_text(binary_path, text_path=None):
+    """
+    Convert a binary raw data file back to the text format, NaN is written as None like the logger does
+    :param binary_path:
+    :param text_path: same name with .txt by default
+    :return: text_path
+    """
+    import pandas as pd
+    text_path = text_path or os.path.splitext(binary_path)[0] + '.txt'
+    records = read_binary_data(binary_path)
+    data = pd.DataFrame({name: records[name] for name in records.dtype.names[1:]})
+    timestamps = pd.to_datetime(records['TIMESTAMP'], unit='ms').strftime(TIMESTAMP_FORMAT).str[:-4]
+    data.insert(0, 'TIMESTAMP', timestamps)
+    data.to_csv(text_path, index=False, na_rep='None')
+    return text_path
+
+
+def calculate_flux(file_path, extra_data_path="", max_lag=MAX_LAG, sampling_frequency=SAMPLING_FREQUENCY,
+                   planar_fit=None, spectra_averages=None, lag_history=None, output_dir=None):
+    """
+    Calculate the EC flux of one raw data file without saving it
+    :param file_path: raw data file in the OpenFLux_data layout
+    :param extra_data_path:
+    :param max_lag: lag search window unit:samples
+    :param sampling_frequency: unit:Hz
+    :param planar_fit: PlanarFit for ROTATION_METHOD "planar_fit", the one in output_dir by default
+    :param spectra_averages: SpectraAverages for the spectral correction, the ones in output_dir by default
+    :param lag_history: LagHistory of the site for the lag search windows, the one in output_dir by default
+    :param output_dir: result folder of the site, ec_flux_dir by default
+    :return: (result_data, cross_cov_results) in the layout of save_flux_results, result_data also holds the
+             binned spectra under "spectra" for save_flux_results
+    """
+    stages = Metrics_Module.StageTimer("calculation_stage_seconds")
+    # ==========================================================================================
+    # Read raw data
+    # ==========================================================================================
+    # Only the wind and scalar columns are parsed, straight into one float64 array that is aligned, despiked,
+    # rotated and detrended in place
+    file_columns = raw_data_columns(file_path)
+    scalar_settings = [setting for setting in SCALARS if setting['column'] in file_columns]
+    channels = ['u_axis_speed', 'v_axis_speed', 'w_axis_speed'] + [setting['column'] for setting in scalar_settings]
+    # Rows with missing fields are gaps, filled by the time alignment when they are short. Invalid values become
+    # NaN and are interpolated by the despiking, a 0 would go into the covariance
+    milliseconds, values = read_raw_arrays([file_path] + ([extra_data_path] if extra_data_path else []), channels)
+    logging.info(f"data length is {len(values)}")
+    if not len(values):
+        raise PeriodRejected(f"{file_path} has no readable samples")
+    stages.lap("read")
+
+    # Put the samples on the exact sampling grid, short gaps are interpolated
+    aligned, first_sample, alignment = align_to_grid(milliseconds, values, sampling_frequency)
+    period_timestamp = int(milliseconds[first_sample])
+    del milliseconds, values
+    logging.info(f"aligned length is {len(aligned)}, coverage {alignment['coverage']} %, "
+                 f"longest gap {alignment['longest_gap']} s")
+    if alignment.pop('rejected'):
+        raise PeriodRejected(f"{file_path} rejected: coverage {alignment['coverage']} % (minimum "
+                             f"{ALIGN_MIN_COVERAGE} %), longest gap {alignment['longest_gap']} s (maximum "
+                             f"{ALIGN_MAX_GAP.total_seconds()} s)")
+    stages.lap("align")
+
+    # Despike the wind components and all scalars together
+    despiked, spike_counts = despike(aligned, DESPIKE_BLOCK.total_seconds() * sampling_frequency, in_place=True)
+    quality = spike_quality(['u', 'v', 'w'] + [setting['name'] for setting in scalar_settings], spike_counts,
+                            len(despiked))
+    quality.update(alignment)
+    despiked[:, 3:] /= np.array([setting['divisor'] for setting in scalar_settings], dtype=np.float64)
+    stages.lap("despike")
+    # ==========================================================================================
+    # Process data
+    # ==========================================================================================
+    # Rotation wind direction, one matrix product for the double rotation and the planar fit
+    wind = despiked[:, :3]
+    raw_wind_means = np.mean(wind, axis=0)
+    rotation, w_offset, rotation_method = period_rotation(*raw_wind_means, planar_fit, output_dir)
+    rotate_wind_in_place(wind, rotation, w_offset)
+    stages.lap("rotate")
+
+    # Calculate variable detrends use average value
+    means = np.mean(despiked, axis=0)
+    despiked -= means
+    wind_means, scalar_means = means[:3], means[3:]
+    wind_prime, w_prime, scalar_primes = despiked[:, :3], despiked[:, 2], despiked[:, 3:]
+    stages.lap("detrend")
+
+    # Time lag and raw flux of every scalar in one pass, only the lags of the search windows are scanned
+    windows = lag_search_windows(scalar_settings, max_lag, sampling_frequency,
+                                 lag_history if lag_history is not None else load_lag_history(output_dir))
+    cross_covariance = calculate_cross_covariance(w_prime, scalar_primes, max_lag,
+                                                  lags=np.arange(windows[0].min(), windows[1].max() + 1))
+    stages.lap("lag_scan")
+    fluxes = calculate_scalar_fluxes(cross_covariance, w_prime, scalar_primes, scalar_settings, sampling_frequency,
+                                     windows)
+    cross_cov_results = list(fluxes['cross_cov_results'][:, 0])
+
+    # Calculate u*, from the same sub-period moments as the integral turbulence test
+    wind_moments = wind_block_moments(wind_prime, Stationarity_Module.block_length(
+        len(w_prime), stationarity_block_length(sampling_frequency)))
+    friction_velocity = float(Stationarity_Module.wind_statistics(
+        Stationarity_Module.combine_moments(wind_moments))['friction_velocity'])
+
+    result_data = build_result_data(period_timestamp, friction_velocity, wind_means, scalar_means, fluxes,
+                                    scalar_settings, sampling_frequency)
+    result_data.update(rotation_record(*raw_wind_means, rotation, rotation_method))
+    result_data.update(quality)
+    stages.lap("stats")
+
+    # Binned spectra and cospectra, stability and spectral correction
+    spectra = Spectral_Module.binned_spectra(w_prime, scalar_primes, fluxes['lag'], sampling_frequency)
+    if spectra_averages is None:
+        spectra_averages = load_spectra_averages(scalar_settings, sampling_frequency, output_dir)
+    result_data.update(spectral_correction(fluxes, friction_velocity, scalar_means, scalar_settings,
+                                           sampling_frequency, spectra_averages, spectra))
+    result_data.update(turbulence_quality(fluxes, wind_moments, result_data['z_over_L'], scalar_settings))
+    result_data['spectra'] = {'sampling_frequency': sampling_frequency, 'stability': result_data['stability_class'],
+                              'names': [setting['name'] for setting in scalar_settings],
+                              'power': spectra[0], 'cospectra': spectra[1]}
+    stages.lap("spectra")
+    Metrics_Module.increment("calculations_total")
+    return result_data, cross_cov_results
+
+
+def run_data_calculation(filename="flag_file.txt",extra_data_path="", max_lag=MAX_LAG,
+                         sampling_frequency=SAMPLING_FREQUENCY):
+    """
+    main function，calculation EC flux each averaging period
+    :param filename:
+    :param extra_data_path:
+    :param max_lag: lag search window unit:samples
+    :param sampling_frequency: unit:Hz
+    :return:
+    """
+    logging.info("Starting data calculation module.")
+    print("Starting data calculation module.")
+
+    # Verify that the original data file exists
+    flag_file_path = os.path.join(BASE_DIR,"OpenFLux_data",filename)
+    # flag_file_path = os.path.join("./", "OpenFLux数据保存", filename)
+
+    if not os.path.exists(flag_file_path):
+        print(f"Flag bit file does not exist, end of program {flag_file_path}")
+        return
+
+    try:
+        result_data, cross_cov_results = calculate_flux(flag_file_path, extra_data_path, max_lag, sampling_frequency)
+    except PeriodRejected as e:
+        logging.warning(str(e))
+        print(e)
+        return
+    save_flux_results(result_data, cross_cov_results)
+
+    logging.info("Data calculation completed and results saved.")
 
 if __name__ == "__main__":
 
@@ -0,0 +1,689 @@
+# ===========================================================================================
+# Copyright (c)  2024 HealthyPhoton Technology. All rights reserved.
+# Licensed under the MIT License. See LICENSE file in the project root for details.
+# ===========================================================================================
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import Batch_Processing_Module
+import Data_Calculation_Module
+import Metrics_Module
+
+# Server
+INGEST_HOST = "0.0.0.0"
+INGEST_PORT = 9200
+INGEST_DATA_DIR = os.path.join(".", "ingest_data")  # Raw half hour files, one folder per site
+INGEST_RESULT_DIR = os.path.join(".", "ingest_flux")  # Results, one folder per site
+INGEST_STATE_FILE = "ingest_state.json"  # Last acknowledged sample and open period of a site, in its data folder
+MAX_PENDING_CALCULATIONS = 8  # Closed periods waiting for a calculation before the server stops reading batches
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024  # unit:bytes, larger messages are a protocol error
+# Logger
+SPOOL_DIR = os.path.join(".", "ingest_spool")  # Samples not yet acknowledged by the server
+SPOOL_SEGMENT_SAMPLES = 18000  # Samples per spool file, half an hour at 10 Hz
+SPOOL_STATE_FILE = "spool_state.json"  # Last acknowledged sequence number, so a restart continues the numbering
+BATCH_INTERVAL = 1.0  # New samples are spooled and sent at least this often unit:s
+BATCH_SAMPLES = 600  # Largest batch, a resume after an outage is sent in batches of this size
+MAX_UNACKED_BATCHES = 8  # Batches in flight before the logger waits for acknowledgements
+ACK_TIMEOUT = 30  # Reconnect when batches stay unacknowledged this long unit:s
+CONNECT_TIMEOUT = 5  # unit:s
+RECONNECT_DELAY = (1, 60)  # First and longest delay between connection attempts unit:s
+
+
+# ==========================================================================================
+# Messages
+# Every message is two uint32 lengths, a JSON header and a payload of binary raw data records
+# (Data_Calculation_Module.binary_record_dtype).
+# logger -> server: {"type": "hello", "site", "sampling_frequency", "columns"}, then
+#                   {"type": "batch", "sequence": first sequence number, "count"} + records
+# server -> logger: {"type": "resume", "sequence": last acknowledged sequence number, -1 for none}, then
+#                   {"type": "ack", "sequence": last sequence number written}
+# ==========================================================================================
+def encode_message(header, payload=b""):
+    """
+    :param header: dict
+    :param payload: bytes
+    :return: bytes
+    """
+    header = json.dumps(header).encode('utf-8')
+    return np.array([len(header), len(payload)], dtype='<u4').tobytes() + header + payload
+
+
+async def read_message(reader):
+    """
+    Read one message
+    :param reader: asyncio.StreamReader
+    :return: (header dict, payload bytes)
+    """
+    header_length, payload_length = (int(length) for length in np.frombuffer(await reader.readexactly(8), '<u4'))
+    if header_length + payload_length > MAX_MESSAGE_SIZE:
+        raise ValueError(f"Message of {header_length + payload_length} bytes is too large")
+    header = json.loads((await reader.readexactly(header_length)).decode('utf-8'))
+    payload = await reader.readexactly(payload_length) if payload_length else b""
+    return header, payload
+
+
+def record_dtype_from_columns(columns):
+    """
+    :param columns: [[name, dtype string], ...] as in the binary file header
+    :return: record dtype
+    """
+    return np.dtype([(name, dtype) for name, dtype in columns])
+
+
+def _write_json(path, content):
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w", encoding="utf-8") as file:
+        json.dump(content, file)
+    os.replace(temporary_path, path)
+
+
+# ==========================================================================================
+# Server
+# ==========================================================================================
+def calculate_site_period(file_path, result_dir, sampling_frequency):
+    """
+    Executor task, calculate and save the flux of one closed period of a site
+    :param file_path: binary raw data file of the period
+    :param result_dir: result folder of the site
+    :param sampling_frequency: unit:Hz
+    :return: TIMESTAMP of the result or None if the period was rejected
+    """
+    try:
+        result_data, cross_cov_results = Data_Calculation_Module.calculate_flux(
+            file_path, max_lag=int(Data_Calculation_Module.LAG_TIME.total_seconds() * sampling_frequency),
+            sampling_frequency=sampling_frequency, output_dir=result_dir)
+    except Data_Calculation_Module.PeriodRejected as e:
+        logging.warning(str(e))
+        return None
+    Data_Calculation_Module.save_flux_results(result_data, cross_cov_results, result_dir)
+    return result_data['TIMESTAMP']
+
+
+class SiteStream:
+    """
+    Raw data of one site on the server. Batches are written to the binary half hour file of their period,
+    a sample of a later period closes the file and hands it to the calculation.
+    """
+
+    def __init__(self, site, data_dir, result_dir):
+        self.site = site
+        self.data_dir = os.path.join(data_dir, site)
+        self.result_dir = os.path.join(result_dir, site)
+        os.makedirs(self.data_dir, exist_ok=True)
+        os.makedirs(self.result_dir, exist_ok=True)
+        self.state_path = os.path.join(self.data_dir, INGEST_STATE_FILE)
+        state = {}
+        if os.path.exists(self.state_path):
+            with open(self.state_path, encoding="utf-8") as file:
+                state = json.load(file)
+        self.last_sequence = state.get('last_sequence', -1)
+        self.period = state.get('period')  # Start of the open period unit:ms
+        self.sampling_frequency = state.get('sampling_frequency')
+        self.dtype = record_dtype_from_columns(state['columns']) if 'columns' in state else None
+        self.calculation_lock = asyncio.Lock()  # One calculation per site at a time, results are saved in order
+        self._file = None
+
+    def period_path(self, period):
+        """
+        :param period: period start unit:ms
+        :return: raw data file path of the period
+        """
+        start = datetime.datetime(1970, 1, 1) + datetime.timedelta(milliseconds=int(period))
+        return os.path.join(self.data_dir,
+                            start.strftime('%Y%m%d_%H%M') + Data_Calculation_Module.BINARY_FILE_EXTENSION)
+
+    def configure(self, dtype, sampling_frequency):
+        """
+        Record layout announced by the logger, a new layout closes the open period
+        :param dtype: record dtype
+        :param sampling_frequency: unit:Hz
+        :return: path of the closed file or None
+        """
+        closed = None
+        if self.dtype is not None and (dtype != self.dtype or sampling_frequency != self.sampling_frequency):
+            closed = self._close_period()
+        self.dtype, self.sampling_frequency = dtype, sampling_frequency
+        return closed
+
+    def _close_period(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        closed = self.period_path(self.period) if self.period is not None else None
+        self.period = None
+        return closed if closed and os.path.exists(closed) else None
+
+    def _open_period(self, period):
+        self.period = period
+        file_path = self.period_path(period)
+        # A period that was open when the server stopped is continued
+        if os.path.exists(file_path) and os.path.getsize(file_path):
+            self._file = open(file_path, 'ab')
+        else:
+            self._file = open(file_path, 'wb')
+            float_dtype = self.dtype[1].str if len(self.dtype) > 1 else '<f8'
+            self._file.write(Data_Calculation_Module.binary_file_header(list(self.dtype.names[1:]),
+                                                                      self.sampling_frequency, float_dtype))
+
+    def write(self, first_sequence, records):
+        """
+        Write a batch, samples that were already written (a resent batch) are skipped
+        :param first_sequence: sequence number of the first record
+        :param records: structured array of self.dtype
+        :return: list of closed period files
+        """
+        last_sequence = first_sequence + len(records) - 1
+        skip = self.last_sequence + 1 - first_sequence
+        if skip < 0:
+            Metrics_Module.increment("ingest_lost_samples_total", -skip, site=self.site)
+            logging.warning(f"{self.site}: {-skip} samples never arrived")
+        records = records[max(skip, 0):]
+        closed = []
+        if len(records):
+            period_length = Data_Calculation_Module.AVERAGING_PERIOD // datetime.timedelta(milliseconds=1)
+            periods = records['TIMESTAMP'] // period_length * period_length
+            # Samples older than the open period or a period earlier in the batch (e.g. a wall clock step back)
+            # are dropped, a closed file is never reopened
+            opened = np.maximum.accumulate(periods)
+            if self.period is not None:
+                opened = np.maximum(opened, self.period)
+            late = periods < opened
+            if late.any():
+                Metrics_Module.increment("ingest_late_samples_total", int(late.sum()), site=self.site)
+                records, periods = records[~late], periods[~late]
+        # A batch of late samples only moves the sequence on, so it is acknowledged and not resent
+        if len(records):
+            boundaries = np.flatnonzero(np.diff(periods)) + 1
+            for start, end in zip(np.r_[0, boundaries], np.r_[boundaries, len(records)]):
+                if periods[start] != self.period:
+                    closed_path = self._close_period()
+                    if closed_path:
+                        closed.append(closed_path)
+                    self._open_period(int(periods[start]))
+                elif self._file is None:
+                    self._open_period(self.period)
+                self._file.write(records[start:end].tobytes())
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            Metrics_Module.increment("ingest_samples_total", len(records), site=self.site)
+        self.last_sequence = max(self.last_sequence, last_sequence)
+        self._save_state()
+        return closed
+
+    def _save_state(self):
+        _write_json(self.state_path, {
+            'last_sequence': self.last_sequence, 'period': self.period,
+            'sampling_frequency': self.sampling_frequency,
+            'columns': [[name, dtype.str] for name, (dtype, _) in self.dtype.fields.items()]})
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class IngestServer:
+    """
+    asyncio ingest service for many loggers. Every connection streams the batches of one site, which are
+    written to the raw files of the site and acknowledged; every closed period is calculated in a process
+    pool with calculate_flux and saved to the result folder of the site. A batch is only read when fewer than
+    max_pending periods wait for a calculation, so a slow calculation holds the loggers back through TCP
+    instead of filling the server memory.
+    """
+
+    def __init__(self, data_dir=INGEST_DATA_DIR, result_dir=INGEST_RESULT_DIR,
+                 max_pending=MAX_PENDING_CALCULATIONS, workers=None):
+        self.data_dir = data_dir
+        self.result_dir = result_dir
+        self.max_pending = max_pending
+        self.sites = {}
+        self._workers = workers
+        self._executor = None
+        self._server = None
+        self._pending = 0
+        self._capacity = None
+        self._tasks = set()
+
+    def site(self, name):
+        """
+        :param name: site name
+        :return: SiteStream of the site
+        """
+        if not name or os.path.basename(name) != name or name.startswith('.'):
+            raise ValueError(f"Invalid site name {name!r}")
+        if name not in self.sites:
+            self.sites[name] = SiteStream(name, self.data_dir, self.result_dir)
+        return self.sites[name]
+
+    async def start(self, host=INGEST_HOST, port=INGEST_PORT):
+        """
+        Start listening, and calculate the closed periods of the known sites that have no result yet
+        :param host:
+        :param port: 0 picks a free port
+        :return: the listening port
+        """
+        # Spawned, a forked worker would inherit the listening socket and keep the port after a crash
+        self._executor = ProcessPoolExecutor(max_workers=self._workers, mp_context=multiprocessing.get_context("spawn"),
+                                             initializer=Data_Calculation_Module.configure_logging)
+        self._capacity = asyncio.Condition()
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        if os.path.isdir(self.data_dir):
+            for name in sorted(os.listdir(self.data_dir)):
+                if os.path.isdir(os.path.join(self.data_dir, name)):
+                    self.recover(self.site(name))
+        return self._server.sockets[0].getsockname()[1]
+
+    def recover(self, site):
+        """
+        Queue the closed periods of a site without a result, e.g. after a server restart
+        :param site: SiteStream
+        :return: number of queued periods
+        """
+        done = Batch_Processing_Module.processed_periods(site.result_dir)
+        open_path = site.period_path(site.period) if site.period is not None else None
+        queued = 0
+        for period, file_path in Batch_Processing_Module.find_raw_files(site.data_dir):
+            if period not in done and file_path != open_path:
+                self._calculate(site, file_path)
+                queued += 1
+        return queued
+
+    def _calculate(self, site, file_path):
+        self._pending += 1
+        Metrics_Module.set_gauge("ingest_pending_calculations", self._pending)
+        task = asyncio.get_running_loop().create_task(self._run_calculation(site, file_path))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_calculation(self, site, file_path):
+        try:
+            async with site.calculation_lock:
+                started = time.perf_counter()
+                timestamp = await asyncio.get_running_loop().run_in_executor(
+                    self._executor, calculate_site_period, file_path, site.result_dir, site.sampling_frequency)
+                Metrics_Module.observe("ingest_calculation_seconds", time.perf_counter() - started, site=site.site)
+                if timestamp is not None:
+                    logging.info(f"{site.site}: calculated {timestamp}")
+        except Exception as e:
+            logging.error(f"{site.site}: calculation of {file_path} failed: {e}")
+        finally:
+            async with self._capacity:
+                self._pending -= 1
+                Metrics_Module.set_gauge("ingest_pending_calculations", self._pending)
+                self._capacity.notify_all()
+
+    async def _wait_for_capacity(self):
+        async with self._capacity:
+            await self._capacity.wait_for(lambda: self._pending < self.max_pending)
+
+    async def _handle_connection(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        site = None
+        try:
+            header, _ = await read_message(reader)
+            if header.get('type') != 'hello':
+                raise ValueError(f"Expected hello, got {header.get('type')}")
+            site = self.site(header['site'])
+            closed = site.configure(record_dtype_from_columns(header['columns']), header['sampling_frequency'])
+            if closed:
+                self._calculate(site, closed)
+            writer.write(encode_message({'type': 'resume', 'sequence': site.last_sequence}))
+            await writer.drain()
+            logging.info(f"{site.site} connected from {peer}, resuming after sample {site.last_sequence}")
+            Metrics_Module.increment("ingest_connections_total", site=site.site)
+
+            while True:
+                await self._wait_for_capacity()
+                header, payload = await read_message(reader)
+                if header.get('type') != 'batch':
+                    raise ValueError(f"Expected batch, got {header.get('type')}")
+                if len(payload) != header['count'] * site.dtype.itemsize:
+                    raise ValueError(f"Batch of {len(payload)} bytes for {header['count']} records")
+                records = np.frombuffer(payload, dtype=site.dtype)
+                for closed in site.write(header['sequence'], records):
+                    self._calculate(site, closed)
+                writer.write(encode_message({'type': 'ack', 'sequence': site.last_sequence}))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except (ValueError, KeyError, TypeError) as e:
+            logging.error(f"Protocol error from {peer}: {e}")
+        except Exception:
+            # The server keeps serving the other sites, the logger reconnects and resends the batch
+            logging.exception(f"Unexpected error on the stream from {peer}")
+        finally:
+            if site is not None:
+                logging.info(f"{site.site} disconnected")
+            writer.close()
+
+    async def close(self):
+        """Stop listening, wait for the running calculations and close the raw files"""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        for site in self.sites.values():
+            site.close()
+        if self._executor is not None:
+            self._executor.shutdown()
+
+
+async def serve(host=INGEST_HOST, port=INGEST_PORT, data_dir=INGEST_DATA_DIR, result_dir=INGEST_RESULT_DIR,
+                workers=None):
+    """
+    Run an ingest server until it is cancelled
+    :param host:
+    :param port:
+    :param data_dir:
+    :param result_dir:
+    :param workers: calculation processes, all cores by default
+    :return:
+    """
+    server = IngestServer(data_dir, result_dir, workers=workers)
+    port = await server.start(host, port)
+    print(f"Ingest server listening on {host}:{port}")
+    stop_event = threading.Event()
+    Metrics_Module.start_exporters(stop_event)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        stop_event.set()
+        await server.close()
+
+
+# ==========================================================================================
+# Logger
+# ==========================================================================================
+class IngestClient:
+    """
+    Logger side of the ingest service. add_sample only queues the encoded sample, a background thread with
+    its own event loop appends the queued samples to the local spool every BATCH_INTERVAL and streams the
+    spool to the server. Acknowledged spool files are deleted, so while the link is down the spool grows and
+    after a reconnect the server tells where to resume.
+    """
+
+    def __init__(self, host, port, site, columns, sampling_frequency, spool_dir=SPOOL_DIR, float_dtype='<f8'):
+        self.host = host
+        self.port = port
+        self.site = site
+        self.sampling_frequency = sampling_frequency
+        self.spool_dir = spool_dir
+        self.dtype = Data_Calculation_Module.binary_record_dtype(columns, float_dtype)
+        self._header = Data_Calculation_Module.binary_file_header(columns, sampling_frequency, float_dtype)
+        self._lock = threading.Lock()
+        self._queued = []
+        self._stop = threading.Event()
+        self._thread = None
+        self._wakeup = None
+        os.makedirs(spool_dir, exist_ok=True)
+        self._segments = self._load_segments()  # [first sequence, path, records], in sequence order
+        state_path = os.path.join(spool_dir, SPOOL_STATE_FILE)
+        self.acknowledged = -1
+        if os.path.exists(state_path):
+            with open(state_path, encoding="utf-8") as file:
+                self.acknowledged = json.load(file)['acknowledged']
+        self.next_sequence = max(self.acknowledged + 1,
+                                 self._segments[-1][0] + self._segments[-1][2] if self._segments else 0)
+
+    def _load_segments(self):
+        segments = []
+        for name in sorted(os.listdir(self.spool_dir)):
+            if not name.endswith(Data_Calculation_Module.BINARY_FILE_EXTENSION):
+                continue
+            path = os.path.join(self.spool_dir, name)
+            try:
+                dtype, _, offset = Data_Calculation_Module.read_binary_header(path)
+            except (ValueError, OSError):
+                dtype = None
+            if dtype != self.dtype:
+                # Spooled with other columns, kept aside for a manual import
+                os.replace(path, path + ".old")
+                logging.warning(f"Spool file {path} has another record layout, renamed to .old")
+                continue
+            segments.append([int(os.path.splitext(name)[0]), path,
+                             (os.path.getsize(path) - offset) // self.dtype.itemsize])
+        return segments
+
+    def add_sample(self, data):
+        """
+        Queue one combined sample, called by the writer thread
+        :param data: dict with time and the value columns
+        :return:
+        """
+        record = Data_Calculation_Module.encode_binary_record(data, self.dtype)
+        with self._lock:
+            self._queued.append(record)
+
+    def spooled(self):
+        """Number of samples not acknowledged by the server yet"""
+        with self._lock:
+            return self.next_sequence - self.acknowledged - 1 + len(self._queued)
+
+    def _spool_queued(self):
+        with self._lock:
+            queued = self._queued[:]
+        while queued:
+            if not self._segments or self._segments[-1][2] >= SPOOL_SEGMENT_SAMPLES:
+                path = os.path.join(self.spool_dir,
+                                    f"{self.next_sequence:020d}{Data_Calculation_Module.BINARY_FILE_EXTENSION}")
+                with open(path, 'wb') as file:
+                    file.write(self._header)
+                self._segments.append([self.next_sequence, path, 0])
+            segment = self._segments[-1]
+            count = min(len(queued), SPOOL_SEGMENT_SAMPLES - segment[2])
+            with open(segment[1], 'ab') as file:
+                file.write(b"".join(queued[:count]))
+                file.flush()
+                os.fsync(file.fileno())
+            # Taken off the queue only once they are in the spool, spooled() never misses a sample
+            with self._lock:
+                del self._queued[:count]
+                segment[2] += count
+                self.next_sequence += count
+            queued = queued[count:]
+        Metrics_Module.set_gauge("ingest_spooled_samples", self.next_sequence - self.acknowledged - 1)
+
+    def _read_spool(self, sequence, count):
+        for first, path, records in self._segments:
+            if first <= sequence < first + records:
+                count = min(count, first + records - sequence)
+                offset = len(self._header) + (sequence - first) * self.dtype.itemsize
+                with open(path, 'rb') as file:
+                    file.seek(offset)
+                    return file.read(count * self.dtype.itemsize), count
+        return b"", 0
+
+    def _acknowledge(self, sequence):
+        # Under the lock, spooled() of the writer thread reads the counters
+        with self._lock:
+            if sequence >= self.next_sequence:
+                # The server has more samples than this spool, e.g. after the spool folder was lost, its numbering
+                # is continued and the spooled samples count as delivered
+                logging.warning(f"Ingest server is at sample {sequence}, the spool only at {self.next_sequence - 1}")
+                for segment in self._segments:
+                    os.remove(segment[1])
+                self._segments = []
+                self.next_sequence = sequence + 1
+            if sequence <= self.acknowledged:
+                return
+            self.acknowledged = sequence
+            _write_json(os.path.join(self.spool_dir, SPOOL_STATE_FILE), {'acknowledged': sequence})
+            # Fully acknowledged spool files are deleted, the one being appended to is kept
+            while len(self._segments) > 1 and self._segments[0][0] + self._segments[0][2] - 1 <= sequence:
+                os.remove(self._segments.pop(0)[1])
+
+    async def _spool_loop(self):
+        while not self._stop.is_set():
+            await asyncio.sleep(BATCH_INTERVAL)
+            self._spool_queued()
+            self._wakeup.set()
+
+    async def _stream(self, reader, writer):
+        writer.write(encode_message({'type': 'hello', 'site': self.site, 'sampling_frequency': self.sampling_frequency,
+                                     'columns': [[name, dtype.str] for name, (dtype, _) in self.dtype.fields.items()]}))
+        await writer.drain()
+        header, _ = await read_message(reader)
+        if header.get('type') != 'resume':
+            raise ValueError(f"Expected resume, got {header.get('type')}")
+        self._acknowledge(header['sequence'])
+        cursor = max(self.acknowledged + 1, self._segments[0][0] if self._segments else 0)
+        in_flight = deque()  # Last sequence number of every unacknowledged batch
+
+        async def read_acknowledgements():
+            while True:
+                ack, _ = await read_message(reader)
+                if ack.get('type') == 'ack':
+                    self._acknowledge(ack['sequence'])
+                    self._wakeup.set()
+
+        ack_task = asyncio.get_running_loop().create_task(read_acknowledgements())
+        try:
+            last_progress = time.monotonic()
+            while not self._stop.is_set():
+                if ack_task.done():
+                    ack_task.result()
+                    raise ConnectionError("Connection closed by the server")
+                while in_flight and in_flight[0] <= self.acknowledged:
+                    in_flight.popleft()
+                    last_progress = time.monotonic()
+                while len(in_flight) < MAX_UNACKED_BATCHES and cursor < self.next_sequence:
+                    payload, count = self._read_spool(cursor, BATCH_SAMPLES)
+                    if not count:
+                        cursor = self.next_sequence
+                        break
+                    writer.write(encode_message({'type': 'batch', 'sequence': cursor, 'count': count}, payload))
+                    cursor += count
+                    in_flight.append(cursor - 1)
+                # Blocks while the server holds the stream back, the spool keeps growing meanwhile
+                await asyncio.wait_for(writer.drain(), ACK_TIMEOUT)
+                if not in_flight:
+                    last_progress = time.monotonic()
+                elif time.monotonic() - last_progress > ACK_TIMEOUT:
+                    raise TimeoutError(f"No acknowledgement for {ACK_TIMEOUT} s")
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), BATCH_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            ack_task.cancel()
+            writer.close()
+
+    async def _run(self):
+        self._wakeup = asyncio.Event()
+        spool_task = asyncio.get_running_loop().create_task(self._spool_loop())
+        delay = RECONNECT_DELAY[0]
+        while not self._stop.is_set():
+            try:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port),
+                                                        CONNECT_TIMEOUT)
+                delay = RECONNECT_DELAY[0]
+                logging.info(f"Connected to the ingest server {self.host}:{self.port}")
+                await self._stream(reader, writer)
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError) as e:
+                logging.warning(f"Ingest server {self.host}:{self.port}: {e}, samples are spooled")
+                Metrics_Module.increment("ingest_reconnects_total")
+            deadline = time.monotonic() + delay
+            while not self._stop.is_set() and time.monotonic() < deadline:
+                await asyncio.sleep(min(0.2, delay))
+            delay = min(delay * 2, RECONNECT_DELAY[1])
+        spool_task.cancel()
+        # Nothing queued is lost on a regular stop
+        self._spool_queued()
+
+    def start(self):
+        """Start the spool and connection thread"""
+        self._thread = threading.Thread(target=asyncio.run, args=(self._run(),), name="ingest_client", daemon=True)
+        self._thread.start()
+
+    def wait_acknowledged(self, timeout):
+        """
+        Wait until the server has acknowledged every queued sample
+        :param timeout: unit:s
+        :return: True if everything was acknowledged
+        """
+        deadline = time.monotonic() + timeout
+        while self.spooled() and time.monotonic() < deadline:
+            time.sleep(0.1)
+        return not self.spooled()
+
+    def stop(self, timeout=10):
+        """Stop the thread, unacknowledged samples stay in the spool for the next start"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+
+def replay_files(file_paths, client, speed=1.0, sampling_frequency=Data_Calculation_Module.SAMPLING_FREQUENCY):
+    """
+    Feed recorded raw data files to an IngestClient as if a logger were sampling them, for tests on one machine
+    :param file_paths: raw data files in time order
+    :param client: started IngestClient
+    :param speed: 1 for real time, 100 for 100 times faster, 0 for as fast as possible
+    :param sampling_frequency: unit:Hz
+    :return: number of samples fed
+    """
+    fed = 0
+    started = time.monotonic()
+    for file_path in file_paths:
+        data = Data_Calculation_Module.read_raw_data(file_path)
+        columns = [column for column in client.dtype.names[1:] if column in data.columns]
+        values = data[columns].to_dict('records')
+        for timestamp, row in zip(data['TIMESTAMP'].tolist(), values):
+            row['time'] = Data_Calculation_Module.format_timestamp(timestamp)
+            client.add_sample(row)
+            fed += 1
+            if speed and fed % sampling_frequency == 0:
+                delay = started + fed / sampling_frequency / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+    return fed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OpenFlux multi-site ingest server, and a logger that replays "
+                                                 "recorded raw files to it")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve_parser = commands.add_parser("serve", help="run the ingest server")
+    serve_parser.add_argument("--host", default=INGEST_HOST)
+    serve_parser.add_argument("--port", type=int, default=INGEST_PORT)
+    serve_parser.add_argument("--data-dir", default=INGEST_DATA_DIR)
+    serve_parser.add_argument("--result-dir", default=INGEST_RESULT_DIR)
+    serve_parser.add_argument("--workers", type=int, help="calculation processes, all cores by default")
+    replay_parser = commands.add_parser("replay", help="stream recorded raw files like a logger")
+    replay_parser.add_argument("files", nargs="+", help="raw data files, e.g. ./OpenFLux_data/20240501_*.txt")
+    replay_parser.add_argument("--site", required=True)
+    replay_parser.add_argument("--server", default=f"127.0.0.1:{INGEST_PORT}", help="host:port")
+    replay_parser.add_argument("--speed", type=float, default=0, help="1 for real time, 0 for unthrottled")
+    replay_parser.add_argument("--spool-dir", help=f"default {SPOOL_DIR}_<site>")
+    args = parser.parse_args()
+
+    Data_Calculation_Module.configure_logging()
+    if args.command == "serve":
+        try:
+            asyncio.run(serve(args.host, args.port, args.data_dir, args.result_dir, args.workers))
+        except KeyboardInterrupt:
+            pass
+    else:
+        host, port = args.server.rsplit(":", 1)
+        files = sorted(args.files)
+        columns = Data_Calculation_Module.read_raw_data(files[0]).columns[1:].tolist()
+        replay_client = IngestClient(host, int(port), args.site, columns, Data_Calculation_Module.SAMPLING_FREQUENCY,
+                                     args.spool_dir or f"{SPOOL_DIR}_{args.site}")
+        replay_client.start()
+        print(f"{replay_files(files, replay_client, args.speed)} samples replayed")
+        if not replay_client.wait_acknowledged(60):
+            print(f"{replay_client.spooled()} samples stay in the spool")
+        replay_client.stop()
@@ -0,0 +1,221 @@
+# ===========================================================================================
+# Copyright (c)  2024 HealthyPhoton Technology. All rights reserved.
+# Licensed under the MIT License. See LICENSE file in the project root for details.
+# ===========================================================================================
+import json
+import os
+import re
+import struct
+
+INSTRUMENT_CONFIG_FILE = "instruments.json"  # Maps serial ports or GPIO pins to drivers
+# Used when there is no configuration file, the HT8x00 and the ultrasonic anemometer on the pigpio soft UART pins
+# of the Raspberry Pi; a PC or a USB serial adapter uses "port" (e.g. "COM3" or "/dev/ttyUSB0") instead of the pins
+DEFAULT_INSTRUMENTS = [
+    {"name": "HT8x00", "driver": "HT8x00", "rx_pin": 19, "tx_pin": 26, "baudrate": 38400},
+    {"name": "wind", "driver": "anemometer", "rx_pin": 25, "tx_pin": 8, "baudrate": 38400},
+]
+
+
+class InstrumentDriver:
+    """
+    Instrument driver: how frames are delimited, which named fields a frame holds and the nominal rate.
+    Subclasses implement parse.
+    """
+
+    def __init__(self, name, fields, start_byte=None, end_byte=b'\r', nominal_rate=10):
+        self.name = name
+        self.fields = list(fields)
+        self.start_byte = start_byte
+        self.end_byte = end_byte
+        self.nominal_rate = nominal_rate  # unit:Hz
+
+    def parse(self, frame):
+        """
+        Parse one complete frame
+        :param frame: bytes including the delimiters
+        :return: tuple of float, one per field, or None if the frame is invalid
+        """
+        raise NotImplementedError
+
+    def encode(self, values):
+        """
+        Build a frame that parses to the given values, for replaying recorded samples (Replay_Module)
+        :param values: one value per field
+        :return: bytes including the delimiters
+        """
+        raise NotImplementedError
+
+
+class CsvDriver(InstrumentDriver):
+    """
+    Driver of a comma separated text frame, the wanted fields are picked by index with one compiled regex
+    and converted with float() straight from bytes, without decode, split or strip.
+    """
+
+    def __init__(self, name, field_indexes, min_fields, start_byte=None, end_byte=b'\r', nominal_rate=10,
+                 separator=b','):
+        """
+        :param name:
+        :param field_indexes: dict of field name to index in the frame (after the start byte)
+        :param min_fields: frames with fewer fields are rejected
+        :param start_byte:
+        :param end_byte:
+        :param nominal_rate: unit:Hz
+        :param separator: one byte
+        """
+        InstrumentDriver.__init__(self, name, field_indexes, start_byte, end_byte, nominal_rate)
+        sep = re.escape(separator)
+        # A field value never contains the separator or the end byte
+        value = b'([^' + sep + re.escape(end_byte) + b']*)'
+        skip = b'[^' + sep + b']*' + sep
+        ordered = sorted(field_indexes.items(), key=lambda item: item[1])
+        pattern = b'^\\s*' + (re.escape(start_byte) if start_byte else b'')
+        position = 0
+        for i, (_, index) in enumerate(ordered):
+            if index > position:
+                pattern += b'(?:' + skip + b'){%d}' % (index - position)
+            pattern += value
+            position = index + 1
+            if i < len(ordered) - 1:
+                pattern += sep
+        if min_fields > position:
+            pattern += b'(?:' + sep + b'[^' + sep + b']*){%d,}' % (min_fields - position)
+        self._regex = re.compile(pattern)
+        # Regex groups follow the frame order, the result follows self.fields
+        group_of = {field: group for group, (field, _) in enumerate(ordered, 1)}
+        self._groups = [group_of[field] for field in self.fields]
+        self._field_indexes = [field_indexes[field] for field in self.fields]
+        self._field_count = max(min_fields, max(field_indexes.values()) + 1)
+        self._separator = separator
+
+    def parse(self, frame):
+        match = self._regex.match(frame)
+        if match is None:
+            return None
+        try:
+            return tuple(float(match.group(group)) for group in self._groups)
+        except ValueError:
+            return None
+
+    def encode(self, values):
+        # Fields that are not parsed are written as 0
+        items = [b'0'] * self._field_count
+        for index, value in zip(self._field_indexes, values):
+            items[index] = repr(float(value)).encode('ascii')
+        return (self.start_byte or b'') + self._separator.join(items) + self.end_byte
+
+
+class StructDriver(InstrumentDriver):
+    """Driver of a fixed layout binary frame, unpacked with a precompiled struct between the delimiters"""
+
+    def __init__(self, name, frame_format, fields, start_byte=b'\x02', end_byte=b'\x03', nominal_rate=10):
+        """
+        :param name:
+        :param frame_format: struct format of the payload, e.g. '<hhhH'
+        :param fields: one name per struct item, None for items that are not used
+        :param start_byte:
+        :param end_byte:
+        :param nominal_rate: unit:Hz
+        """
+        InstrumentDriver.__init__(self, name, [field for field in fields if field], start_byte, end_byte,
+                                  nominal_rate)
+        self._struct = struct.Struct(frame_format)
+        self._items = [i for i, field in enumerate(fields) if field]
+        self._offset = len(start_byte) if start_byte else 0
+        # Struct codes of the items, integer items are rounded when a frame is encoded
+        codes = []
+        for count, code in re.findall(r'(\d*)([xcbB?hHiIlLqQnNefdspP])', frame_format):
+            if code != 'x':
+                codes += [code] * (1 if code in 'sp' else int(count or 1))
+        self._integer_items = [code in 'bBhHiIlLqQnN?' for code in codes]
+
+    def parse(self, frame):
+        if len(frame) < self._offset + self._struct.size:
+            return None
+        values = self._struct.unpack_from(frame, self._offset)
+        return tuple(float(values[i]) for i in self._items)
+
+    def encode(self, values):
+        # Items that are not parsed are written as 0
+        items = [0] * len(self._integer_items)
+        for item, value in zip(self._items, values):
+            items[item] = int(round(value)) if self._integer_items[item] else float(value)
+        payload = self._struct.pack(*items)
+        return (self.start_byte or b'') + payload + (self.end_byte or b'')
+
+
+DRIVERS = {}  # Registered drivers by name
+
+
+def register_driver(driver):
+    """
+    Register a driver so instruments can refer to it by name
+    :param driver: InstrumentDriver
+    :return: driver
+    """
+    DRIVERS[driver.name] = driver
+    return driver
+
+
+def get_driver(name):
+    """
+    Registered driver by name
+    :param name:
+    :return: InstrumentDriver
+    """
+    if name not in DRIVERS:
+        raise KeyError(f"Unknown instrument driver {name}, registered drivers are {sorted(DRIVERS)}")
+    return DRIVERS[name]
+
+
+register_driver(CsvDriver("HT8x00", {"real_time_concentration": 2, "ambient_temperature": 7, "transmittance": 9},
+                          min_fields=19, end_byte=b'\r'))
+register_driver(CsvDriver("anemometer", {"u_axis_speed": 1, "v_axis_speed": 2, "w_axis_speed": 3, "sonic_temp": 6},
+                          min_fields=8, start_byte=b'\x02', end_byte=b'\x03'))
+
+
+def _delimiter(text):
+    """Delimiter from the configuration file, written as a string with escapes such as "\\r" or "\\u0002" """
+    return text.encode('latin-1') if text else None
+
+
+def driver_from_config(name, spec):
+    """
+    Create a driver from its configuration file entry
+    :param name: driver name
+    :param spec: dict with type "csv" (fields, min_fields) or "struct" (format, fields),
+                 and optionally start_byte, end_byte and nominal_rate
+    :return: InstrumentDriver
+    """
+    start_byte = _delimiter(spec.get("start_byte"))
+    end_byte = _delimiter(spec.get("end_byte", "\r"))
+    nominal_rate = spec.get("nominal_rate", 10)
+    if spec["type"] == "csv":
+        return CsvDriver(name, spec["fields"], spec["min_fields"], start_byte, end_byte, nominal_rate)
+    if spec["type"] == "struct":
+        return StructDriver(name, spec["format"], spec["fields"], start_byte, end_byte, nominal_rate)
+    raise ValueError(f"Unknown driver type {spec['type']} for {name}")
+
+
+def load_instrument_config(config_path=INSTRUMENT_CONFIG_FILE):
+    """
+    Load the instrument configuration, DEFAULT_INSTRUMENTS if the file does not exist.
+    Drivers defined in the file are registered first, each instrument then gets its driver object.
+    :param config_path: JSON file with "drivers" (optional) and "instruments"
+    :return: list of instrument dicts with name, driver and either port/baudrate or rx_pin/tx_pin/baudrate
+    """
+    if os.path.exists(config_path):
+        with open(config_path, encoding='utf-8') as file:
+            config = json.load(file)
+    else:
+        config = {"instruments": DEFAULT_INSTRUMENTS}
+
+    for name, spec in config.get("drivers", {}).items():
+        register_driver(driver_from_config(name, spec))
+
+    instruments = []
+    for entry in config["instruments"]:
+        instrument = dict(entry)
+        instrument["driver"] = get_driver(entry["driver"])
+        instruments.append(instrument)
+    return instruments
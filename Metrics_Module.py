@@ -0,0 +1,258 @@
+# ===========================================================================================
+# Copyright (c)  2024 HealthyPhoton Technology. All rights reserved.
+# Licensed under the MIT License. See LICENSE file in the project root for details.
+# ===========================================================================================
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_ENABLED = True  # False turns every counter, timer and exporter into a no-op
+METRICS_HTTP_HOST = "127.0.0.1"  # Prometheus text endpoint at http://host:port/metrics
+METRICS_HTTP_PORT = 9108  # 0 disables the endpoint
+METRICS_FILE = ""  # Prometheus text file rewritten every METRICS_FILE_INTERVAL, "" disables it
+METRICS_FILE_INTERVAL = 10  # unit:s
+METRICS_PREFIX = "openflux_"
+
+_lock = threading.Lock()
+_counters = {}  # (name, labels): value
+_gauges = {}  # (name, labels): value
+_timings = {}  # (name, labels): [count, sum, max]
+_collectors = []  # Callables that report values kept elsewhere when the metrics are rendered
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def increment(name, value=1, **labels):
+    """
+    Add to a counter
+    :param name: metric name without prefix, counters end with _total
+    :param value:
+    :param labels: label values, e.g. instrument="wind"
+    :return:
+    """
+    if not METRICS_ENABLED:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    """
+    Set a gauge
+    :param name: metric name without prefix
+    :param value:
+    :param labels:
+    :return:
+    """
+    if not METRICS_ENABLED:
+        return
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name, seconds, **labels):
+    """
+    Record one duration, exported as count, sum and maximum
+    :param name: metric name without prefix, ending with _seconds
+    :param seconds:
+    :param labels:
+    :return:
+    """
+    if not METRICS_ENABLED:
+        return
+    key = _key(name, labels)
+    with _lock:
+        timing = _timings.get(key)
+        if timing is None:
+            _timings[key] = [1, seconds, seconds]
+        else:
+            timing[0] += 1
+            timing[1] += seconds
+            if seconds > timing[2]:
+                timing[2] = seconds
+
+
+class timer:
+    """Context manager that observes the duration of its block"""
+
+    def __init__(self, name, **labels):
+        self._name = name
+        self._labels = labels
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        observe(self._name, time.perf_counter() - self._start, **self._labels)
+        return False
+
+
+class StageTimer:
+    """Times consecutive stages of one run, each lap records the time since the previous lap"""
+
+    def __init__(self, name, **labels):
+        self._name = name
+        self._labels = labels
+        self._last = time.perf_counter()
+
+    def lap(self, stage):
+        """
+        Record the duration of the stage that just finished
+        :param stage: value of the stage label
+        :return:
+        """
+        now = time.perf_counter()
+        observe(self._name, now - self._last, stage=stage, **self._labels)
+        self._last = now
+
+
+def register_collector(collector):
+    """
+    Register a callable that is asked for its values whenever the metrics are rendered, for counters
+    that are already kept elsewhere and would cost nothing extra on the hot path
+    :param collector: callable returning (name, "counter" or "gauge", labels dict, value) tuples
+    :return: collector
+    """
+    _collectors.append(collector)
+    return collector
+
+
+def _labels_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+def render():
+    """
+    All metrics in the Prometheus text format
+    :return: str
+    """
+    with _lock:
+        counters = list(_counters.items())
+        gauges = list(_gauges.items())
+        timings = [(key, list(timing)) for key, timing in _timings.items()]
+    for collector in _collectors:
+        try:
+            for name, metric_type, labels, value in collector():
+                item = (_key(name, labels), value)
+                (counters if metric_type == "counter" else gauges).append(item)
+        except Exception as e:
+            gauges.append((_key("collector_errors", {"error": type(e).__name__}), 1))
+
+    lines = []
+    typed = set()
+    for metric_type, items in (("counter", counters), ("gauge", gauges)):
+        for (name, labels), value in sorted(items, key=lambda item: item[0]):
+            name = METRICS_PREFIX + name
+            if name not in typed:
+                lines.append(f"# TYPE {name} {metric_type}")
+                typed.add(name)
+            lines.append(f"{name}{_labels_text(labels)} {value}")
+    for (name, labels), (count, total, maximum) in sorted(timings, key=lambda item: item[0]):
+        name = METRICS_PREFIX + name
+        if name not in typed:
+            lines.append(f"# TYPE {name} summary")
+            typed.add(name)
+        lines.append(f"{name}_count{_labels_text(labels)} {count}")
+        lines.append(f"{name}_sum{_labels_text(labels)} {total:.6f}")
+        lines.append(f"{name}_max{_labels_text(labels)} {maximum:.6f}")
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    """Clear all recorded values, the collectors stay registered"""
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _timings.clear()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are not worth a line on the console
+        pass
+
+
+def start_http_server(port=METRICS_HTTP_PORT, host=METRICS_HTTP_HOST):
+    """
+    Serve /metrics from a daemon thread
+    :param port:
+    :param host:
+    :return: the server, shut down with server.shutdown()
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def write_metrics_file(path=METRICS_FILE):
+    """
+    Replace the metrics file with the current metrics, readers never see a partial file
+    :param path:
+    :return:
+    """
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w", encoding="utf-8") as file:
+        file.write(render())
+    os.replace(temporary_path, path)
+
+
+def start_metrics_file(stop_event, path=METRICS_FILE, interval=METRICS_FILE_INTERVAL):
+    """
+    Rewrite the metrics file every interval seconds from a daemon thread until stop_event is set
+    :param stop_event: threading.Event
+    :param path:
+    :param interval: unit:s
+    :return: the thread
+    """
+    def run():
+        while True:
+            stopped = stop_event.wait(interval)
+            try:
+                write_metrics_file(path)
+            except OSError as e:
+                logging.error(f"Metrics file {path} could not be written: {e}")
+            if stopped:
+                return
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def start_exporters(stop_event):
+    """
+    Start the configured HTTP endpoint and metrics file, nothing is started when METRICS_ENABLED is False
+    :param stop_event: threading.Event that stops the metrics file thread
+    :return:
+    """
+    if not METRICS_ENABLED:
+        return
+    if METRICS_HTTP_PORT:
+        try:
+            start_http_server(METRICS_HTTP_PORT, METRICS_HTTP_HOST)
+            logging.info(f"Metrics at http://{METRICS_HTTP_HOST}:{METRICS_HTTP_PORT}/metrics")
+        except OSError as e:
+            logging.error(f"Metrics endpoint could not be started: {e}")
+    if METRICS_FILE:
+        start_metrics_file(stop_event, METRICS_FILE, METRICS_FILE_INTERVAL)
@@ -3,23 +3,199 @@
 # Licensed under the MIT License. See LICENSE file in the project root for details.
 # ===========================================================================================
 import datetime
+import logging
+import socket
 import threading
 import serial
 import os
 import time
+import math
+import queue
+import multiprocessing
+import numpy as np
 import Data_Calculation_Module
+import Instrument_Driver_Module
+import Metrics_Module
+import Calculation_Worker_Module
+import Ingest_Module
+import Replay_Module
 
-data_dic = {}
-data_lock = threading.Lock()  # Lock of data_dic
 stop_event = threading.Event()  # Events that control thread stopping
+# Calculate the flux of every averaging period online from the written samples, False queues the raw file for
+# the calculation worker process after each period (see Calculation_Worker_Module)
+ONLINE_FLUX_CALCULATION = True
+calculation_queue_dir = Calculation_Worker_Module.CALCULATION_QUEUE_DIR  # Jobs of the worker, a replay has its own
+# Result folder of the online calculation with the planar fit, lag history and spectra of the site,
+# Data_Calculation_Module.ec_flux_dir if None, a replay has its own
+result_dir = None
+flux_accumulator = Data_Calculation_Module.FluxAccumulator()
+# Also calculate the flux of the trailing averaging period every Data_Calculation_Module.ROLLING_FLUX_STEP
+# (e.g. for leak detection), saved in the rolling folder of result_dir (Data_Calculation_Module.rolling_flux_dir)
+ROLLING_FLUX_CALCULATION = False
+rolling_accumulator = None
+# Raw data file format, "txt" for text lines or "bin" for fixed size binary records
+RAW_FILE_FORMAT = "txt"
+BINARY_FLOAT_DTYPE = '<f8'  # '<f8' or '<f4' for the binary value columns
+# Raw data file buffering, at most WRITER_FLUSH_INTERVAL seconds of samples are lost on a crash
+WRITER_FLUSH_INTERVAL = 5  # unit:s
+WRITER_BUFFER_SIZE = 64 * 1024  # unit:bytes
+# Sampler, one row every 1 / SAMPLING_FREQUENCY s on monotonic deadlines aligned to the wall clock frames
+SAMPLING_FREQUENCY = Data_Calculation_Module.SAMPLING_FREQUENCY  # unit:Hz
+STALE_AGE = 0.5  # unit:s, a frame older than this at the tick is flagged as stale
+CLOCK_RESYNC_THRESHOLD = 1.0  # unit:s, re-align the ticks when the wall clock has moved further than this
+FRAME_FRESH, FRAME_DUPLICATE, FRAME_STALE = 0, 1, 2  # Per-instrument row flags
+sampler_stats = {"ticks": 0, "missed_ticks": 0}
+# Frames are split by the delimiters of their driver and queued with their receive time between reader and parser
+FRAME_QUEUE_SIZE = 256  # Frames per instrument, the oldest frame is dropped when the parser falls behind
+MAX_FRAME_SIZE = 1024  # unit:bytes, longer garbage without a delimiter is discarded
+RING_BUFFER_SIZE = 4096  # Parsed frames kept per instrument, 400 s at 10 Hz
+# Stream the samples to an ingest server (see Ingest_Module), spooled in Ingest_Module.SPOOL_DIR while the
+# link is down. "" keeps the logger standalone.
+INGEST_SERVER = ""  # host:port, e.g. "flux-server.local:9200"
+INGEST_SITE = socket.gethostname()  # Site name on the server
+ingest_client = None
+# Record the raw bytes of every instrument to <instrument>_<start>.cap files in this folder, they can be
+# replayed byte for byte with Replay_Module. "" records nothing.
+SERIAL_CAPTURE_DIR = ""
 # =======================================================================
 # Initialise the serial port
 # =======================================================================
-ser_wind = 0
-ser_ht8x00 = 0
-class softuart(threading.Thread):
-    global data_dic
+# Instruments, their drivers and ports come from Instrument_Driver_Module.INSTRUMENT_CONFIG_FILE,
+# the per-instrument state below is built by configure_instruments
+instruments = []
+instrument_drivers = {}
+instrument_fields = {}  # Instrument name: (column prefix, field names)
+frame_queues = {}
+frame_stats = {}
+instrument_buffers = {}
+raw_data_columns = Data_Calculation_Module.RAW_DATA_COLUMNS
+binary_record_dtype = Data_Calculation_Module.binary_record_dtype(raw_data_columns, BINARY_FLOAT_DTYPE)
+
+
+class SystemClock:
+    """Time source of the readers, the sampler and the raw files. Replay_Module swaps in a VirtualClock."""
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def time(self):
+        return time.time()
+
+    def now(self):
+        return datetime.datetime.now()
 
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+clock = SystemClock()
+
+
+def open_capture(uart_name):
+    """
+    :param uart_name:
+    :return: Replay_Module.SerialCapture of the instrument, None if SERIAL_CAPTURE_DIR is not set
+    """
+    return Replay_Module.SerialCapture(SERIAL_CAPTURE_DIR, uart_name) if SERIAL_CAPTURE_DIR else None
+
+
+class FrameSplitter:
+    """Splits a byte stream into frames ending with end_byte, and starting with start_byte if one is given"""
+
+    def __init__(self, start_byte, end_byte, max_frame_size=MAX_FRAME_SIZE):
+        self._start_byte = start_byte
+        self._end_byte = end_byte
+        self._max_frame_size = max_frame_size
+        self._buffer = bytearray()
+
+    def feed(self, chunk):
+        """
+        Add received bytes
+        :param chunk: bytes
+        :return: list of complete frames
+        """
+        buffer = self._buffer
+        buffer += chunk
+        frames = []
+        while buffer:
+            if self._start_byte is not None:
+                # Bytes outside a start/end pair (e.g. checksums) are skipped
+                start = buffer.find(self._start_byte)
+                if start < 0:
+                    buffer.clear()
+                    break
+                del buffer[:start]
+            end = buffer.find(self._end_byte, 1 if self._start_byte is not None else 0)
+            if end < 0:
+                break
+            if self._start_byte is not None:
+                # A frame cut off by a new start byte is dropped
+                restart = buffer.rfind(self._start_byte, 1, end)
+                if restart > 0:
+                    del buffer[:restart]
+                    end -= restart
+            frames.append(bytes(buffer[:end + 1]))
+            del buffer[:end + 1]
+        if len(buffer) > self._max_frame_size:
+            buffer.clear()
+        return frames
+
+
+def enqueue_frame(uart_name, frame, received):
+    """
+    Put a frame on the queue of its instrument, dropping the oldest frame when the queue is full
+    :param uart_name:
+    :param frame: bytes
+    :param received: monotonic receive time
+    :return:
+    """
+    frame_queue = frame_queues[uart_name]
+    frame_stats[uart_name]["frames"] += 1
+    while True:
+        try:
+            frame_queue.put_nowait((received, frame))
+            return
+        except queue.Full:
+            try:
+                frame_queue.get_nowait()
+                frame_stats[uart_name]["dropped"] += 1
+            except queue.Empty:
+                pass
+
+
+class SerialFrameReader(threading.Thread):
+    """Reads whatever is waiting on a pyserial port, splits it into frames and queues them"""
+
+    def __init__(self, uart_name, ser):
+        threading.Thread.__init__(self)
+        self._uart_name = uart_name
+        self._ser = ser
+        driver = instrument_drivers[uart_name]
+        self._splitter = FrameSplitter(driver.start_byte, driver.end_byte)
+
+    def run(self):
+        capture = open_capture(self._uart_name)
+        while not stop_event.is_set():
+            try:
+                # Blocks for at most the port timeout when nothing is waiting
+                chunk = self._ser.read(self._ser.in_waiting or 1)
+            except serial.SerialException as e:
+                print(f"Serial port read error on {self._uart_name}: {e}")
+                time.sleep(1)
+                continue
+            if not chunk:
+                continue
+            received = clock.monotonic()
+            Metrics_Module.increment("serial_bytes_read_total", len(chunk), instrument=self._uart_name)
+            if capture is not None:
+                capture.write(clock.time(), chunk)
+            for frame in self._splitter.feed(chunk):
+                enqueue_frame(self._uart_name, frame, received)
+        if capture is not None:
+            capture.close()
+
+
+class softuart(threading.Thread):
     """soft uart(ttl) based on pigpio wiht Rx & Tx GPIO need to be set"""
 
     def __init__(self, uart_name, rxPin, txPin, baud=9600, timeout=5):
@@ -39,14 +215,19 @@ class softuart(threading.Thread):
 
     def run(self):
         self.flushInput()
-        send_cnt = 0
-        while True:
+        driver = instrument_drivers[self._uart_name]
+        splitter = FrameSplitter(driver.start_byte, driver.end_byte)
+        capture = open_capture(self._uart_name)
+        while not stop_event.is_set():
             buf = self.read()  # Block and receive data until one frame of data is received
-
-            if self._uart_name == "ser_ht8x00":
-                process_ht8x00_data(buf)
-            elif self._uart_name == "ser_wind":
-                process_wind_data(buf)
+            received = clock.monotonic()
+            Metrics_Module.increment("serial_bytes_read_total", len(buf), instrument=self._uart_name)
+            if capture is not None and buf:
+                capture.write(clock.time(), buf)
+            for frame in splitter.feed(buf):
+                enqueue_frame(self._uart_name, frame, received)
+        if capture is not None:
+            capture.close()
 
     def flushInput(self):
         # fatal exceptions off (so that closing an unopened gpio doesn't error)
@@ -62,7 +243,7 @@ class softuart(threading.Thread):
         count = 0
         text = []
         lt = 0
-        while lt == 0:
+        while lt == 0 and not stop_event.is_set():
 
             time.sleep(0.01)
             (count, data) = self._pi.bb_serial_read(self._rxPin)
@@ -83,148 +264,264 @@ class softuart(threading.Thread):
         return bytes(text)
 
 
-def get_ht8x00_data():
+class InstrumentRingBuffer:
+    """
+    Preallocated ring buffer of every parsed frame of one instrument, column 0 is the monotonic receive time.
+    There is one writer (the parser thread of the instrument). Readers never block it: they copy the rows
+    and retry if the writer has wrapped around into the copied rows in the meantime.
+    """
+
+    def __init__(self, fields, size=RING_BUFFER_SIZE):
+        self.fields = list(fields)
+        self._size = size
+        self._rows = np.full((size, len(self.fields) + 1), np.nan)
+        self.count = 0  # Frames written so far, also the number of the latest frame
+
+    def append(self, received, values):
+        """
+        Store one parsed frame
+        :param received: monotonic receive time
+        :param values: one value per field
+        :return:
+        """
+        row = self._rows[self.count % self._size]
+        row[0] = received
+        row[1:] = values
+        # Publishing the new count makes the row visible to readers
+        self.count += 1
+
+    def latest(self):
+        """
+        Latest frame
+        :return: (frame number, receive time, values) or None before the first frame
+        """
+        while True:
+            count = self.count
+            if count == 0:
+                return None
+            row = self._rows[(count - 1) % self._size].copy()
+            # The row is intact unless the writer has since reached it again (including a write in progress)
+            if self.count - count < self._size - 1:
+                return count, row[0], row[1:]
+
+    def window(self, start_time, end_time=None):
+        """
+        Buffered frames received in (start_time, end_time], e.g. all frames of one sampling interval for
+        block-averaging or oversampling
+        :param start_time: monotonic time
+        :param end_time: monotonic time, no upper limit by default
+        :return: array of rows (receive time, values...) in receive order
+        """
+        while True:
+            count = self.count
+            # The oldest slot is left out, it is the next one the writer overwrites
+            first = count - min(count, self._size - 1)
+            rows = self._rows[np.arange(first, count) % self._size]
+            # Same check as latest: the rows are intact unless the writer has since reached the first one again
+            if self.count - first < self._size:
+                received = rows[:, 0]
+                selected = received > start_time
+                if end_time is not None:
+                    selected &= received <= end_time
+                return rows[selected]
+
+
+def configure_instruments(instrument_config):
     """
-    Obtain HT8x00 data
+    Build the per-instrument drivers, queues, ring buffers and raw data columns
+    :param instrument_config: list from Instrument_Driver_Module.load_instrument_config
     :return:
     """
-    global data_dic
-    try:
-        buffer = b''
-        while not stop_event.is_set():
-            byte = ser_ht8x00.read(1)
-            if byte:
-                buffer += byte
-                if byte == b'\r':
-                    process_ht8x00_data(buffer)
-                    buffer = b''
-                    return data_dic["HT8x00"]
-    except Exception as e:
-        print(f"An exception occurred while processing HT8x00 data.: {e}")
-
-def get_wind_data():
+    global instruments, instrument_drivers, instrument_fields, frame_queues, frame_stats, instrument_buffers
+    global raw_data_columns, binary_record_dtype, flux_accumulator, rolling_accumulator
+    instruments = instrument_config
+    instrument_drivers = {instrument["name"]: instrument["driver"] for instrument in instruments}
+    instrument_fields = {name: (name.lower(), driver.fields) for name, driver in instrument_drivers.items()}
+    frame_queues = {name: queue.Queue(FRAME_QUEUE_SIZE) for name in instrument_drivers}
+    frame_stats = {name: {"frames": 0, "dropped": 0, "invalid": 0} for name in instrument_drivers}
+    instrument_buffers = {name: InstrumentRingBuffer(driver.fields) for name, driver in instrument_drivers.items()}
+    # Values of all instruments first, then the age and flag of every instrument
+    raw_data_columns = [field for _, fields in instrument_fields.values() for field in fields]
+    raw_data_columns += [f"{prefix}_{suffix}" for prefix, _ in instrument_fields.values() for suffix in ("age", "flag")]
+    binary_record_dtype = Data_Calculation_Module.binary_record_dtype(raw_data_columns, BINARY_FLOAT_DTYPE)
+    # Fluxes of every configured scalar that the instruments deliver
+    scalar_settings = [setting for setting in Data_Calculation_Module.SCALARS if setting['column'] in raw_data_columns]
+    flux_accumulator = Data_Calculation_Module.FluxAccumulator(scalar_settings=scalar_settings, output_dir=result_dir)
+    if ROLLING_FLUX_CALCULATION:
+        rolling_accumulator = Data_Calculation_Module.RollingFluxAccumulator(scalar_settings=scalar_settings,
+                                                                             output_dir=result_dir)
+
+
+configure_instruments(Instrument_Driver_Module.load_instrument_config())
+
+
+@Metrics_Module.register_collector
+def logger_metrics():
     """
-    Obtain anemometer data
+    Sampler and per-instrument frame counters for the metrics endpoint, read when the metrics are rendered
+    :return: list of (name, type, labels, value)
+    """
+    metrics = [(f"sampler_{name}_total", "counter", {}, value) for name, value in sampler_stats.items()]
+    for name, stats in frame_stats.items():
+        metrics.append(("frames_received_total", "counter", {"instrument": name}, stats["frames"]))
+        metrics.append(("frames_dropped_total", "counter", {"instrument": name}, stats["dropped"]))
+        metrics.append(("frames_invalid_total", "counter", {"instrument": name}, stats["invalid"]))
+        metrics.append(("frames_parsed_total", "counter", {"instrument": name}, instrument_buffers[name].count))
+        metrics.append(("frame_queue_length", "gauge", {"instrument": name}, frame_queues[name].qsize()))
+    metrics.append(("calculation_jobs_pending", "gauge", {},
+                    len(Calculation_Worker_Module.pending_jobs(calculation_queue_dir))))
+    return metrics
+
+
+def process_frame(uart_name, data, received=None):
+    """
+    Parse a received frame with the driver of its instrument and store it in the ring buffer
+    :param uart_name: instrument name
+    :param data: frame bytes
+    :param received: monotonic receive time of the frame, now by default
     :return:
     """
-    global data_dic
-    try:
-        buffer = b''
-        while not stop_event.is_set():
-            byte = ser_wind.read(1)
-            if byte == b'\x02':
-                buffer = byte
-                continue
+    values = instrument_drivers[uart_name].parse(data)
+    if values is None:
+        frame_stats[uart_name]["invalid"] += 1
+        return
+    instrument_buffers[uart_name].append(clock.monotonic() if received is None else received, values)
 
-            buffer += byte
 
-            if byte == b'\x03':
-                process_wind_data(buffer)
-                buffer = ""
-                return data_dic['wind']
-    except serial.SerialException as e:
-        print(f"Serial port read error: {e}")
-    except Exception as e:
-        print(f"An exception occurred while retrieving anemometer data: {e}")
-    return None
-
-def process_ht8x00_data(data):
+def parse_frames(uart_name):
     """
-    Process the received frame of HT8X00 data
-    :param data:
+    Frame parser thread, processes the queued frames of one instrument
+    :param uart_name:
     :return:
     """
-    global data_dic
-    try:
-        data_str = data.decode('utf-8').strip()
-        # print("A frame of data received is", data_str)
-        parts = data_str.split(',')
-        if len(parts) >= 19 :
-            nh3_data = float(parts[2].strip())
-            ambient_temperature = float(parts[7].strip())
-            transmittance = float(parts[9].strip())
-            with data_lock:
-                data_dic["HT8x00"] = {
-                    "real_time_concentration": nh3_data,
-                    "ambient_temperature": ambient_temperature,
-                    "transmittance": transmittance
-                }
-    except Exception as e:
-        print(f"Error while processing ht8x00 frame data: {e}")
-
-
-
-def process_wind_data(data):
+    frame_queue = frame_queues[uart_name]
+    while not stop_event.is_set():
+        try:
+            received, frame = frame_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        process_frame(uart_name, frame, received)
+
+
+def open_instrument_readers():
     """
-    Process the received frame of anemometer data
-    :param data:
+    Open the configured instruments, a pyserial reader for a "port" and a pigpio softuart for "rx_pin"/"tx_pin"
+    :return: list of reader threads, not started
+    """
+    readers = []
+    for instrument in instruments:
+        if "port" in instrument:
+            ser = serial.Serial(instrument["port"], instrument.get("baudrate", 38400), timeout=0.1)
+            readers.append(SerialFrameReader(instrument["name"], ser))
+        else:
+            global pigpio
+            import pigpio
+            readers.append(softuart(instrument["name"], instrument["rx_pin"], instrument["tx_pin"],
+                                    instrument.get("baudrate", 38400)))
+    return readers
+
+
+def read_data(readers):
+    """
+    Data reading thread function, runs one frame reader and one frame parser per instrument
+    :param readers: reader threads from open_instrument_readers
     :return:
     """
-    global data_dic
-    try:
-        data_str = data[1:-1].decode('utf-8').strip()
-
-        parts = data_str.split(',')
-        if len(parts) >= 8 :
-            u_axis_speed = float(parts[1].strip())
-            v_axis_speed = float(parts[2].strip())
-            w_axis_speed = float(parts[3].strip())
-            sonic_temp = float(parts[6].strip())
-            with data_lock:
-                data_dic["wind"] = {
-                    "u_axis_speed": u_axis_speed,
-                    "v_axis_speed": v_axis_speed,
-                    "w_axis_speed": w_axis_speed,
-                    "sonic_temp": sonic_temp
-                }
+    for reader in readers:
+        reader.start()
+    parsers = [threading.Thread(target=parse_frames, args=(name,)) for name in frame_queues]
+    for parser in parsers:
+        parser.start()
+    for thread in readers + parsers:
+        thread.join()
+
+def sample_instruments(timestamp, tick_time, last_frames):
+    """
+    Build the combined row of one tick from the latest frame of every instrument
+    :param timestamp: row TIMESTAMP
+    :param tick_time: monotonic time of the tick
+    :param last_frames: frame number of every instrument at the previous tick, updated in place
+    :return: combined data dict with the values, <prefix>_age (s) and <prefix>_flag per instrument
+    """
+    combined_data = {"time": timestamp}
+    for name, (prefix, fields) in instrument_fields.items():
+        latest = instrument_buffers[name].latest()
+        if latest is None:
+            combined_data.update({field: None for field in fields})
+            combined_data[f"{prefix}_age"] = None
+            combined_data[f"{prefix}_flag"] = FRAME_STALE
+            continue
+        frame, received, values = latest
+        combined_data.update(zip(fields, values.tolist()))
+        age = tick_time - float(received)
+        if age > STALE_AGE:
+            flag = FRAME_STALE
+        elif frame == last_frames.get(name):
+            flag = FRAME_DUPLICATE
         else:
-            print("The data format is incorrect or required fields are missing")
-            return None
-    except Exception as e:
-        print(f"An error occurred while processing ultrasonic anemometer data: {e}")
-        return None
-
-def read_data():
-    """Data reading thread function, the main thread is responsible for this task"""
-    while not stop_event.is_set():
-        get_ht8x00_data()
-        get_wind_data()
-        time.sleep(0.01)
+            flag = FRAME_FRESH
+        last_frames[name] = frame
+        combined_data[f"{prefix}_age"] = round(max(age, 0.0), 3)
+        combined_data[f"{prefix}_flag"] = flag
+    return combined_data
+
 
 def write_data():
     """
-    Write Thread
+    Write Thread, emits exactly SAMPLING_FREQUENCY rows per second on clock.monotonic() deadlines.
+    Ticks are aligned to the wall clock frames (.00, .10, ...) and stamped with the frame time. When the
+    thread wakes up late, the overdue ticks are still written (flagged as duplicates) and counted as missed.
     :return:
     """
 
     global last_file_time, current_file
-    last_timestamp = None  # Used to store the previous timestamp
+    period = 1 / SAMPLING_FREQUENCY
+    last_frames = {}
+    anchor_frame = None
     while not stop_event.is_set():
-        # Reduce cpu usage
-        time.sleep(0.01)
-        # Get milliseconds
-        now = datetime.datetime.now()
-        timestamp = now.strftime("%Y-%m-%d %H:%M:%S.%f")[:-4]
-        current_centisecond = now.strftime("%f")[:1]
-        # Creating a Merge Data Dictionary
-        if last_timestamp is None or current_centisecond != last_timestamp:
-            with data_lock:
-
-                combined_data = {
-                    "time": timestamp,
-                    "real_time_concentration": data_dic.get("HT8x00", {}).get("real_time_concentration", None),
-                    "ambient_temperature": data_dic.get("HT8x00", {}).get("ambient_temperature", None),
-                    "transmittance": data_dic.get("HT8x00", {}).get("transmittance", None),
-                    "u_axis_speed": data_dic.get("wind", {}).get("u_axis_speed", None),
-                    "v_axis_speed": data_dic.get("wind", {}).get("v_axis_speed", None),
-                    "w_axis_speed": data_dic.get("wind", {}).get("w_axis_speed", None),
-                    "sonic_temp": data_dic.get("wind", {}).get("sonic_temp", None)
-                }
+        if anchor_frame is None:
+            # Align the first tick with the next wall clock frame boundary
+            wall_time = clock.time()
+            anchor_frame = math.floor(wall_time * SAMPLING_FREQUENCY) + 1
+            anchor_monotonic = clock.monotonic() + anchor_frame / SAMPLING_FREQUENCY - wall_time
+            tick = 0
+
+        deadline = anchor_monotonic + tick * period
+        delay = deadline - clock.monotonic()
+        if delay > 0:
+            clock.sleep(delay)
+        now = clock.monotonic()
+        Metrics_Module.observe("sampler_tick_lateness_seconds", max(now - deadline, 0.0))
+        # Rounding of a virtual clock can wake up a hair before the deadline
+        overdue = max(int((now - deadline) // period), 0)
+        if overdue > 0:
+            sampler_stats["missed_ticks"] += overdue
+
+        for _ in range(overdue + 1):
+            frame_time = (anchor_frame + tick) / SAMPLING_FREQUENCY
+            timestamp = datetime.datetime.fromtimestamp(frame_time).strftime("%Y-%m-%d %H:%M:%S.%f")[:-4]
+            combined_data = sample_instruments(timestamp, now, last_frames)
             # Save data to local
             save_data_to_local(combined_data)
-
-            # Update last_timestamp
-            last_timestamp = current_centisecond
+            if ONLINE_FLUX_CALCULATION:
+                flux_accumulator.add_sample(combined_data)
+            if rolling_accumulator is not None:
+                for rolling_result in rolling_accumulator.add_sample(combined_data):
+                    save_rolling_flux(rolling_result)
+            if ingest_client is not None:
+                ingest_client.add_sample(combined_data)
+            sampler_stats["ticks"] += 1
+            tick += 1
+        raw_writer.flush_if_due()
+        Metrics_Module.observe("sampler_tick_work_seconds", clock.monotonic() - now)
+
+        # Follow wall clock steps (NTP, manual changes) instead of drifting away from them
+        clock_offset = (clock.time() - clock.monotonic()) - (anchor_frame / SAMPLING_FREQUENCY - anchor_monotonic)
+        if abs(clock_offset) > CLOCK_RESYNC_THRESHOLD:
+            logging.warning(f"Wall clock moved by {clock_offset:+.3f} s, re-aligning the sampler")
+            Metrics_Module.increment("clock_realign_total")
+            anchor_frame = None
+    raw_writer.close()
 
 
 def sanitize_data(data):
@@ -238,6 +535,103 @@ def sanitize_data(data):
             data[key] = data[key].replace('\n', '').replace('\r', '')
     return data
 
+class RawDataWriter:
+    """
+    Keeps the raw data file of the current averaging period open and writes the samples in batches.
+    The buffer is written out when it reaches buffer_size bytes or, checked by flush_if_due on every tick of
+    the write thread, when the oldest sample in it is flush_interval seconds old, and synced to disk, so a
+    crash loses at most flush_interval seconds.
+    """
+
+    def __init__(self, flush_interval=WRITER_FLUSH_INTERVAL, buffer_size=WRITER_BUFFER_SIZE):
+        self._flush_interval = flush_interval
+        self._buffer_size = buffer_size
+        self._file = None
+        self._binary = False
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._first_buffered = None
+
+    def open(self, current_file):
+        """
+        Close the current file and continue in current_file, the header is written if the file is new
+        :param current_file:
+        :return:
+        """
+        self.close()
+        self._binary = current_file.endswith(Data_Calculation_Module.BINARY_FILE_EXTENSION)
+        file_exists = os.path.isfile(current_file)
+        self._file = open(current_file, 'ab')
+        if not file_exists:
+            if self._binary:
+                header = Data_Calculation_Module.binary_file_header(
+                    raw_data_columns, Data_Calculation_Module.SAMPLING_FREQUENCY, BINARY_FLOAT_DTYPE)
+            else:
+                header = ",".join(["TIMESTAMP"] + raw_data_columns).encode('utf-8') + b"\n"
+            self._file.write(header)
+            self._file.flush()
+
+    def write(self, data):
+        """
+        Add one combined sample to the buffer
+        :param data:
+        :return:
+        """
+        if self._binary:
+            record = Data_Calculation_Module.encode_binary_record(data, binary_record_dtype)
+        else:
+            values = [data['time']] + [f"{data[column]}" for column in raw_data_columns]
+            record = (",".join(values) + "\n").encode('utf-8')
+        if not self._buffer:
+            self._first_buffered = clock.monotonic()
+        self._buffer.append(record)
+        self._buffered_bytes += len(record)
+        if self._buffered_bytes >= self._buffer_size:
+            self.flush()
+
+    def flush_if_due(self):
+        """Flush when the oldest buffered sample is flush_interval seconds old"""
+        if self._buffer and clock.monotonic() - self._first_buffered >= self._flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered samples and sync them to disk"""
+        if self._file is None or not self._buffer:
+            return
+        with Metrics_Module.timer("raw_flush_seconds"):
+            self._file.write(b"".join(self._buffer))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        Metrics_Module.increment("raw_bytes_written_total", self._buffered_bytes)
+        Metrics_Module.increment("raw_flushes_total")
+        self._buffer = []
+        self._buffered_bytes = 0
+
+    def close(self):
+        """Flush and close the current file"""
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+
+
+raw_writer = RawDataWriter()
+
+
+def save_rolling_flux(rolling_result):
+    """
+    Save a rolling window result in a thread, the planar fit only takes the averaging periods
+    :param rolling_result: (result_data, cross_cov_results) from RollingFluxAccumulator.add_sample
+    :return:
+    """
+    rolling_dir = Data_Calculation_Module.rolling_flux_dir
+    if result_dir is not None:
+        rolling_dir = os.path.join(result_dir, "rolling")
+    threading.Thread(target=Data_Calculation_Module.save_flux_results, args=rolling_result,
+                     kwargs={"output_dir": rolling_dir, "update_fit": False,
+                             "period": Data_Calculation_Module.ROLLING_FLUX_STEP}).start()
+
+
 def save_data_to_local(data):
     """
     Save data to local
@@ -245,37 +639,44 @@ def save_data_to_local(data):
     :return:
     """
     global last_file_time, current_file,output_filename
+    started = time.perf_counter()
     data = sanitize_data(data)
     # try:
     #     print((datetime.datetime.now() - last_file_time).total_seconds() )
     # except:
     #     pass
     # time_inserval =(datetime.datetime.now() - last_file_time).total_seconds()
+    extension = Data_Calculation_Module.BINARY_FILE_EXTENSION if RAW_FILE_FORMAT == "bin" else ".txt"
+    # The file of a sample follows its frame time, a tick written late still goes to the period it belongs to
+    frame_time = datetime.datetime.strptime(data['time'], Data_Calculation_Module.TIMESTAMP_FORMAT)
     if last_file_time is None :
-        last_file_time = datetime.datetime.now()
-        output_filename = f"{last_file_time.strftime('%Y%m%d_%H%M')}.txt"
+        last_file_time = frame_time
+        output_filename = f"{last_file_time.strftime('%Y%m%d_%H%M')}{extension}"
         current_file = os.path.join(file_path, output_filename)
+        raw_writer.open(current_file)
 
     # elif (datetime.datetime.now().minute ==0 or datetime.datetime.now().minute ==30 ):
-    elif (datetime.datetime.now().minute%30==0):
-        if output_filename !=f"{datetime.datetime.now().strftime('%Y%m%d_%H%M')}.txt":
-
-            cal_flux = threading.Thread(target=Data_Calculation_Module.run_data_calculation, args=(output_filename,))
-            cal_flux.start()
-            last_file_time = datetime.datetime.now()
-            output_filename = f"{last_file_time.strftime('%Y%m%d_%H%M')}.txt"
+    else:
+        period = Data_Calculation_Module.period_start(frame_time)
+        if period > Data_Calculation_Module.period_start(last_file_time):
+
+            # Close the finished file before it is handed to the calculation
+            new_filename = f"{period.strftime('%Y%m%d_%H%M')}{extension}"
+            raw_writer.open(os.path.join(file_path, new_filename))
+            if ONLINE_FLUX_CALCULATION:
+                flux_result = flux_accumulator.finish()
+                if flux_result is not None:
+                    cal_flux = threading.Thread(target=Data_Calculation_Module.save_flux_results, args=flux_result,
+                                                kwargs={"output_dir": result_dir})
+                    cal_flux.start()
+            else:
+                Calculation_Worker_Module.submit_job(os.path.join(file_path, output_filename), calculation_queue_dir)
+            last_file_time = frame_time
+            output_filename = new_filename
             current_file = os.path.join(file_path, output_filename)
 
-    file_exists = os.path.isfile(current_file)
-
-    with open(current_file, 'a', encoding='utf-8') as file:
-        if not file_exists:
-            header_line = "TIMESTAMP,real_time_concentration,ambient_temperature,transmittance,u_axis_speed,v_axis_speed,w_axis_speed,sonic_temp\n"
-            file.write(header_line)
-        data_line = f"{data['time']},{data['real_time_concentration']},{data['ambient_temperature']},{data['transmittance']},{data['u_axis_speed']},{data['v_axis_speed']},{data['w_axis_speed']},{data['sonic_temp']}\n"
-        file.write(data_line)
-        # print("Write data successfully")
-        file.flush()
+    raw_writer.write(data)
+    Metrics_Module.observe("save_data_seconds", time.perf_counter() - started)
 
 
 if __name__ == "__main__":
@@ -287,31 +688,43 @@ if __name__ == "__main__":
     file_path = './OpenFLux_data'
     if not os.path.exists(file_path):
         os.makedirs(file_path)
+    Data_Calculation_Module.configure_logging()
+    Data_Calculation_Module.configure_paths()
 
     last_file_time = None
     current_file = None
 
+    # Calculation worker process, started before any thread. Jobs left over from the last run and
+    # recent periods without a result (e.g. the half hour cut short by a crash) are calculated first.
+    worker_stop_event = multiprocessing.Event()
+    calculation_worker = Calculation_Worker_Module.start_worker(worker_stop_event, calculation_queue_dir)
+    recovered = Calculation_Worker_Module.recover_missing_periods(file_path, queue_dir=calculation_queue_dir)
+    if recovered:
+        print(f"Queued {len(recovered)} raw files without results for calculation")
+
+    # Metrics endpoint and / or metrics file, see Metrics_Module
+    Metrics_Module.start_exporters(stop_event)
+
+    if INGEST_SERVER:
+        ingest_host, ingest_port = INGEST_SERVER.rsplit(":", 1)
+        ingest_client = Ingest_Module.IngestClient(ingest_host, int(ingest_port), INGEST_SITE, raw_data_columns,
+                                                   SAMPLING_FREQUENCY, float_dtype=BINARY_FLOAT_DTYPE)
+        ingest_client.start()
+        print(f"Streaming to the ingest server {INGEST_SERVER} as {INGEST_SITE}")
+
     # =======================================================================
-    # Created folder
+    # Open the instruments
     # =======================================================================
-    sys = "Windows" # Raspberry ; Windows ;
     try:
-        print(f"The program running system is {sys}")
-        if sys == "Windows":
-            # Start the data reading thread
-            read_thread = threading.Thread(target=read_data)
-            read_thread.start()
-        elif sys == "Raspberry":
-            # Start the data reading thread
-            import RPi.GPIO as GPIO
-            import pigpio
-            ser_ht8x00 = softuart('ser_ht8x00', 19, 26, 38400)
-            ser_ht8x00.start()
-            ser_wind = softuart('ser_wind', 25, 8, 38400)
-            ser_wind.start()
-
-            print("Serial port initialisation complete, connecting...")
-        while not data_dic:
+        for instrument in instruments:
+            print(f"{instrument['name']}: driver {instrument['driver'].name}, "
+                  f"{instrument.get('port') or 'GPIO ' + str(instrument.get('rx_pin'))}")
+        # Start the data reading thread
+        read_thread = threading.Thread(target=read_data, args=(open_instrument_readers(),))
+        read_thread.start()
+
+        print("Serial port initialisation complete, connecting...")
+        while not any(buffer.count for buffer in instrument_buffers.values()):
             time.sleep(0.1)
 
         # Start the data saving thread
@@ -326,4 +739,7 @@ if __name__ == "__main__":
         stop_event.set()
         read_thread.join()  # Wait for the read thread to stop
         write_thread.join()  # Wait for the write thread to stop
+        Calculation_Worker_Module.stop_worker(calculation_worker, worker_stop_event)
+        if ingest_client is not None:
+            ingest_client.stop()
         print("The programme has been safely exited.")
\ No newline at end of file
@@ -0,0 +1,463 @@
+# ===========================================================================================
+# Copyright (c)  2024 HealthyPhoton Technology. All rights reserved.
+# Licensed under the MIT License. See LICENSE file in the project root for details.
+# ===========================================================================================
+import argparse
+import datetime
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import struct
+import threading
+import time
+
+import numpy as np
+
+import Data_Calculation_Module
+import Metrics_Module
+
+REPLAY_DATA_DIR = "./replay_data"  # Raw data files written by a replay
+REPLAY_RESULT_DIR = "./replay_flux"  # Results of a replay
+CAPTURE_FILE_MAGIC = b'OFLXCAP1'
+CAPTURE_EXTENSION = '.cap'
+CAPTURE_RECORD = struct.Struct('<dI')  # Wall time of the read unit:s and length of the chunk unit:bytes
+REPLAY_TIME_TOLERANCE = 1e-6  # A chunk this close after a tick still belongs to it unit:s
+REPLAY_POLL_INTERVAL = 0.1  # Longest real time a throttled reader sleeps at once unit:s
+DUPLICATE_RECEIVE_TOLERANCE = 0.002  # Rows whose frames were received this close together show the same frame unit:s
+
+
+class VirtualClock:
+    """
+    Clock of a replay with the interface of OpenFlux.SystemClock, starting at a recorded wall time.
+    With speed > 0 it runs speed times faster than real time. With speed 0 it only moves when the sampler
+    sleeps: it jumps to the end of the sleep at once and then runs the advance hooks, which deliver the
+    recorded bytes that are due, so an unthrottled replay is deterministic.
+    """
+
+    def __init__(self, start, speed=0.0):
+        """
+        :param start: wall time the clock starts at unit:s since 1970
+        :param speed: 1 for real time, 100 for 100 times faster, 0 for unthrottled
+        """
+        self.start = start
+        self.speed = speed
+        self._elapsed = 0.0
+        self._started = time.monotonic()
+        self._advance_hooks = []
+
+    def add_advance_hook(self, hook):
+        """Call hook() after every sleep of an unthrottled clock"""
+        self._advance_hooks.append(hook)
+
+    def monotonic(self):
+        if self.speed:
+            return (time.monotonic() - self._started) * self.speed
+        return self._elapsed
+
+    def time(self):
+        return self.start + self.monotonic()
+
+    def now(self):
+        return datetime.datetime.fromtimestamp(self.time())
+
+    def sleep(self, seconds):
+        if seconds <= 0:
+            return
+        if self.speed:
+            time.sleep(seconds / self.speed)
+            return
+        self._elapsed += seconds
+        for hook in self._advance_hooks:
+            hook()
+
+    def step(self, seconds):
+        """Move the wall time but not the monotonic time, like an NTP step, the sampler re-aligns to it"""
+        self.start += seconds
+
+    def to_monotonic(self, wall_time):
+        """Monotonic time of this clock at a wall time"""
+        return wall_time - self.start
+
+
+class SerialCapture:
+    """
+    Raw bytes of one instrument as they were read from the port, for a byte for byte replay: the magic,
+    a uint32 header length, a JSON header and then one record per read (CAPTURE_RECORD and the bytes)
+    """
+
+    def __init__(self, capture_dir, instrument, started=None):
+        """
+        :param capture_dir:
+        :param instrument: instrument name
+        :param started: wall time of the capture unit:s, now by default
+        """
+        os.makedirs(capture_dir, exist_ok=True)
+        started = time.time() if started is None else started
+        file_name = f"{instrument}_{datetime.datetime.fromtimestamp(started):%Y%m%d_%H%M%S}{CAPTURE_EXTENSION}"
+        self.file_path = os.path.join(capture_dir, file_name)
+        self._file = open(self.file_path, 'ab')
+        if self._file.tell() == 0:
+            header = json.dumps({"instrument": instrument, "started": started}).encode('utf-8')
+            self._file.write(CAPTURE_FILE_MAGIC + struct.pack('<I', len(header)) + header)
+
+    def write(self, wall_time, chunk):
+        """
+        Append the bytes of one read
+        :param wall_time: unit:s since 1970
+        :param chunk: bytes
+        :return:
+        """
+        self._file.write(CAPTURE_RECORD.pack(wall_time, len(chunk)) + chunk)
+
+    def close(self):
+        self._file.close()
+
+
+def read_capture_header(file_path):
+    """
+    :param file_path: capture file
+    :return: (header dict with instrument and started, data offset)
+    """
+    with open(file_path, 'rb') as file:
+        if file.read(len(CAPTURE_FILE_MAGIC)) != CAPTURE_FILE_MAGIC:
+            raise ValueError(f"{file_path} is not an OpenFlux serial capture")
+        header_length = struct.unpack('<I', file.read(4))[0]
+        header = json.loads(file.read(header_length).decode('utf-8'))
+    return header, len(CAPTURE_FILE_MAGIC) + 4 + header_length
+
+
+def capture_chunks(file_path):
+    """
+    Chunks of a capture file in the order they were read, a record cut short by a crash is ignored
+    :param file_path:
+    :return: generator of (wall time, bytes)
+    """
+    _, offset = read_capture_header(file_path)
+    with open(file_path, 'rb') as file:
+        file.seek(offset)
+        while True:
+            record = file.read(CAPTURE_RECORD.size)
+            if len(record) < CAPTURE_RECORD.size:
+                return
+            wall_time, length = CAPTURE_RECORD.unpack(record)
+            chunk = file.read(length)
+            if len(chunk) < length:
+                return
+            yield wall_time, chunk
+
+
+def capture_sources(file_paths):
+    """
+    Group capture files by instrument
+    :param file_paths: capture files
+    :return: dict of instrument name to a generator of (wall time, bytes) over its files in time order
+    """
+    files = {}
+    for file_path in file_paths:
+        header, _ = read_capture_header(file_path)
+        files.setdefault(header["instrument"], []).append((header["started"], file_path))
+
+    def chunks(paths):
+        for _, file_path in sorted(paths):
+            yield from capture_chunks(file_path)
+
+    return {name: chunks(paths) for name, paths in files.items()}
+
+
+def _epoch_seconds(milliseconds):
+    """
+    Wall times of TIMESTAMP values, which are local times written as milliseconds since 1970-01-01
+    :param milliseconds: float64 array from Data_Calculation_Module.parse_timestamps
+    :return: float64 array of seconds since 1970 (UTC), with the UTC offset of the first valid value
+    """
+    valid = milliseconds[np.isfinite(milliseconds)]
+    if len(valid) == 0:
+        return milliseconds / 1000
+    local = datetime.datetime(1970, 1, 1) + datetime.timedelta(milliseconds=float(valid[0]))
+    return milliseconds / 1000 + (local.timestamp() - float(valid[0]) / 1000)
+
+
+def recorded_frames(file_paths, name, driver):
+    """
+    Frames of one instrument rebuilt from archived raw data files. A frame is taken as received <prefix>_age
+    before its row (at the row time in files without ages), and rows that show a frame again (duplicate or
+    stale) are left out, so the replayed sampler sees the frames when the live one did.
+    :param file_paths: text or binary raw data files in time order
+    :param name: instrument name, the age column is <lower case name>_age
+    :param driver: InstrumentDriver, its encode builds the frames
+    :return: generator of (wall time, frame bytes)
+    """
+    import pandas as pd
+    age_column = f"{name.lower()}_age"
+    last_received = -np.inf
+    for file_path in file_paths:
+        data = Data_Calculation_Module.read_raw_data(file_path)
+        missing = [field for field in driver.fields if field not in data.columns]
+        if missing:
+            raise ValueError(f"{file_path} has no {', '.join(missing)} column for {name}")
+        received = _epoch_seconds(Data_Calculation_Module.parse_timestamps(data['TIMESTAMP']))
+        if age_column in data.columns:
+            received = received - pd.to_numeric(data[age_column], errors='coerce').to_numpy(dtype=np.float64)
+        values = np.column_stack([pd.to_numeric(data[field], errors='coerce').to_numpy(dtype=np.float64)
+                                  for field in driver.fields])
+        valid = np.isfinite(received) & np.isfinite(values).all(axis=1)
+        received, values = received[valid], values[valid]
+        new_frame = np.diff(received, prepend=last_received) > DUPLICATE_RECEIVE_TOLERANCE
+        for wall_time, row in zip(received[new_frame].tolist(), values[new_frame].tolist()):
+            yield wall_time, driver.encode(row)
+        if len(received):
+            last_received = max(last_received, received[-1])
+
+
+def recorded_file_sources(file_paths, instrument_drivers):
+    """
+    :param file_paths: archived raw data files (OpenFLux_data), sorted by name which is their time order
+    :param instrument_drivers: dict of instrument name to InstrumentDriver
+    :return: dict of instrument name to a generator of (wall time, frame bytes)
+    """
+    file_paths = sorted(file_paths, key=os.path.basename)
+    return {name: recorded_frames(file_paths, name, driver) for name, driver in instrument_drivers.items()}
+
+
+class ReplayReader(threading.Thread):
+    """
+    Stands in for the serial reader of one instrument: the recorded chunks go through the FrameSplitter and
+    enqueue_frame of the logger when the virtual clock reaches their wall time
+    """
+
+    def __init__(self, logger, uart_name, chunks, clock):
+        """
+        :param logger: the OpenFlux module
+        :param uart_name: instrument name
+        :param chunks: iterable of (wall time, bytes) in time order
+        :param clock: VirtualClock
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self._logger = logger
+        self._uart_name = uart_name
+        self._chunks = iter(chunks)
+        self._clock = clock
+        driver = logger.instrument_drivers[uart_name]
+        self._splitter = logger.FrameSplitter(driver.start_byte, driver.end_byte)
+        self._next = next(self._chunks, None)
+        self.chunks = 0
+        self.last_time = None  # Wall time of the last chunk delivered
+
+    @property
+    def finished(self):
+        return self._next is None
+
+    def next_time(self):
+        """Wall time of the next chunk, None at the end"""
+        return None if self._next is None else self._next[0]
+
+    def deliver(self, until):
+        """
+        Feed every chunk recorded up to a wall time
+        :param until: unit:s since 1970
+        :return:
+        """
+        while self._next is not None and self._next[0] <= until:
+            wall_time, chunk = self._next
+            received = self._clock.to_monotonic(wall_time)
+            Metrics_Module.increment("serial_bytes_read_total", len(chunk), instrument=self._uart_name)
+            for frame in self._splitter.feed(chunk):
+                self._logger.enqueue_frame(self._uart_name, frame, received)
+            self.chunks += 1
+            self.last_time = wall_time
+            self._next = next(self._chunks, None)
+
+    def run(self):
+        # Throttled replay, a parse_frames thread of read_data takes the frames from the queue
+        while not self._logger.stop_event.is_set() and self._next is not None:
+            delay = self._next[0] - self._clock.time()
+            if delay > 0:
+                self._clock.sleep(min(delay, REPLAY_POLL_INTERVAL * self._clock.speed))
+                continue
+            self.deliver(self._clock.time())
+
+
+def drain_frames(logger):
+    """Parse every queued frame in the calling thread, the unthrottled replay has no parser threads"""
+    for name, frame_queue in logger.frame_queues.items():
+        while True:
+            try:
+                received, frame = frame_queue.get_nowait()
+            except queue.Empty:
+                break
+            logger.process_frame(name, frame, received)
+
+
+def next_period_start(wall_time):
+    """
+    :param wall_time: unit:s since 1970
+    :return: wall time of the next local averaging period boundary
+    """
+    local = datetime.datetime.fromtimestamp(wall_time)
+    boundary = Data_Calculation_Module.period_start(local)
+    return (boundary + Data_Calculation_Module.AVERAGING_PERIOD).timestamp()
+
+
+def run_replay(sources, speed=0.0, data_dir=REPLAY_DATA_DIR, result_dir=REPLAY_RESULT_DIR, finish_period=True):
+    """
+    Run the logger of OpenFlux.py on recorded data instead of serial ports: the sampler, the raw data files
+    with their period rollover and the flux calculation (online or by the worker process) are the live
+    code, only the clock is virtual.
+    :param sources: dict of instrument name to (wall time, bytes) chunks, from recorded_file_sources or
+                    capture_sources
+    :param speed: 1 for real time, 100 for 100 times faster, 0 for as fast as possible. Unthrottled, the
+                  frames are parsed in the sampler thread when the clock reaches them, so the result does not
+                  depend on thread scheduling
+    :param data_dir: folder of the raw data files written by the replay
+    :param result_dir: result folder of the calculation
+    :param finish_period: step the clock to the next averaging period boundary after the last chunk, so the last
+                          period is rolled over and calculated without a tail of stale samples
+    :return: dict with chunks, ticks, missed_ticks, virtual_seconds and elapsed (real seconds)
+    """
+    import OpenFlux
+    import Calculation_Worker_Module
+
+    unknown = sorted(set(sources) - set(OpenFlux.instrument_drivers))
+    if unknown:
+        print(f"No configured instrument for {', '.join(unknown)}, not replayed")
+    os.makedirs(data_dir, exist_ok=True)
+    os.makedirs(result_dir, exist_ok=True)
+    # The results of the replay, and the site state its calculation reads, are kept in result_dir
+    live_result_dir = OpenFlux.result_dir
+    OpenFlux.result_dir = result_dir
+    # Fresh buffers, queues and accumulator, and the logger state __main__ of OpenFlux would set up
+    OpenFlux.configure_instruments(OpenFlux.instruments)
+    OpenFlux.stop_event.clear()
+    OpenFlux.file_path = data_dir
+    OpenFlux.last_file_time = None
+    OpenFlux.current_file = None
+    for name in OpenFlux.sampler_stats:
+        OpenFlux.sampler_stats[name] = 0
+
+    first_chunks = {}
+    for name, chunks in sources.items():
+        chunks = iter(chunks)
+        first = next(chunks, None)
+        if first is not None and name in OpenFlux.instrument_drivers:
+            first_chunks[name] = (first, chunks)
+    if not first_chunks:
+        print("Nothing to replay")
+        OpenFlux.result_dir = live_result_dir
+        return {"chunks": 0, "ticks": 0, "missed_ticks": 0, "virtual_seconds": 0.0, "elapsed": 0.0}
+    # Half a sample period early, so the first tick is the grid point of the first recorded frame
+    first_time = min(first[0] for first, _ in first_chunks.values())
+    clock = VirtualClock(first_time - 0.5 / OpenFlux.SAMPLING_FREQUENCY, speed)
+    readers = [ReplayReader(OpenFlux, name, itertools.chain([first], chunks), clock)
+               for name, (first, chunks) in first_chunks.items()]
+    live_clock = OpenFlux.clock
+    OpenFlux.clock = clock
+    # The raw files of the replay are queued apart from the jobs of a live logger
+    live_queue_dir = OpenFlux.calculation_queue_dir
+    OpenFlux.calculation_queue_dir = os.path.join(result_dir, "calculation_queue")
+
+    worker_stop_event = worker = None
+    if not OpenFlux.ONLINE_FLUX_CALCULATION:
+        worker_stop_event = multiprocessing.Event()
+        worker = Calculation_Worker_Module.start_worker(worker_stop_event, OpenFlux.calculation_queue_dir,
+                                                        output_dir=result_dir)
+
+    period = 1 / OpenFlux.SAMPLING_FREQUENCY
+
+    def end_of_data():
+        """
+        Called once every chunk is delivered and the last one sampled. Skips the rest of the last period with a
+        wall clock step, the sampler re-aligns to the boundary and its next tick rolls the raw file over.
+        :return: True when the tick being written is the last one
+        """
+        last_time = max(reader.last_time for reader in readers if reader.last_time is not None)
+        now = clock.time() + REPLAY_TIME_TOLERANCE
+        if not finish_period:
+            return now >= last_time
+        boundary = next_period_start(last_time)
+        if boundary - now > 2 * period:
+            clock.step(boundary - 0.5 * period - clock.time())
+            return False
+        return now >= boundary
+
+    threads_before = set(threading.enumerate())
+    started = time.monotonic()
+    try:
+        if speed:
+            read_thread = threading.Thread(target=OpenFlux.read_data, args=(readers,))
+            read_thread.start()
+            write_thread = threading.Thread(target=OpenFlux.write_data)
+            write_thread.start()
+            while write_thread.is_alive():
+                time.sleep(REPLAY_POLL_INTERVAL * min(1.0, 1 / speed))
+                sampled = max(reader.last_time or 0 for reader in readers) + period
+                if all(reader.finished for reader in readers) and clock.time() >= sampled and end_of_data():
+                    # One more tick for the rollover at the boundary
+                    clock.sleep(3 * period)
+                    break
+            OpenFlux.stop_event.set()
+            read_thread.join()
+            write_thread.join()
+        else:
+            def deliver_due():
+                until = clock.time() + REPLAY_TIME_TOLERANCE
+                for reader in readers:
+                    reader.deliver(until)
+                drain_frames(OpenFlux)
+                # The sampler still writes the tick it is sleeping for, then stops
+                if all(reader.finished for reader in readers) and end_of_data():
+                    OpenFlux.stop_event.set()
+
+            clock.add_advance_hook(deliver_due)
+            OpenFlux.write_data()
+        if finish_period and OpenFlux.rolling_accumulator is not None:
+            # The last window does not wait for the lagged pairs of samples after the data
+            for rolling_result in OpenFlux.rolling_accumulator.finish():
+                OpenFlux.save_rolling_flux(rolling_result)
+        # Calculations started by the last rollover
+        for thread in set(threading.enumerate()) - threads_before:
+            thread.join()
+        if worker is not None:
+            while Calculation_Worker_Module.pending_jobs(OpenFlux.calculation_queue_dir) and worker.is_alive():
+                time.sleep(REPLAY_POLL_INTERVAL)
+    finally:
+        OpenFlux.stop_event.set()
+        OpenFlux.clock = live_clock
+        OpenFlux.calculation_queue_dir = live_queue_dir
+        OpenFlux.result_dir = live_result_dir
+        if worker is not None:
+            Calculation_Worker_Module.stop_worker(worker, worker_stop_event)
+
+    return {"chunks": sum(reader.chunks for reader in readers), "ticks": OpenFlux.sampler_stats["ticks"],
+            "missed_ticks": OpenFlux.sampler_stats["missed_ticks"],
+            "virtual_seconds": clock.monotonic(), "elapsed": time.monotonic() - started}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay archived raw data files or serial captures through the "
+                                                 "OpenFlux logger and its flux calculation")
+    parser.add_argument("files", nargs="+", help="raw data files (e.g. ./OpenFLux_data/20240501_*.txt) or "
+                                                 f"serial captures (*{CAPTURE_EXTENSION})")
+    parser.add_argument("--speed", type=float, default=0, help="1 for real time, 100 for 100 times faster, "
+                                                                "0 for unthrottled (default)")
+    parser.add_argument("--data-dir", default=REPLAY_DATA_DIR, help="folder for the raw data files of the replay")
+    parser.add_argument("--result-dir", default=REPLAY_RESULT_DIR)
+    parser.add_argument("--raw-format", choices=["txt", "bin"], help="raw data file format, the one of "
+                                                                     "OpenFlux.py by default")
+    parser.add_argument("--no-finish", action="store_true", help="stop after the last chunk instead of "
+                                                                 "calculating the last period")
+    args = parser.parse_args()
+
+    Data_Calculation_Module.configure_logging()
+    import OpenFlux
+    if args.raw_format:
+        OpenFlux.RAW_FILE_FORMAT = args.raw_format
+    captures = [file_path for file_path in args.files if file_path.endswith(CAPTURE_EXTENSION)]
+    recorded = [file_path for file_path in args.files if not file_path.endswith(CAPTURE_EXTENSION)]
+    # An instrument with serial captures is replayed from them rather than from the recorded values
+    replay_sources = recorded_file_sources(recorded, OpenFlux.instrument_drivers) if recorded else {}
+    replay_sources.update(capture_sources(captures))
+    summary = run_replay(replay_sources, args.speed, args.data_dir, args.result_dir, not args.no_finish)
+    print(f"{summary['chunks']} chunks, {summary['ticks']} samples ({summary['missed_ticks']} missed) in "
+          f"{summary['elapsed']:.1f} s for {summary['virtual_seconds'] / 3600:.2f} h of data")
@@ -0,0 +1,252 @@
+# ===========================================================================================
+# Copyright (c)  2024 HealthyPhoton Technology. All rights reserved.
+# Licensed under the MIT License. See LICENSE file in the project root for details.
+# ===========================================================================================
+import argparse
+import datetime
+import os
+import sqlite3
+
+import numpy as np
+
+RESULTS_DATABASE = "EC_FLUX.sqlite"  # Results store in the result folder
+RESULTS_TABLE = "flux_results"
+RESULTS_PERIOD = datetime.timedelta(minutes=30)  # Default averaging period, the rows are keyed by its start
+PERIOD_COLUMN = "period_start"  # Primary key, the start of the period the TIMESTAMP of a result falls in
+CURVE_COLUMNS = ("cross_covariance", "cross_covariance_step")  # Lag curve as float64 bytes and its lag step unit:s
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def period_start(timestamp, period=RESULTS_PERIOD):
+    """
+    Start of the averaging period that contains a result TIMESTAMP, like Data_Calculation_Module.period_start.
+    The TIMESTAMP is the time of the first sample, so a rerun with other leading samples keeps the same key.
+    :param timestamp: e.g. 2024-01-01 00:00:00.10, str or datetime
+    :param period: timedelta
+    :return: str, e.g. 2024-01-01 00:00:00
+    """
+    # The fraction of a second never moves a timestamp into another period
+    timestamp = datetime.datetime.fromisoformat(str(timestamp)[:19])
+    day_start = datetime.datetime.combine(timestamp.date(), datetime.time())
+    return str(day_start + ((timestamp - day_start) // period) * period)
+
+
+class ResultsStore:
+    """
+    SQLite results store, one row per period keyed by the start of the period (period_start), so a rerun period
+    replaces its row and a date range is an index lookup. Result columns are added as they appear, the
+    cross-covariance curve of the period is kept as a float64 array in a BLOB column.
+    """
+
+    def __init__(self, database_path, timeout=30, period=RESULTS_PERIOD):
+        """
+        :param database_path:
+        :param timeout: wait for the lock of another writer unit:s
+        :param period: averaging period of the stored results, timedelta
+        """
+        self.database_path = database_path
+        self.period = period
+        self._connection = sqlite3.connect(database_path, timeout=timeout)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(f"CREATE TABLE IF NOT EXISTS {RESULTS_TABLE} ({PERIOD_COLUMN} TEXT PRIMARY KEY, "
+                                 f"TIMESTAMP TEXT, {CURVE_COLUMNS[0]} BLOB, {CURVE_COLUMNS[1]} REAL)")
+        self._columns = self._table_columns()
+
+    def _table_columns(self):
+        return [row[1] for row in self._connection.execute(f"PRAGMA table_info({RESULTS_TABLE})")]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        self._connection.close()
+
+    def result_columns(self):
+        """EC_FLUX.csv columns in the order they first appeared"""
+        return [column for column in self._columns if column not in CURVE_COLUMNS and column != PERIOD_COLUMN]
+
+    def upsert(self, result_data, cross_cov_results=None, lag_step=None):
+        """
+        Insert the result of one period or replace the stored one of the same period start as a whole, columns
+        the new result does not have are left empty
+        :param result_data: dict of EC_FLUX.csv columns, starting with TIMESTAMP
+        :param cross_cov_results: lagged covariances, index 0 is the most negative lag
+        :param lag_step: lag between two curve points unit:s
+        :return:
+        """
+        row = {PERIOD_COLUMN: period_start(result_data['TIMESTAMP'], self.period)}
+        row.update({key: (value.item() if isinstance(value, np.generic) else value)
+                    for key, value in result_data.items()})
+        if cross_cov_results is not None:
+            row[CURVE_COLUMNS[0]] = np.asarray(cross_cov_results, dtype='<f8').tobytes()
+            row[CURVE_COLUMNS[1]] = lag_step
+        with self._connection:
+            for column in row:
+                if column not in self._columns:
+                    # No declared type, values keep the type they were written with
+                    self._connection.execute(f"ALTER TABLE {RESULTS_TABLE} ADD COLUMN {_quote(column)}")
+                    self._columns.append(column)
+            names = ", ".join(_quote(column) for column in row)
+            self._connection.execute(f"INSERT OR REPLACE INTO {RESULTS_TABLE} ({names}) "
+                                     f"VALUES ({', '.join('?' * len(row))})", list(row.values()))
+
+    def _range(self, select, start=None, end=None):
+        conditions, parameters = [], []
+        if start is not None:
+            conditions.append(f"{PERIOD_COLUMN} >= ?")
+            parameters.append(str(start))
+        if end is not None:
+            conditions.append(f"{PERIOD_COLUMN} < ?")
+            parameters.append(str(end))
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        return self._connection.execute(f"SELECT {select} FROM {RESULTS_TABLE}{where} ORDER BY {PERIOD_COLUMN}",
+                                        parameters)
+
+    def query(self, start=None, end=None, columns=None):
+        """
+        Results of a time range
+        :param start: first period start to include, e.g. "2024-05-01", None for no limit
+        :param end: period start to stop before, None for no limit
+        :param columns: result columns, all by default
+        :return: DataFrame in the EC_FLUX.csv layout
+        """
+        import pandas as pd
+        columns = ["TIMESTAMP"] + [column for column in (columns or self.result_columns()) if column != "TIMESTAMP"]
+        rows = self._range(", ".join(_quote(column) for column in columns), start, end).fetchall()
+        return pd.DataFrame(rows, columns=columns)
+
+    def cross_covariance(self, start=None, end=None):
+        """
+        Lag curves of a time range
+        :param start: first period start to include
+        :param end: period start to stop before
+        :return: (list of TIMESTAMP, list of lag step, list of float64 arrays), periods without a curve are left out
+        """
+        timestamps, steps, curves = [], [], []
+        for timestamp, curve, step in self._range(f"TIMESTAMP, {CURVE_COLUMNS[0]}, {CURVE_COLUMNS[1]}", start, end):
+            if curve is not None:
+                timestamps.append(timestamp)
+                steps.append(step)
+                curves.append(np.frombuffer(curve, dtype='<f8'))
+        return timestamps, steps, curves
+
+    def timestamps(self):
+        """All stored TIMESTAMP values"""
+        return [row[0] for row in self._connection.execute(f"SELECT TIMESTAMP FROM {RESULTS_TABLE}")]
+
+    def contains(self, timestamp):
+        """True if the period of this TIMESTAMP is stored"""
+        return self._connection.execute(f"SELECT 1 FROM {RESULTS_TABLE} WHERE {PERIOD_COLUMN} = ?",
+                                        (period_start(timestamp, self.period),)).fetchone() is not None
+
+
+def store_path(output_dir):
+    """
+    :param output_dir: result folder
+    :return: path of the results store of the folder
+    """
+    return os.path.join(output_dir, RESULTS_DATABASE)
+
+
+def cross_covariance_header(length, lag_step):
+    """
+    Column names of cross_covariance_results.txt
+    :param length: number of curve points
+    :param lag_step: unit:s
+    :return: list, e.g. ["time", "-1.0s", ..., "1.0s"]
+    """
+    return ["time"] + [f"{round((i - length // 2) * lag_step, 1)}s" for i in range(length)]
+
+
+def read_results_csv(file_path):
+    """
+    Read an EC_FLUX.csv, the classes of the sub-periods (e.g. steady_state_blocks 001012) are kept as text and
+    the floats are parsed exactly
+    :param file_path:
+    :return: DataFrame
+    """
+    import pandas as pd
+    columns = pd.read_csv(file_path, nrows=0).columns
+    return pd.read_csv(file_path, dtype={column: str for column in columns if column.endswith('_blocks')},
+                       float_precision='round_trip')
+
+
+def export_csv(database_path, output_dir, start=None, end=None):
+    """
+    Write the stored results of a time range in the original layout, EC_FLUX.csv and the tab separated
+    cross_covariance_results.txt (files in output_dir are replaced)
+    :param database_path:
+    :param output_dir:
+    :param start: first period start to include
+    :param end: period start to stop before
+    :return: number of periods exported
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    with ResultsStore(database_path) as store:
+        results = store.query(start, end)
+        timestamps, steps, curves = store.cross_covariance(start, end)
+    results.to_csv(os.path.join(output_dir, 'EC_FLUX.csv'), index=False)
+
+    with open(os.path.join(output_dir, 'cross_covariance_results.txt'), 'w', encoding='utf-8') as file:
+        header_written = False
+        for timestamp, step, curve in zip(timestamps, steps, curves):
+            if not header_written:
+                file.write("\t" + "\t".join(cross_covariance_header(len(curve), step or 0.1)) + "\n")
+                header_written = True
+            # The appended one row frames of the text file always had the index 0
+            file.write("0\t" + timestamp + "\t" + "\t".join(repr(float(value)) for value in curve) + "\n")
+    return len(results)
+
+
+def import_csv(database_path, output_dir, period=RESULTS_PERIOD):
+    """
+    Load an existing EC_FLUX.csv and cross_covariance_results.txt into the store, a later duplicate of a
+    period replaces the earlier one
+    :param database_path:
+    :param output_dir: folder with the CSV results
+    :param period: averaging period of the results, timedelta
+    :return: number of periods imported
+    """
+    import pandas as pd
+    results = read_results_csv(os.path.join(output_dir, 'EC_FLUX.csv'))
+    curves, lag_step = {}, None
+    curve_path = os.path.join(output_dir, 'cross_covariance_results.txt')
+    if os.path.exists(curve_path):
+        curve_data = pd.read_csv(curve_path, sep='\t', index_col=0, float_precision='round_trip')
+        lags = [float(column.rstrip('s')) for column in curve_data.columns[1:]]
+        lag_step = round(lags[1] - lags[0], 6) if len(lags) > 1 else None
+        for row in curve_data.itertuples(index=False):
+            curves[str(row[0])] = np.array(row[1:], dtype=np.float64)
+    with ResultsStore(database_path, period=period) as store:
+        for record in results.to_dict('records'):
+            record = {key: value for key, value in record.items() if not pd.isna(value)}
+            timestamp = str(record['TIMESTAMP'])
+            store.upsert(record, curves.get(timestamp), lag_step if timestamp in curves else None)
+    return len(results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the OpenFlux results store to the CSV layout or import CSV "
+                                                 "results into it")
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("result_dir", help="folder with EC_FLUX.sqlite, e.g. ./EC_FLUX")
+    parser.add_argument("--csv-dir", help="folder of the CSV files, the result folder by default")
+    parser.add_argument("--start", help="first period start to export, e.g. 2024-05-01")
+    parser.add_argument("--end", help="period start to stop before, e.g. 2024-06-01")
+    parser.add_argument("--period", type=float, default=RESULTS_PERIOD.total_seconds() / 60,
+                        help="averaging period of the imported results unit:minutes")
+    args = parser.parse_args()
+
+    csv_dir = args.csv_dir or args.result_dir
+    if args.command == "export":
+        print(f"{export_csv(store_path(args.result_dir), csv_dir, args.start, args.end)} periods exported")
+    else:
+        print(f"{import_csv(store_path(args.result_dir), csv_dir, datetime.timedelta(minutes=args.period))} "
+              f"periods imported")
@@ -0,0 +1,280 @@
+# ===========================================================================================
+# Copyright (c)  2024 HealthyPhoton Technology. All rights reserved.
+# Licensed under the MIT License. See LICENSE file in the project root for details.
+# ===========================================================================================
+import os
+
+import numpy as np
+
+SPECTRAL_BINS = 40  # Log spaced frequency bins between 1 / SPECTRAL_PERIOD and the Nyquist frequency
+SPECTRAL_PERIOD = 1800  # Averaging period the lowest bin is based on unit:s
+MEASUREMENT_HEIGHT = 3.0  # Height of the sonic above the displacement height unit:m
+NEUTRAL_LIMIT = 0.1  # |z/L| up to this is neutral
+STABILITY_CLASSES = ("unstable", "neutral", "stable")
+SPECTRAL_MIN_PERIODS = 10  # Periods of a stability class before its average heat cospectrum is the reference
+MAX_CORRECTION = 3.0  # Upper limit of the spectral correction factor
+SPECTRA_AVERAGE_FILE = "spectra_by_stability.npz"  # Running sums of the normalised spectra per stability class
+VON_KARMAN = 0.4
+GRAVITY = 9.81  # unit:m/s^2
+
+
+def frequency_bins(sampling_frequency, bins=SPECTRAL_BINS, period=SPECTRAL_PERIOD):
+    """
+    Log spaced frequency bins, the same for every period at a sampling frequency so periods can be averaged
+    :param sampling_frequency: unit:Hz
+    :param bins: number of bins
+    :param period: unit:s
+    :return: (edges, centres, widths) unit:Hz
+    """
+    edges = np.logspace(np.log10(1 / period), np.log10(sampling_frequency / 2), bins + 1)
+    return edges, np.sqrt(edges[:-1] * edges[1:]), np.diff(edges)
+
+
+def binned_spectra(w_prime, scalar_primes, lags, sampling_frequency, bins=SPECTRAL_BINS):
+    """
+    Power spectra of w and every scalar and the cospectra of w with every scalar at its flux lag, from real FFTs
+    averaged in log spaced bins. The scalars are transformed one at a time, so only two transforms are held.
+    :param w_prime: vertical wind fluctuation
+    :param scalar_primes: (n, k) scalar fluctuations
+    :param lags: flux lag of every scalar unit:samples, w_prime[i + lag] pairs with scalar_primes[i]
+    :param sampling_frequency: unit:Hz
+    :param bins: number of bins
+    :return: (power (k + 1, bins) with w first, cospectra (k, bins)), one sided densities, NaN for empty bins
+    """
+    w_prime = np.asarray(w_prime, dtype=np.float64)
+    scalar_primes = np.asarray(scalar_primes, dtype=np.float64).reshape(len(w_prime), -1)
+    n, k = scalar_primes.shape
+    frequencies = np.fft.rfftfreq(n, 1 / sampling_frequency)[1:]
+    scale = 2 / (n * sampling_frequency)
+    edges, _, _ = frequency_bins(sampling_frequency, bins)
+    index = np.searchsorted(edges, frequencies, side='right') - 1
+    valid = (index >= 0) & (index < bins)
+    index = index[valid]
+    counts = np.bincount(index, minlength=bins).astype(np.float64)
+
+    power = np.empty((k + 1, bins))
+    cospectra = np.empty((k, bins))
+    w_transform = np.fft.rfft(w_prime)[1:]
+    with np.errstate(invalid='ignore'):
+        power[0] = np.bincount(index, (np.abs(w_transform) ** 2 * scale)[valid], bins) / counts
+        for i in range(k):
+            # A circular shift aligns the scalar with w at its lag before the transform
+            transform = np.fft.rfft(np.roll(scalar_primes[:, i], int(lags[i])))[1:]
+            power[i + 1] = np.bincount(index, (np.abs(transform) ** 2 * scale)[valid], bins) / counts
+            cospectra[i] = np.bincount(index, (np.real(np.conj(w_transform) * transform) * scale)[valid],
+                                       bins) / counts
+    return power, cospectra
+
+
+def normalise(spectra, widths):
+    """
+    Scale every binned spectrum so it integrates to 1, periods of different variance can then be averaged
+    :param spectra: (m, bins)
+    :param widths: bin widths unit:Hz
+    :return: (m, bins)
+    """
+    integral = np.nansum(spectra * widths, axis=1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(integral != 0, spectra / integral, np.nan)
+
+
+def obukhov_stability(friction_velocity, kinematic_heat_flux, temperature, height=MEASUREMENT_HEIGHT):
+    """
+    Stability parameter z/L
+    :param friction_velocity: unit:m/s
+    :param kinematic_heat_flux: w'T' unit:K m/s
+    :param temperature: mean (sonic) temperature unit:degC
+    :param height: unit:m
+    :return: z/L, NaN if u* is 0
+    """
+    if not friction_velocity:
+        return float('nan')
+    obukhov_length = -friction_velocity ** 3 * (temperature + 273.15) / (VON_KARMAN * GRAVITY * kinematic_heat_flux)
+    return float(height / obukhov_length) if np.isfinite(obukhov_length) and obukhov_length else 0.0
+
+
+def stability_class(z_over_l):
+    """
+    :param z_over_l:
+    :return: "unstable", "neutral", "stable" or "unknown"
+    """
+    if not np.isfinite(z_over_l):
+        return "unknown"
+    if z_over_l < -NEUTRAL_LIMIT:
+        return "unstable"
+    return "neutral" if z_over_l <= NEUTRAL_LIMIT else "stable"
+
+
+def transfer_function(frequencies, response_time):
+    """
+    First order response of a closed-path analyzer. Its phase shift is taken out by the lag search, so only
+    the amplitude response attenuates the cospectrum (Moore 1986).
+    :param frequencies: unit:Hz
+    :param response_time: unit:s
+    :return: transfer function of the flux, between 0 and 1
+    """
+    return 1 / np.sqrt(1 + (2 * np.pi * np.asarray(frequencies) * response_time) ** 2)
+
+
+def correction_factors(reference_cospectrum, sampling_frequency, response_times, bins=SPECTRAL_BINS):
+    """
+    Spectral correction of every scalar: the integral of an unattenuated reference cospectrum (the w-T
+    cospectrum) divided by its integral after the transfer function of the scalar
+    :param reference_cospectrum: binned reference cospectrum, normalised or not
+    :param sampling_frequency: unit:Hz
+    :param response_times: first order response time of every scalar unit:s, 0 for no correction
+    :param bins: number of bins
+    :return: array of factors, 1 where there is no usable reference, at most MAX_CORRECTION
+    """
+    _, centres, widths = frequency_bins(sampling_frequency, bins)
+    response_times = np.asarray(response_times, dtype=np.float64)
+    factors = np.ones(len(response_times))
+    if reference_cospectrum is None:
+        return factors
+    reference = np.nan_to_num(np.asarray(reference_cospectrum, dtype=np.float64)) * widths
+    attenuated = transfer_function(centres[None, :], response_times[:, None]) @ reference
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratio = reference.sum() / attenuated
+    usable = np.isfinite(ratio) & (ratio > 0) & (response_times > 0)
+    factors[usable] = np.clip(ratio[usable], 1.0, MAX_CORRECTION)
+    return factors
+
+
+class SpectraAverages:
+    """Running sums of the normalised spectra and cospectra of every stability class"""
+
+    def __init__(self, sampling_frequency, names, counts=None, power_sum=None, cospectra_sum=None,
+                 bins=SPECTRAL_BINS):
+        self.sampling_frequency = sampling_frequency
+        self.names = list(names)  # Scalar names, the power spectra start with w
+        self.bins = bins
+        classes, k = len(STABILITY_CLASSES), len(self.names)
+        self.counts = np.zeros(classes, dtype=np.int64) if counts is None else np.asarray(counts)
+        self.power_sum = np.zeros((classes, k + 1, bins)) if power_sum is None else np.asarray(power_sum)
+        self.cospectra_sum = np.zeros((classes, k, bins)) if cospectra_sum is None else np.asarray(cospectra_sum)
+
+    def add(self, stability, power, cospectra):
+        """
+        Add the spectra of one period to its stability class
+        :param stability: one of STABILITY_CLASSES, other classes are ignored
+        :param power: binned power spectra (k + 1, bins)
+        :param cospectra: binned cospectra (k, bins)
+        :return:
+        """
+        self._add(stability, power, cospectra, 1)
+
+    def remove(self, stability, power, cospectra):
+        """
+        Take the spectra of a period out of its stability class again, e.g. before the spectra of a recalculated
+        period are added
+        :param stability: stability class the spectra were added to
+        :param power: the binned power spectra that were added
+        :param cospectra: the binned cospectra that were added
+        :return:
+        """
+        if stability in STABILITY_CLASSES and self.counts[STABILITY_CLASSES.index(stability)] > 0:
+            self._add(stability, power, cospectra, -1)
+
+    def _add(self, stability, power, cospectra, sign):
+        if stability not in STABILITY_CLASSES:
+            return
+        _, _, widths = frequency_bins(self.sampling_frequency, self.bins)
+        index = STABILITY_CLASSES.index(stability)
+        self.counts[index] += sign
+        self.power_sum[index] += sign * np.nan_to_num(normalise(power, widths))
+        self.cospectra_sum[index] += sign * np.nan_to_num(normalise(cospectra, widths))
+
+    def mean_cospectrum(self, stability, name):
+        """
+        Average normalised cospectrum of a scalar in a stability class
+        :param stability:
+        :param name: scalar name
+        :return: binned cospectrum or None with fewer than SPECTRAL_MIN_PERIODS periods
+        """
+        if stability not in STABILITY_CLASSES or name not in self.names:
+            return None
+        index = STABILITY_CLASSES.index(stability)
+        if self.counts[index] < SPECTRAL_MIN_PERIODS:
+            return None
+        return self.cospectra_sum[index, self.names.index(name)] / self.counts[index]
+
+    def save(self, file_path):
+        """Write the sums to an NPZ file, replaced atomically"""
+        edges, _, _ = frequency_bins(self.sampling_frequency, self.bins)
+        temporary_path = file_path + '.tmp.npz'
+        np.savez_compressed(temporary_path, sampling_frequency=self.sampling_frequency, names=np.array(self.names),
+                            classes=np.array(STABILITY_CLASSES), edges=edges, counts=self.counts,
+                            power_sum=self.power_sum, cospectra_sum=self.cospectra_sum)
+        os.replace(temporary_path, file_path)
+
+    @classmethod
+    def load(cls, file_path, sampling_frequency, names):
+        """
+        Load the sums of a result folder, a new set if the file is missing or was made for other settings
+        :param file_path:
+        :param sampling_frequency: unit:Hz
+        :param names: scalar names
+        :return: SpectraAverages
+        """
+        if os.path.exists(file_path):
+            with np.load(file_path) as stored:
+                if (float(stored['sampling_frequency']) == sampling_frequency
+                        and list(stored['names']) == list(names)
+                        and stored['power_sum'].shape[-1] == SPECTRAL_BINS):
+                    return cls(sampling_frequency, names, stored['counts'], stored['power_sum'],
+                               stored['cospectra_sum'])
+        return cls(sampling_frequency, names)
+
+
+def daily_spectra_path(output_dir, timestamp):
+    """
+    NPZ file with the binned spectra of every period of a day
+    :param output_dir: result folder
+    :param timestamp: TIMESTAMP of the period
+    :return: path
+    """
+    return os.path.join(output_dir, f"spectra_{timestamp[:10].replace('-', '')}.npz")
+
+
+def save_period_spectra(output_dir, timestamp, spectra):
+    """
+    Store the binned spectra of one period in the NPZ file of its day and add them to the stability class
+    averages. A period that is already in the day file (a rerun) replaces its spectra in both.
+    The caller holds the lock of the averages file (Data_Calculation_Module.locked_file).
+    :param output_dir: result folder
+    :param timestamp: TIMESTAMP of the period
+    :param spectra: dict with sampling_frequency, names, stability, power and cospectra
+    :return:
+    """
+    sampling_frequency, names = spectra['sampling_frequency'], list(spectra['names'])
+    power = np.asarray(spectra['power'], dtype=np.float32)[None]
+    cospectra = np.asarray(spectra['cospectra'], dtype=np.float32)[None]
+    timestamps = np.array([timestamp])
+    stability = np.array([spectra['stability']])
+    previous = None  # (stability, power, cospectra) of an earlier calculation of the period
+
+    file_path = daily_spectra_path(output_dir, timestamp)
+    if os.path.exists(file_path):
+        with np.load(file_path) as stored:
+            if list(stored['names']) == names and stored['power'].shape[1:] == power.shape[1:]:
+                keep = stored['timestamps'] != timestamp
+                if not keep.all():
+                    rerun = np.flatnonzero(~keep)[-1]
+                    previous = (str(stored['stability'][rerun]), stored['power'][rerun], stored['cospectra'][rerun])
+                timestamps = np.concatenate((stored['timestamps'][keep], timestamps))
+                stability = np.concatenate((stored['stability'][keep], stability))
+                power = np.concatenate((stored['power'][keep], power))
+                cospectra = np.concatenate((stored['cospectra'][keep], cospectra))
+    edges, _, _ = frequency_bins(sampling_frequency, power.shape[-1])
+    temporary_path = file_path + '.tmp.npz'
+    np.savez_compressed(temporary_path, timestamps=timestamps, stability=stability, names=np.array(names),
+                        edges=edges, power=power, cospectra=cospectra)
+    os.replace(temporary_path, file_path)
+
+    average_path = os.path.join(output_dir, SPECTRA_AVERAGE_FILE)
+    averages = SpectraAverages.load(average_path, sampling_frequency, names)
+    if previous is not None:
+        averages.remove(*previous)
+    # The stored float32 spectra are added, so a rerun takes out exactly what was added
+    averages.add(spectra['stability'], power[-1], cospectra[-1])
+    averages.save(average_path)
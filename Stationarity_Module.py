@@ -0,0 +1,206 @@
+# ===========================================================================================
+# Copyright (c)  2024 HealthyPhoton Technology. All rights reserved.
+# Licensed under the MIT License. See LICENSE file in the project root for details.
+# ===========================================================================================
+import math
+
+import numpy as np
+
+STATIONARITY_BLOCKS = 6  # Sub-periods of the steady state test, e.g. 5 minutes of a half hour
+STEADY_STATE_LIMITS = (0.3, 1.0)  # Deviation of the mean sub-period covariance for class 1 / 2
+ITC_LIMITS = (0.3, 0.75)  # Deviation of sigma_w / u* from its model for class 1 / 2
+# sigma_w / u* = c1 * |z/L| ** c2 as (z/L from, z/L to, c1, c2), Foken and Wichura (1996)
+ITC_W_MODEL = ((-3.0, -0.2, 2.0, 1 / 8), (-0.2, 0.4, 1.3, 0.0))
+
+
+def block_length(sample_count, nominal_length, blocks=STATIONARITY_BLOCKS):
+    """
+    Samples per block: the nominal sub-period, longer for files of more than one averaging period
+    :param sample_count: samples of the period
+    :param nominal_length: samples of one sub-period of a full averaging period
+    :param blocks:
+    :return: unit:samples
+    """
+    return max(int(nominal_length), math.ceil(sample_count / blocks), 1)
+
+
+def block_sums(x, y, length, blocks=STATIONARITY_BLOCKS):
+    """
+    Sums of paired series in consecutive blocks, one block at a time with the products summed by np.einsum, so
+    no temporary is larger than a block. Block i holds the rows from i * length on, the last block also takes the
+    rows after blocks * length. Pairs with a NaN are left out.
+    :param x: (n, k)
+    :param y: (n, k)
+    :param length: rows per block
+    :param blocks:
+    :return: (count, sum_x, sum_y, sum_xy, sum_xx, sum_yy), each (blocks, k), blocks without rows are 0
+    """
+    x = np.asarray(x, dtype=np.float64).reshape(len(x), -1)
+    y = np.asarray(y, dtype=np.float64).reshape(len(y), -1)
+    sums = np.zeros((6, blocks, x.shape[1]))
+    for i in range(blocks):
+        start = i * length
+        if start >= len(x):
+            break
+        end = start + length if i < blocks - 1 else len(x)
+        block_x, block_y = x[start:end], y[start:end]
+        valid = np.isfinite(block_x) & np.isfinite(block_y)
+        if not valid.all():
+            block_x = np.where(valid, block_x, 0.0)
+            block_y = np.where(valid, block_y, 0.0)
+        sums[:, i] = (valid.sum(axis=0), block_x.sum(axis=0), block_y.sum(axis=0),
+                      np.einsum('ij,ij->j', block_x, block_y), np.einsum('ij,ij->j', block_x, block_x),
+                      np.einsum('ij,ij->j', block_y, block_y))
+    return tuple(sums)
+
+
+def moments_from_sums(count, sum_x, sum_y, sum_xy, sum_xx=None, sum_yy=None):
+    """
+    Means and co-moments from raw sums
+    :param count: pairs per block
+    :param sum_x:
+    :param sum_y:
+    :param sum_xy:
+    :param sum_xx: optional, for the second moments of x
+    :param sum_yy: optional, for the second moments of y
+    :return: dict with count, mean_x, mean_y, comoment and m2_x / m2_y when the squares are given,
+             NaN for blocks without pairs
+    """
+    count = np.asarray(count, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_x = np.where(count > 0, sum_x / count, np.nan)
+        mean_y = np.where(count > 0, sum_y / count, np.nan)
+    moments = {'count': count, 'mean_x': mean_x, 'mean_y': mean_y,
+               'comoment': np.where(count > 0, sum_xy - mean_x * sum_y, np.nan)}
+    if sum_xx is not None:
+        moments['m2_x'] = np.where(count > 0, sum_xx - mean_x * sum_x, np.nan)
+    if sum_yy is not None:
+        moments['m2_y'] = np.where(count > 0, sum_yy - mean_y * sum_y, np.nan)
+    return moments
+
+
+def block_moments(x, y, length, blocks=STATIONARITY_BLOCKS):
+    """
+    Block means and co-moments of paired series, see block_sums
+    :return: dict of moments_from_sums, each (blocks, k)
+    """
+    return moments_from_sums(*block_sums(x, y, length, blocks))
+
+
+def combine_moments(moments):
+    """
+    Moments of the whole period from the block moments (pairwise update of Chan et al.), no pass over the data
+    :param moments: dict of block moments (blocks, k)
+    :return: dict of the same keys, each (k,)
+    """
+    count = moments['count']
+    total = count.sum(axis=0)
+    weights = np.nan_to_num(count)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_x = np.nansum(moments['mean_x'] * weights, axis=0) / total
+        mean_y = np.nansum(moments['mean_y'] * weights, axis=0) / total
+    delta_x = np.nan_to_num(moments['mean_x'] - mean_x)
+    delta_y = np.nan_to_num(moments['mean_y'] - mean_y)
+    combined = {'count': total, 'mean_x': mean_x, 'mean_y': mean_y,
+                'comoment': np.nansum(moments['comoment'], axis=0) + np.sum(weights * delta_x * delta_y, axis=0)}
+    if 'm2_x' in moments:
+        combined['m2_x'] = np.nansum(moments['m2_x'], axis=0) + np.sum(weights * delta_x ** 2, axis=0)
+    if 'm2_y' in moments:
+        combined['m2_y'] = np.nansum(moments['m2_y'], axis=0) + np.sum(weights * delta_y ** 2, axis=0)
+    return combined
+
+
+def _covariance(comoment, count):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(count > 1, comoment / (count - 1), np.nan)
+
+
+def classify(deviation, limits):
+    """
+    0 / 1 / 2 classes of a relative deviation, 2 where it is not defined
+    :param deviation:
+    :param limits: upper limits of class 0 and 1
+    :return: int array
+    """
+    deviation = np.asarray(deviation, dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+        return np.where(deviation <= limits[0], 0, np.where(deviation <= limits[1], 1, 2))
+
+
+def steady_state_test(moments):
+    """
+    Steady state test of Foken and Wichura (1996): the mean covariance of the sub-periods against the
+    covariance of the whole period, both from the block moments
+    :param moments: block moments of the lag aligned (w', c') pairs, each (blocks, k)
+    :return: dict with block_covariance (blocks, k), covariance (k,), deviation (k,), steady_state (k,) and
+             block_flags (blocks, k): class of every block covariance against the period, -1 for empty blocks
+    """
+    block_covariance = _covariance(moments['comoment'], moments['count'])
+    period = combine_moments(moments)
+    covariance = _covariance(period['comoment'], period['count'])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if np.isfinite(block_covariance).any():
+            mean_block = np.nanmean(block_covariance, axis=0)
+        else:
+            mean_block = np.full(covariance.shape, np.nan)
+        deviation = np.abs(mean_block - covariance) / np.abs(covariance)
+        block_deviation = np.abs(block_covariance - covariance) / np.abs(covariance)
+    block_flags = np.where(np.isfinite(block_covariance), classify(block_deviation, STEADY_STATE_LIMITS), -1)
+    return {'block_covariance': block_covariance, 'covariance': covariance, 'deviation': deviation,
+            'steady_state': classify(deviation, STEADY_STATE_LIMITS), 'block_flags': block_flags}
+
+
+def wind_statistics(moments):
+    """
+    Standard deviations and friction velocity from the moments of the rotated wind paired with w
+    :param moments: moments of x = (u', v', w') and y = (w', w', w'), (blocks, 3) or (3,)
+    :return: dict of sigma_u, sigma_w and friction_velocity, per block or for the period
+    """
+    count = moments['count'][..., 0]
+    variance = _covariance(moments['m2_x'], moments['count'])
+    covariance = _covariance(moments['comoment'], moments['count'])
+    return {'count': count, 'sigma_u': np.sqrt(variance[..., 0]), 'sigma_w': np.sqrt(variance[..., 2]),
+            'friction_velocity': (covariance[..., 0] ** 2 + covariance[..., 1] ** 2) ** 0.25}
+
+
+def itc_model(z_over_l):
+    """
+    Modelled sigma_w / u*
+    :param z_over_l: stability parameter
+    :return: NaN outside the range of ITC_W_MODEL
+    """
+    z_over_l = np.asarray(z_over_l, dtype=np.float64)
+    model = np.full(z_over_l.shape, np.nan)
+    for low, high, c1, c2 in ITC_W_MODEL:
+        inside = (z_over_l > low) & (z_over_l <= high)
+        model[inside] = c1 * np.abs(z_over_l[inside]) ** c2
+    return model
+
+
+def integral_turbulence_test(sigma_w, friction_velocity, z_over_l):
+    """
+    Integral turbulence characteristic of w: measured sigma_w / u* against its model
+    :param sigma_w: per block or for the period unit:m/s
+    :param friction_velocity: same shape unit:m/s
+    :param z_over_l: stability parameter of the period
+    :return: (deviation, class), deviation is NaN and the class -1 where z/L is outside the model or u* is 0
+    """
+    model = itc_model(z_over_l)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        deviation = np.abs(np.asarray(sigma_w) / np.asarray(friction_velocity) - model) / model
+    return deviation, np.where(np.isfinite(deviation), classify(deviation, ITC_LIMITS), -1)
+
+
+def quality_flag(steady_state, itc_class):
+    """
+    Overall 0 / 1 / 2 flag of Mauder and Foken (2004), the steady state alone where the ITC is not defined
+    :param steady_state: class per scalar
+    :param itc_class: ITC class of the period, -1 if not defined
+    :return: int array per scalar
+    """
+    return np.maximum(np.asarray(steady_state), itc_class)
+
+
+def flag_string(flags):
+    """Block classes as one character per block, "-" for blocks without data"""
+    return "".join("-" if flag < 0 else str(int(flag)) for flag in flags)
@@ -0,0 +1,59 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# The modules are flat files in the project root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Data_Calculation_Module  # noqa: E402
+
+SAMPLING_FREQUENCY = 10  # unit:Hz
+LAG = 3  # Delay of the concentration behind w unit:samples
+
+
+def red_noise(n, rng, memory=20):
+    """Unit variance noise correlated over about memory samples, like the eddies of a turbulent record"""
+    kernel = np.exp(-np.arange(5 * memory) / memory)
+    noise = np.convolve(rng.standard_normal(n + len(kernel) - 1), kernel, mode='valid')
+    return noise / np.sqrt(np.sum(kernel ** 2))
+
+
+@pytest.fixture(scope="session")
+def turbulence():
+    """One hour of synthetic 10 Hz raw data in the OpenFLux_data layout, the concentration follows w by LAG"""
+    rng = np.random.default_rng(0)
+    n = 3600 * SAMPLING_FREQUENCY
+    w = 0.3 * red_noise(n, rng)
+    concentration = 2.0 + 0.5 * np.roll(w, LAG) + 0.02 * rng.standard_normal(n)
+    timestamps = pd.date_range("2024-01-01 00:00", periods=n, freq=pd.Timedelta(seconds=1 / SAMPLING_FREQUENCY))
+    return pd.DataFrame({
+        'TIMESTAMP': timestamps.strftime("%Y-%m-%d %H:%M:%S.%f").str[:-4],
+        'real_time_concentration': concentration * 16,
+        'ambient_temperature': 20.0,
+        'transmittance': 90.0,
+        'u_axis_speed': 3 + red_noise(n, rng),
+        'v_axis_speed': 0.5 + 0.5 * red_noise(n, rng),
+        'w_axis_speed': w + 0.05,
+        'sonic_temp': 21 + 0.8 * w + 0.02 * rng.standard_normal(n),
+    })
+
+
+@pytest.fixture
+def half_hour(turbulence):
+    """Copy of the first averaging period of the synthetic data"""
+    return turbulence.iloc[:1800 * SAMPLING_FREQUENCY].copy()
+
+
+@pytest.fixture
+def result_dir(tmp_path, monkeypatch):
+    """Raw data and result folders of the calculation in a temporary folder"""
+    (tmp_path / "OpenFLux_data").mkdir()
+    directory = tmp_path / "EC_FLUX"
+    directory.mkdir()
+    monkeypatch.setattr(Data_Calculation_Module, "BASE_DIR", str(tmp_path))
+    monkeypatch.setattr(Data_Calculation_Module, "ec_flux_dir", str(directory))
+    monkeypatch.setattr(Data_Calculation_Module, "rolling_flux_dir", str(directory / "rolling"))
+    return directory
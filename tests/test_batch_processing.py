@@ -0,0 +1,42 @@
+import datetime
+
+import Batch_Processing_Module
+import Data_Calculation_Module
+import Results_Store_Module
+
+
+def test_period_start():
+    assert Batch_Processing_Module.period_start(datetime.datetime(2024, 1, 1, 10, 59, 59)) == \
+        datetime.datetime(2024, 1, 1, 10, 30)
+
+
+def test_period_start_of_other_averaging_periods():
+    timestamp = datetime.datetime(2024, 1, 1, 1, 50)
+    assert Data_Calculation_Module.period_start(timestamp, datetime.timedelta(minutes=15)) == \
+        datetime.datetime(2024, 1, 1, 1, 45)
+    # Periods that do not divide an hour start at multiples of the period since midnight
+    assert Data_Calculation_Module.period_start(timestamp, datetime.timedelta(minutes=40)) == \
+        datetime.datetime(2024, 1, 1, 1, 20)
+
+
+def test_find_raw_files_sorts_and_selects_the_range(tmp_path):
+    for name in ("20240101_0030.txt", "20240101_0000.txt", "20240101_0100.txt", "notes.txt"):
+        (tmp_path / name).write_text("")
+    raw_files = Batch_Processing_Module.find_raw_files(str(tmp_path), datetime.datetime(2024, 1, 1, 0, 30))
+    assert raw_files == [(datetime.datetime(2024, 1, 1, 0, 30), str(tmp_path / "20240101_0030.txt")),
+                         (datetime.datetime(2024, 1, 1, 1, 0), str(tmp_path / "20240101_0100.txt"))]
+
+
+def test_run_batch_calculation_skips_the_calculated_periods(turbulence, tmp_path):
+    data_dir = tmp_path / "OpenFLux_data"
+    data_dir.mkdir()
+    output_dir = tmp_path / "EC_FLUX"
+    turbulence.iloc[18000:].to_csv(data_dir / "20240101_0030.txt", index=False)
+    assert Batch_Processing_Module.run_batch_calculation(str(data_dir), str(output_dir), workers=2) == 1
+
+    turbulence.iloc[:18000].to_csv(data_dir / "20240101_0000.txt", index=False)
+    assert Batch_Processing_Module.run_batch_calculation(str(data_dir), str(output_dir), workers=2) == 1
+    assert Batch_Processing_Module.run_batch_calculation(str(data_dir), str(output_dir), workers=2) == 0
+    with Results_Store_Module.ResultsStore(Results_Store_Module.store_path(str(output_dir))) as store:
+        results = store.query()
+    assert results['TIMESTAMP'].tolist() == ["2024-01-01 00:00:00.00", "2024-01-01 00:30:00.00"]
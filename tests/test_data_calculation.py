@@ -0,0 +1,563 @@
+import os
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import Data_Calculation_Module
+import Results_Store_Module
+import Spectral_Module
+import Stationarity_Module
+
+SAMPLES = 18000  # One averaging period at 10 Hz
+PERIOD_ORIGIN = Data_Calculation_Module.timestamp_to_milliseconds("2024-01-01 00:00:00.00")
+
+
+def lagged_series(n=3000, lag=4, seed=0):
+    """w' and c' where c follows w by lag samples, plus noise"""
+    rng = np.random.default_rng(seed)
+    w = rng.standard_normal(n + lag)
+    c = 0.5 * w[:n] + 0.2 * rng.standard_normal(n)
+    return w[lag:] - w[lag:].mean(), c - c.mean()
+
+
+def np_cov_loop(w_prime, c_prime, max_lag):
+    """The per-lag np.cov loop that calculate_cross_covariance replaces"""
+    results = []
+    for lag in range(-max_lag, max_lag + 1):
+        if lag < 0:
+            cov = np.cov(w_prime[:lag], c_prime[-lag:])
+        elif lag > 0:
+            cov = np.cov(w_prime[lag:], c_prime[:-lag])
+        else:
+            cov = np.cov(w_prime, c_prime)
+        results.append(cov[0, 1])
+    return np.array(results)
+
+
+# ==========================================================================================
+# Lag scan
+# ==========================================================================================
+@pytest.mark.parametrize("method", ["fft", "direct", "auto"])
+def test_cross_covariance_matches_the_np_cov_loop(method):
+    w_prime, c_prime = lagged_series()
+    covariance = Data_Calculation_Module.calculate_cross_covariance(w_prime, c_prime, 10, method)
+    np.testing.assert_allclose(covariance, np_cov_loop(w_prime, c_prime, 10), rtol=1e-10, atol=1e-14)
+    # c follows w, so the peak is at the negative lag that pairs them
+    assert np.argmax(covariance) - 10 == -4
+
+
+def test_cross_covariance_limits_the_lag_window_to_the_series():
+    w_prime, c_prime = lagged_series(n=8)
+    covariance = Data_Calculation_Module.calculate_cross_covariance(w_prime, c_prime, 10)
+    assert len(covariance) == 2 * 6 + 1
+    np.testing.assert_allclose(covariance, np_cov_loop(w_prime, c_prime, 6), rtol=1e-10, atol=1e-14)
+
+
+def test_turbulent_steady_state_uses_the_first_five_minutes_at_the_peak_lag():
+    w_prime, c_prime = lagged_series(n=6000)
+    cross_cov_results = Data_Calculation_Module.calculate_cross_covariance(w_prime, c_prime, 10)
+    previous_flux_mean, steady_state = Data_Calculation_Module.calculate_turbulent_steady_state(
+        cross_cov_results, w_prime, c_prime, 10)
+    assert previous_flux_mean == Data_Calculation_Module.extract_lagged_data_and_calculate_cov(
+        -4, {'w_prime': w_prime, 'c_prime': c_prime}, 10)
+    assert previous_flux_mean == pytest.approx(np.cov(w_prime[:-4][:3000], c_prime[4:][:3000])[0, 1])
+    assert steady_state == 0
+
+
+# ==========================================================================================
+# Online calculation
+# ==========================================================================================
+def records(data):
+    """Combined samples as OpenFlux hands them to the accumulator"""
+    return data.rename(columns={'TIMESTAMP': 'time'}).to_dict('records')
+
+
+def test_online_flux_matches_run_data_calculation(half_hour, result_dir):
+    online = Data_Calculation_Module.FluxAccumulator()
+    for record in records(half_hour):
+        online.add_sample(record)
+    result, cross_cov_results = online.finish()
+    assert online.count == 0
+
+    half_hour.to_csv(result_dir.parent / "OpenFLux_data" / "20240101_0000.txt", index=False)
+    Data_Calculation_Module.run_data_calculation("20240101_0000.txt")
+    with Results_Store_Module.ResultsStore(Results_Store_Module.store_path(str(result_dir))) as store:
+        reference = store.query().iloc[0]
+    for key, value in result.items():
+        if key == 'spectra':
+            continue
+        if isinstance(value, str):
+            assert value == reference[key], key
+        else:
+            assert value == pytest.approx(reference[key], rel=1e-9, abs=1e-12), key
+    assert np.argmax(np.abs(cross_cov_results)) - Data_Calculation_Module.MAX_LAG == -3
+
+
+def test_online_flux_needs_more_samples_than_the_lag_window(half_hour):
+    online = Data_Calculation_Module.FluxAccumulator()
+    for record in records(half_hour.iloc[:2 * Data_Calculation_Module.MAX_LAG + 1]):
+        online.add_sample(record)
+    online.add_sample({'time': "2024-01-01 00:00:02.10", 'u_axis_speed': None})
+    assert online.finish() is None
+
+
+def online_and_file(data, directory):
+    """
+    Result of the online calculation and of calculate_flux for the same samples
+    :return: (online result or None, file result)
+    """
+    online = Data_Calculation_Module.FluxAccumulator()
+    for record in records(data):
+        online.add_sample(record)
+    path = directory / "20240101_0000.txt"
+    data.to_csv(path, index=False)
+    return online.finish(), Data_Calculation_Module.calculate_flux(str(path))
+
+
+def assert_same_result(online, reference):
+    for key, value in online.items():
+        if key == 'spectra':
+            continue
+        if isinstance(value, float):
+            assert value == pytest.approx(reference[key], rel=1e-9, abs=1e-12), key
+        else:
+            assert value == reference[key], key
+
+
+def add_spikes(data, columns, count, seed=1):
+    rng = np.random.default_rng(seed)
+    for column in columns:
+        rows = rng.choice(len(data), count, replace=False)
+        data.loc[data.index[rows], column] += 50 * data[column].std()
+    return data
+
+
+# A period of whole despiking blocks and one that ends in a partial block
+@pytest.mark.parametrize("samples", [SAMPLES, 16500])
+def test_online_flux_is_despiked_like_calculate_flux(half_hour, tmp_path, samples):
+    data = add_spikes(half_hour.iloc[:samples].copy(), ['w_axis_speed', 'real_time_concentration'], 20)
+    (online, online_curve), (reference, reference_curve) = online_and_file(data, tmp_path)
+    assert_same_result(online, reference)
+    np.testing.assert_allclose(online_curve, reference_curve, rtol=1e-9, atol=1e-15)
+    assert online['spikes_w'] == 20
+    assert online['spike_flag'] == 0
+    for key in ('power', 'cospectra'):
+        np.testing.assert_allclose(online['spectra'][key], reference['spectra'][key], rtol=1e-9)
+    assert online['spectra']['stability'] == reference['spectra']['stability']
+
+
+def test_online_flux_matches_calculate_flux_with_spikes_gaps_and_duplicates(half_hour, tmp_path):
+    data = add_spikes(half_hour, ['w_axis_speed', 'real_time_concentration'], 20)
+    rng = np.random.default_rng(2)
+    dropped = list(rng.choice(np.arange(100, 17000), 40, replace=False)) + list(range(5000, 5020))
+    data = data.drop(index=dropped)
+    data = pd.concat([data, data.iloc[[300, 301]]]).sort_index(kind='stable').reset_index(drop=True)
+
+    (online, _), (reference, _) = online_and_file(data, tmp_path)
+    assert_same_result(online, reference)
+    assert online['spikes_w'] == 20
+    assert online['filled_samples'] == 60
+    assert online['duplicate_samples'] == 2
+    assert online['longest_gap'] == 2.0
+
+
+def test_online_flux_rejects_a_long_gap_like_calculate_flux(half_hour, tmp_path):
+    data = half_hour.drop(index=range(9000, 9100))
+    online = Data_Calculation_Module.FluxAccumulator()
+    for record in records(data):
+        online.add_sample(record)
+    assert online.finish() is None
+    path = tmp_path / "20240101_0000.txt"
+    data.to_csv(path, index=False)
+    with pytest.raises(Data_Calculation_Module.PeriodRejected):
+        Data_Calculation_Module.calculate_flux(str(path))
+
+
+def test_rolling_windows_match_direct_windows(turbulence, result_dir):
+    rolling = Data_Calculation_Module.RollingFluxAccumulator()
+    windows = []
+    for record in records(turbulence):
+        windows += rolling.add_sample(record)
+    windows += rolling.finish()
+    results = {result['TIMESTAMP']: result for result, _ in windows}
+    # A window every 5 minutes from the first full half hour on, the last one completed by finish
+    assert list(results) == [f"2024-01-01 00:{minute:02d}:00.00" for minute in range(0, 35, 5)]
+
+    for start, tolerance in ((0, 1e-9), (SAMPLES, 2e-3)):
+        direct = Data_Calculation_Module.FluxAccumulator()
+        for record in records(turbulence.iloc[start:start + SAMPLES]):
+            direct.add_sample(record)
+        expected, _ = direct.finish()
+        window = results[expected['TIMESTAMP']]
+        # The pairs at the edges of a later window use the samples next to it
+        for key in ('flux', 'sonic_temp_flux', 'u_mean', 'friction_velocity', 'concentration_mean'):
+            assert window[key] == pytest.approx(expected[key], rel=tolerance), key
+        assert window['lag'] == expected['lag']
+
+    # The overlapping windows are stored by their start, none replaces another
+    for result, cross_cov_results in windows:
+        Data_Calculation_Module.save_flux_results(result, cross_cov_results, Data_Calculation_Module.rolling_flux_dir,
+                                                  update_fit=False, period=Data_Calculation_Module.ROLLING_FLUX_STEP)
+    with Results_Store_Module.ResultsStore(
+            Results_Store_Module.store_path(Data_Calculation_Module.rolling_flux_dir)) as store:
+        assert store.timestamps() == list(results)
+
+
+# ==========================================================================================
+# Alignment to the sampling grid
+# ==========================================================================================
+def grid_samples(count=SAMPLES):
+    """Samples exactly on the 10 Hz grid of one period, the value of a sample is its grid index"""
+    milliseconds = PERIOD_ORIGIN + np.arange(count) * 100
+    return milliseconds, np.arange(count, dtype=np.float64)[:, None]
+
+
+def test_align_to_grid_keeps_a_complete_period():
+    milliseconds, values = grid_samples()
+    aligned, first, quality = Data_Calculation_Module.align_to_grid(milliseconds, values, 10)
+    np.testing.assert_array_equal(aligned, values)
+    assert first == 0
+    assert quality == {'coverage': 100.0, 'longest_gap': 0.0, 'filled_samples': 0, 'duplicate_samples': 0,
+                       'rejected': False}
+
+
+def test_align_to_grid_interpolates_gaps_and_reports_coverage():
+    milliseconds, values = grid_samples()
+    kept = np.ones(SAMPLES, dtype=bool)
+    kept[1000:1010] = False
+    kept[5000:5030] = False
+    # Timestamps a few milliseconds off the grid go to the nearest grid point (the first one stays in the period)
+    jitter = np.where(np.arange(SAMPLES) % 2, -3, 4)
+    aligned, _, quality = Data_Calculation_Module.align_to_grid((milliseconds + jitter)[kept], values[kept], 10)
+    np.testing.assert_allclose(aligned, values)
+    assert quality['filled_samples'] == 40
+    assert quality['longest_gap'] == 3.0
+    assert quality['coverage'] == round(100 * (SAMPLES - 40) / SAMPLES, 2)
+    assert not quality['rejected']
+
+
+def test_align_to_grid_sorts_and_drops_duplicates():
+    milliseconds, values = grid_samples(100)
+    order = np.r_[np.arange(50, 100), np.arange(50), [10, 20]]
+    aligned, first, quality = Data_Calculation_Module.align_to_grid(milliseconds[order], values[order], 10)
+    np.testing.assert_array_equal(aligned, values)
+    assert order[first] == 0
+    assert quality['duplicate_samples'] == 2
+
+
+@pytest.mark.parametrize("missing, reason", [(slice(9000, 9100), 'longest_gap'), (slice(0, 2000), 'coverage')])
+def test_align_to_grid_rejects_long_gaps_and_low_coverage(missing, reason):
+    milliseconds, values = grid_samples()
+    kept = np.ones(SAMPLES, dtype=bool)
+    kept[missing] = False
+    _, _, quality = Data_Calculation_Module.align_to_grid(milliseconds[kept], values[kept], 10,
+                                                          max_gap=timedelta(seconds=5))
+    assert quality['rejected']
+    if reason == 'longest_gap':
+        assert quality['longest_gap'] > 5
+    else:
+        assert quality['coverage'] < Data_Calculation_Module.ALIGN_MIN_COVERAGE
+
+
+# ==========================================================================================
+# Binary raw data
+# ==========================================================================================
+def test_timestamp_milliseconds_round_trip():
+    milliseconds = Data_Calculation_Module.timestamp_to_milliseconds("2024-01-01 00:30:00.10")
+    assert milliseconds % 1000 == 100
+    assert Data_Calculation_Module.format_timestamp(milliseconds) == "2024-01-01 00:30:00.10"
+
+
+def test_text_binary_round_trip(half_hour, tmp_path):
+    text_path = tmp_path / "20240101_0000.txt"
+    half_hour.iloc[:100].to_csv(text_path, index=False)
+    binary_path = Data_Calculation_Module.convert_text_to_binary(str(text_path))
+    assert binary_path == str(tmp_path / "20240101_0000.bin")
+    records = Data_Calculation_Module.read_binary_data(binary_path)
+    np.testing.assert_array_equal(records['w_axis_speed'], pd.read_csv(text_path)['w_axis_speed'])
+
+    copy_path = Data_Calculation_Module.convert_binary_to_text(binary_path, str(tmp_path / "copy.txt"))
+    pd.testing.assert_frame_equal(pd.read_csv(copy_path), pd.read_csv(text_path))
+
+
+def test_binary_reader_ignores_an_incomplete_record(tmp_path):
+    columns = ['real_time_concentration', 'w_axis_speed']
+    dtype = Data_Calculation_Module.binary_record_dtype(columns)
+    path = tmp_path / "20240101_0000.bin"
+    with open(path, 'wb') as file:
+        file.write(Data_Calculation_Module.binary_file_header(columns, 10))
+        file.write(Data_Calculation_Module.encode_binary_record(
+            {'time': "2024-01-01 00:00:00.00", 'real_time_concentration': 32.0, 'w_axis_speed': None}, dtype))
+        file.write(Data_Calculation_Module.encode_binary_record(
+            {'time': "2024-01-01 00:00:00.10", 'real_time_concentration': 33.0, 'w_axis_speed': 0.5}, dtype)[:-3])
+    assert Data_Calculation_Module.read_binary_header(str(path))[:2] == (dtype, 10)
+    records = Data_Calculation_Module.read_binary_data(str(path))
+    assert len(records) == 1 and records['real_time_concentration'][0] == 32.0
+    assert np.isnan(records['w_axis_speed'][0])
+
+
+def test_read_raw_arrays_reads_chunks_like_pandas(half_hour, tmp_path):
+    columns = ['w_axis_speed', 'real_time_concentration']
+    raw = half_hour.iloc[:250].copy()
+    # A missing value in a used column drops the row, in an unused one (transmittance) it does not
+    raw.loc[10, 'w_axis_speed'] = np.nan
+    raw.loc[20, 'transmittance'] = np.nan
+    path = tmp_path / "20240101_0000.txt"
+    raw.to_csv(path, index=False)
+    milliseconds, values = Data_Calculation_Module.read_raw_arrays([str(path)], columns, chunk_rows=64)
+    expected = pd.read_csv(path).drop(index=10)
+    np.testing.assert_array_equal(values, expected[columns].to_numpy())
+    assert Data_Calculation_Module.format_timestamp(milliseconds[20 - 1]) == expected['TIMESTAMP'].iloc[19]
+
+    # A value that is not a number is read as NaN, like the old per-column coercion
+    lines = path.read_text().splitlines()
+    items = lines[31].split(",")
+    items[raw.columns.get_loc('w_axis_speed')] = "garbage"
+    lines[31] = ",".join(items)
+    path.write_text("\n".join(lines) + "\n")
+    _, coerced = Data_Calculation_Module.read_raw_arrays([str(path)], columns, chunk_rows=64)
+    assert np.isnan(coerced[29, 0])
+    np.testing.assert_array_equal(np.delete(coerced, 29, axis=0), np.delete(values, 29, axis=0))
+
+
+def test_calculate_flux_reads_binary_files(half_hour, tmp_path):
+    text_path = tmp_path / "20240101_0000.txt"
+    half_hour.to_csv(text_path, index=False)
+    binary_path = Data_Calculation_Module.convert_text_to_binary(str(text_path))
+    text_result, text_curve = Data_Calculation_Module.calculate_flux(str(text_path))
+    binary_result, binary_curve = Data_Calculation_Module.calculate_flux(binary_path)
+    binary_spectra, text_spectra = binary_result.pop('spectra'), text_result.pop('spectra')
+    assert binary_result == text_result
+    np.testing.assert_array_equal(binary_curve, text_curve)
+    np.testing.assert_array_equal(binary_spectra['cospectra'], text_spectra['cospectra'])
+
+
+# ==========================================================================================
+# Despiking
+# ==========================================================================================
+def test_spike_mask_flags_spikes_and_nan():
+    rng = np.random.default_rng(0)
+    values = rng.standard_normal((6000, 2))
+    values[[100, 4000], 0] += 50
+    values[2500, 1] = np.nan
+    replaced = Data_Calculation_Module.spike_mask(values, 3000)
+    assert np.flatnonzero(replaced[:, 0]).tolist() == [100, 4000]
+    assert np.flatnonzero(replaced[:, 1]).tolist() == [2500]
+
+
+def test_spike_mask_ignores_a_constant_block():
+    values = np.full((100, 1), 3.0)
+    values[50] = 4.0
+    # The MAD of the block is 0, so no sample is a spike
+    assert not Data_Calculation_Module.spike_mask(values, 100).any()
+
+
+def test_despike_interpolates_and_counts():
+    values = np.tile(np.arange(100, dtype=np.float64)[:, None], (1, 2))
+    values += np.random.default_rng(0).normal(0, 0.01, values.shape)
+    original = values.copy()
+    values[40, 0] = 1000.0
+    despiked, counts = Data_Calculation_Module.despike(values, 100)
+    assert counts.tolist() == [1, 0]
+    assert despiked[40, 0] == pytest.approx((original[39, 0] + original[41, 0]) / 2)
+    assert values[40, 0] == 1000.0  # A copy unless in_place
+    despiked, _ = Data_Calculation_Module.despike(values, 100, in_place=True)
+    assert despiked is values and values[40, 0] == pytest.approx((original[39, 0] + original[41, 0]) / 2)
+
+
+@pytest.mark.parametrize("count, flag", [(0, 0), (10, 0), (11, 1), (50, 1), (51, 2)])
+def test_spike_quality_flag(count, flag):
+    quality = Data_Calculation_Module.spike_quality(['u', 'w'], [0, count], 1000)
+    assert quality == {'spikes_u': 0, 'spikes_w': count, 'spike_flag': flag}
+
+
+def test_new_result_columns_rewrite_ec_flux_exactly(tmp_path, monkeypatch):
+    monkeypatch.setattr(Data_Calculation_Module, "RESULTS_FORMAT", "csv")
+    Data_Calculation_Module.save_flux_results({'TIMESTAMP': "2024-01-01 00:00:00.00", 'flux': 0.1 + 0.2}, [1.0],
+                                              str(tmp_path))
+    Data_Calculation_Module.save_flux_results({'TIMESTAMP': "2024-01-01 00:30:00.00", 'flux': 1 / 3,
+                                               'spike_flag': 1}, [1.0], str(tmp_path))
+    results = pd.read_csv(tmp_path / "EC_FLUX.csv", float_precision='round_trip')
+    assert results.columns.tolist() == ['TIMESTAMP', 'flux', 'spike_flag']
+    assert results['flux'].tolist() == [0.1 + 0.2, 1 / 3]
+
+
+# ==========================================================================================
+# Planar fit
+# ==========================================================================================
+def mean_winds(count, seed=0):
+    """Period mean winds on the tilted plane w = 0.02 + 0.05 u - 0.03 v, half hourly from 2024-01-01"""
+    rng = np.random.default_rng(seed)
+    u, v = rng.uniform(-4, 4, count), rng.uniform(-4, 4, count)
+    timestamps = pd.date_range("2024-01-01", periods=count, freq="30min").strftime("%Y-%m-%d %H:%M:%S.00")
+    return [{'TIMESTAMP': timestamp, 'u_mean': u_mean, 'v_mean': v_mean, 'w_mean': 0.02 + 0.05 * u_mean - 0.03 * v_mean}
+            for timestamp, u_mean, v_mean in zip(timestamps, u, v)]
+
+
+def test_planar_fit_finds_the_tilt_plane(tmp_path):
+    for result_data in mean_winds(60):
+        planar_fit = Data_Calculation_Module.update_planar_fit(result_data, str(tmp_path))
+    np.testing.assert_allclose(planar_fit.coefficients, [0.02, 0.05, -0.03], atol=1e-12)
+    # The rotated w of any period on the plane has no mean
+    rotation = planar_fit.rotation_matrix(3.0, 1.0, 0.02 + 0.15 - 0.03)
+    assert (rotation @ [3.0, 1.0, 0.15 - 0.03])[2] == pytest.approx(0, abs=1e-12)
+    assert Data_Calculation_Module.load_planar_fit(str(tmp_path)).count == 60
+
+
+def test_planar_fit_replaces_a_rerun_period():
+    planar_fit = Data_Calculation_Module.PlanarFit()
+    periods = mean_winds(3)
+    for result_data in periods:
+        planar_fit.add_period(*result_data.values())
+    sums = planar_fit.sums.copy()
+    planar_fit.add_period(periods[1]['TIMESTAMP'], 9.0, 9.0, 9.0)
+    planar_fit.add_period(*periods[1].values())
+    np.testing.assert_allclose(planar_fit.sums, sums, atol=1e-12)
+    assert planar_fit.count == 3 and planar_fit.last_period == periods[2]['TIMESTAMP']
+    # A rerun below the minimum wind leaves the fit
+    planar_fit.add_period(periods[0]['TIMESTAMP'], 0.1, 0.1, 0.0)
+    assert planar_fit.count == 2 and periods[0]['TIMESTAMP'] not in planar_fit.periods
+
+
+def test_concurrent_planar_fit_updates_are_all_kept(tmp_path):
+    periods = mean_winds(80)
+    with ProcessPoolExecutor(4) as executor:
+        list(executor.map(Data_Calculation_Module.update_planar_fit, periods, [str(tmp_path)] * len(periods)))
+    assert Data_Calculation_Module.load_planar_fit(str(tmp_path)).count == 80
+
+
+# ==========================================================================================
+# Lag history
+# ==========================================================================================
+def detected_lags(count, lag, day=1):
+    """EC_FLUX.csv rows with a detected lag of the concentration and the fixed lag of the sonic temperature"""
+    return [{'TIMESTAMP': f"2024-01-{day:02d} {i // 2:02d}:{i % 2 * 30:02d}:00.00", 'concentration_mean': 2.0,
+             'lag': lag, 'lag_source': "detected", 'sonic_temp_mean': 21.0, 'sonic_temp_lag': 0.0,
+             'sonic_temp_lag_source': "fixed"} for i in range(count)]
+
+
+def test_lag_history_narrows_the_search_to_the_median():
+    history = Data_Calculation_Module.LagHistory()
+    for result_data in detected_lags(Data_Calculation_Module.LAG_HISTORY_MIN_PERIODS - 1, -0.3):
+        history.add_period(result_data['TIMESTAMP'], 'concentration', result_data['lag'])
+    low, high, default = Data_Calculation_Module.lag_search_windows(lag_history=history)
+    assert (low.tolist(), high.tolist(), default.tolist()) == ([-10, 0], [10, 0], [0, 0])
+
+    history.add_period("2024-01-02 00:00:00.00", 'concentration', -0.5)
+    assert history.expected_lag('concentration') == -0.3
+    low, high, default = Data_Calculation_Module.lag_search_windows(lag_history=history)
+    assert (low.tolist(), high.tolist(), default.tolist()) == ([-6, 0], [0, 0], [-3, 0])
+    # A rerun period replaces its lag
+    history.add_period("2024-01-02 00:00:00.00", 'concentration', -0.3)
+    assert len(history.lags['concentration']) == Data_Calculation_Module.LAG_HISTORY_MIN_PERIODS
+    assert 'sonic_temp' not in history.lags
+
+
+def test_weak_peak_takes_the_default_lag():
+    lags = np.arange(-10, 11)
+    cross_covariance = np.column_stack((np.exp(-(lags + 3.0) ** 2), np.exp(-lags ** 2.0)))
+    _, lag, _, lag_source = Data_Calculation_Module.scalar_lags(cross_covariance)
+    assert lag.tolist() == [-3, 0] and lag_source.tolist() == ["detected", "fixed"]
+    # The same peak below LAG_PEAK_MIN_SNR standard errors
+    _, lag, _, lag_source = Data_Calculation_Module.scalar_lags(cross_covariance, noise=[1.0, 1.0])
+    assert lag.tolist() == [0, 0] and lag_source.tolist() == ["default", "fixed"]
+
+
+def test_calculate_flux_searches_the_lag_history_of_its_result_folder(half_hour, tmp_path):
+    path = tmp_path / "20240101_0000.txt"
+    half_hour.to_csv(path, index=False)
+    result, _ = Data_Calculation_Module.calculate_flux(str(path), output_dir=str(tmp_path))
+    assert (result['lag'], result['lag_source'], result['sonic_temp_lag_source']) == (-0.3, "detected", "fixed")
+
+    # A site whose history expects 0.5 s only searches 0.2 s to 0.8 s, the red noise peaks at the window edge
+    site_dir = tmp_path / "site"
+    site_dir.mkdir()
+    for result_data in detected_lags(Data_Calculation_Module.LAG_HISTORY_MIN_PERIODS, 0.5, day=2):
+        Data_Calculation_Module.update_lag_history(result_data, str(site_dir))
+    result, _ = Data_Calculation_Module.calculate_flux(str(path), output_dir=str(site_dir))
+    assert (result['lag'], result['lag_source']) == (0.2, "detected")
+    online = Data_Calculation_Module.FluxAccumulator(output_dir=str(site_dir))
+    for record in records(half_hour):
+        online.add_sample(record)
+    assert online.finish()[0]['lag'] == 0.2
+
+
+def test_concurrent_lag_history_updates_are_all_kept(tmp_path):
+    periods = detected_lags(48, -0.3)
+    with ProcessPoolExecutor(4) as executor:
+        list(executor.map(Data_Calculation_Module.update_lag_history, periods, [str(tmp_path)] * len(periods)))
+    assert len(Data_Calculation_Module.load_lag_history(str(tmp_path)).lags['concentration']) == 48
+
+
+# ==========================================================================================
+# Spectra
+# ==========================================================================================
+def test_spectra_of_a_rerun_period_replace_the_earlier_ones(half_hour, tmp_path):
+    path = tmp_path / "20240101_0000.txt"
+    half_hour.to_csv(path, index=False)
+    result, _ = Data_Calculation_Module.calculate_flux(str(path))
+    for _ in range(2):
+        Data_Calculation_Module.save_flux_results(dict(result), [0.0], str(tmp_path))
+    averages = Data_Calculation_Module.load_spectra_averages(output_dir=str(tmp_path))
+    assert averages.counts.sum() == 1
+    with np.load(Spectral_Module.daily_spectra_path(str(tmp_path), result['TIMESTAMP'])) as stored:
+        assert list(stored['timestamps']) == [result['TIMESTAMP']]
+
+
+# ==========================================================================================
+# Stationarity
+# ==========================================================================================
+def test_block_moments_match_np_cov_per_block_and_period():
+    w_prime, c_prime = lagged_series(n=3100)
+    moments = Stationarity_Module.block_moments(w_prime, c_prime, 500)
+    # The last block also takes the 100 rows after six full blocks
+    assert moments['count'][:, 0].tolist() == [500] * 5 + [600]
+    for block, start in enumerate(range(0, 3000, 500)):
+        stop = start + 500 if block < 5 else None
+        np.testing.assert_allclose(moments['comoment'][block, 0] / (moments['count'][block, 0] - 1),
+                                   np.cov(w_prime[start:stop], c_prime[start:stop])[0, 1])
+    period = Stationarity_Module.combine_moments(moments)
+    np.testing.assert_allclose(period['comoment'][0] / (period['count'][0] - 1), np.cov(w_prime, c_prime)[0, 1])
+
+
+def test_steady_state_test_flags_opposite_trends():
+    w_prime, c_prime = lagged_series(n=3004)
+    # c follows w by 4 samples, paired at that lag
+    w_prime, c_prime = w_prime[:-4], c_prime[4:]
+    steady = Stationarity_Module.steady_state_test(Stationarity_Module.block_moments(w_prime, c_prime, 500))
+    assert steady['steady_state'][0] == 0
+    assert Stationarity_Module.flag_string(steady['block_flags'][:, 0]) == "000000"
+    # Opposite trends cancel most of the period covariance but hardly change that of the blocks
+    trend = np.linspace(-1.0, 1.0, 3000)
+    unsteady = Stationarity_Module.steady_state_test(
+        Stationarity_Module.block_moments(w_prime + trend, c_prime - trend, 500))
+    assert unsteady['steady_state'][0] == 2
+    assert Stationarity_Module.flag_string(unsteady['block_flags'][:, 0]) == "222222"
+
+
+# ==========================================================================================
+# Import
+# ==========================================================================================
+def test_import_changes_nothing_and_loads_no_pandas(tmp_path):
+    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    code = ("import sys; sys.path.insert(0, sys.argv[1]); import Data_Calculation_Module, Calculation_Worker_Module, "
+            "Batch_Processing_Module; print('pandas' in sys.modules)")
+    output = subprocess.run([sys.executable, "-c", code, project_dir], cwd=tmp_path, capture_output=True, text=True,
+                            check=True).stdout
+    assert output == "False\n"
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_configure_paths_creates_the_result_folder(tmp_path, monkeypatch):
+    for name in ("BASE_DIR", "raw_data_dir", "ec_flux_dir", "rolling_flux_dir"):
+        monkeypatch.setattr(Data_Calculation_Module, name, getattr(Data_Calculation_Module, name))
+    assert Data_Calculation_Module.configure_paths(str(tmp_path)) == str(tmp_path / "EC_FLUX")
+    assert (tmp_path / "EC_FLUX").is_dir()
+    assert Data_Calculation_Module.rolling_flux_dir == str(tmp_path / "EC_FLUX" / "rolling")
+    Data_Calculation_Module.configure_paths(result_dir=str(tmp_path / "site"))
+    assert Data_Calculation_Module.raw_data_dir == str(tmp_path / "RawData") and (tmp_path / "site").is_dir()
@@ -0,0 +1,117 @@
+import os
+
+import numpy as np
+import pytest
+
+import Data_Calculation_Module
+import Ingest_Module
+
+COLUMNS = ['real_time_concentration', 'w_axis_speed']
+DTYPE = Data_Calculation_Module.binary_record_dtype(COLUMNS)
+HEADER_SIZE = len(Data_Calculation_Module.binary_file_header(COLUMNS, 10))
+FIRST_PERIOD = Data_Calculation_Module.timestamp_to_milliseconds("2024-01-01 00:00:00.00")
+PERIOD_LENGTH = 30 * 60 * 1000  # unit:ms
+
+
+def batch(first_sample, count, period=FIRST_PERIOD):
+    """count 10 Hz records from sample first_sample of the period on"""
+    records = np.zeros(count, dtype=DTYPE)
+    records['TIMESTAMP'] = period + (first_sample + np.arange(count)) * 100
+    records['w_axis_speed'] = first_sample + np.arange(count)
+    return records
+
+
+@pytest.fixture
+def stream(tmp_path):
+    site = Ingest_Module.SiteStream("site", str(tmp_path / "data"), str(tmp_path / "results"))
+    site.configure(DTYPE, 10)
+    return site
+
+
+def stored(stream, period=FIRST_PERIOD):
+    """Records in the raw data file of a period"""
+    stream.close()
+    with open(stream.period_path(period), 'rb') as file:
+        return np.frombuffer(file.read()[HEADER_SIZE:], dtype=DTYPE)
+
+
+def test_write_appends_batches_to_the_period_file(stream):
+    assert stream.write(0, batch(0, 10)) == []
+    assert stream.write(10, batch(10, 5)) == []
+    np.testing.assert_array_equal(stored(stream)['w_axis_speed'], np.arange(15))
+    assert stream.last_sequence == 14
+    assert stream.period == FIRST_PERIOD
+
+
+def test_a_resent_batch_is_skipped(stream):
+    stream.write(0, batch(0, 10))
+    # The acknowledgement was lost, the logger sends the last batch again with one new sample
+    stream.write(5, batch(5, 6))
+    stream.write(0, batch(0, 10))
+    np.testing.assert_array_equal(stored(stream)['w_axis_speed'], np.arange(11))
+    assert stream.last_sequence == 10
+
+
+def test_a_missing_sequence_is_written_after_the_gap(stream):
+    stream.write(0, batch(0, 10))
+    stream.write(20, batch(20, 10))
+    np.testing.assert_array_equal(stored(stream)['w_axis_speed'], np.r_[np.arange(10), np.arange(20, 30)])
+    assert stream.last_sequence == 29
+
+
+def test_the_next_period_closes_the_file(stream):
+    stream.write(0, batch(17990, 10))
+    closed = stream.write(10, batch(0, 3, FIRST_PERIOD + PERIOD_LENGTH))
+    assert closed == [stream.period_path(FIRST_PERIOD)]
+    assert len(stored(stream)) == 10
+    assert len(stored(stream, FIRST_PERIOD + PERIOD_LENGTH)) == 3
+
+
+def test_out_of_order_samples_of_a_closed_period_are_dropped(stream):
+    second_period = FIRST_PERIOD + PERIOD_LENGTH
+    # A wall clock step back in the middle of a batch: the samples after it belong to the closed period
+    records = np.concatenate((batch(17998, 2), batch(0, 2, second_period), batch(17999, 1), batch(2, 1, second_period)))
+    closed = stream.write(0, records)
+    assert closed == [stream.period_path(FIRST_PERIOD)]
+    assert len(stored(stream)) == 2
+    np.testing.assert_array_equal(stored(stream, second_period)['w_axis_speed'], [0, 1, 2])
+    assert stream.last_sequence == 5
+
+
+def test_a_late_only_batch_is_acknowledged_without_writing(stream):
+    second_period = FIRST_PERIOD + PERIOD_LENGTH
+    stream.write(0, batch(0, 2, second_period))
+    size = os.path.getsize(stream.period_path(second_period))
+    assert stream.write(2, batch(17990, 5)) == []
+    assert stream.last_sequence == 6
+    assert stream.period == second_period
+    assert os.path.getsize(stream.period_path(second_period)) == size
+    assert not os.path.exists(stream.period_path(FIRST_PERIOD))
+
+
+def test_a_restarted_stream_continues_the_open_period(stream, tmp_path):
+    stream.write(0, batch(0, 10))
+    stream.close()
+    restarted = Ingest_Module.SiteStream("site", str(tmp_path / "data"), str(tmp_path / "results"))
+    assert restarted.last_sequence == 9
+    assert restarted.period == FIRST_PERIOD
+    assert restarted.configure(DTYPE, 10) is None
+    restarted.write(10, batch(10, 5))
+    np.testing.assert_array_equal(stored(restarted)['w_axis_speed'], np.arange(15))
+
+
+def test_acknowledged_spool_files_are_deleted(tmp_path, monkeypatch):
+    monkeypatch.setattr(Ingest_Module, "SPOOL_SEGMENT_SAMPLES", 10)
+    client = Ingest_Module.IngestClient("localhost", 0, "site", COLUMNS, 10, spool_dir=str(tmp_path / "spool"))
+    for i in range(25):
+        client.add_sample({'time': "2024-01-01 00:00:00.00", 'real_time_concentration': 1.0, 'w_axis_speed': i})
+    client._spool_queued()
+    assert client.spooled() == 25
+    assert len(os.listdir(tmp_path / "spool")) == 3
+
+    client._acknowledge(14)
+    assert client.spooled() == 10
+    # The file of samples 10 to 19 still holds unacknowledged samples
+    assert len([name for name in os.listdir(tmp_path / "spool") if name.endswith(".bin")]) == 2
+    restarted = Ingest_Module.IngestClient("localhost", 0, "site", COLUMNS, 10, spool_dir=str(tmp_path / "spool"))
+    assert (restarted.acknowledged, restarted.next_sequence) == (14, 25)
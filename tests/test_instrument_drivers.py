@@ -0,0 +1,98 @@
+import json
+import os
+import struct
+
+import pytest
+
+import Instrument_Driver_Module
+
+
+@pytest.fixture(autouse=True)
+def drivers(monkeypatch):
+    """Drivers registered by a test are dropped after it"""
+    monkeypatch.setattr(Instrument_Driver_Module, "DRIVERS", dict(Instrument_Driver_Module.DRIVERS))
+
+
+def ht8x00_frame(fields=19):
+    items = [str(i) for i in range(fields)]
+    items[2], items[7], items[9] = "2.0345", "21.5", "93.25"
+    return ",".join(items).encode('ascii') + b'\r'
+
+
+def test_ht8x00_frame():
+    driver = Instrument_Driver_Module.get_driver("HT8x00")
+    assert driver.fields == ["real_time_concentration", "ambient_temperature", "transmittance"]
+    assert driver.parse(ht8x00_frame()) == (2.0345, 21.5, 93.25)
+    # More fields than the minimum are accepted
+    assert driver.parse(ht8x00_frame(21)) == (2.0345, 21.5, 93.25)
+
+
+@pytest.mark.parametrize("frame", [ht8x00_frame(18), ht8x00_frame().replace(b"21.5", b"n/a"), b"\r", b""])
+def test_invalid_ht8x00_frames(frame):
+    assert Instrument_Driver_Module.get_driver("HT8x00").parse(frame) is None
+
+
+def test_anemometer_frame():
+    driver = Instrument_Driver_Module.get_driver("anemometer")
+    frame = b'\x02Q,+001.25,-000.50,+000.03,M,+343.21,+021.40,00,\x03'
+    assert driver.parse(frame) == (1.25, -0.5, 0.03, 21.4)
+    # A frame without the start byte is rejected
+    assert driver.parse(frame[1:]) is None
+
+
+@pytest.mark.parametrize("name, values", [("HT8x00", (2.0345, 21.5, 93.25)),
+                                          ("anemometer", (1.25, -0.5, 0.03, 21.4))])
+def test_csv_encode_round_trip(name, values):
+    driver = Instrument_Driver_Module.get_driver(name)
+    frame = driver.encode(values)
+    assert frame.endswith(driver.end_byte)
+    assert driver.parse(frame) == values
+
+
+def test_struct_driver():
+    driver = Instrument_Driver_Module.StructDriver("binary", "<hhhH", ["u", None, "w", "status"])
+    assert driver.fields == ["u", "w", "status"]
+    frame = driver.encode((-12.4, 7.6, 3))
+    # Integer items are rounded, items that are not parsed are written as 0
+    assert frame == b'\x02' + struct.pack("<hhhH", -12, 0, 8, 3) + b'\x03'
+    assert driver.parse(frame) == (-12.0, 8.0, 3.0)
+    assert driver.parse(frame[:-2]) is None
+
+
+def test_driver_from_config():
+    driver = Instrument_Driver_Module.driver_from_config("logger", {
+        "type": "csv", "fields": {"co2": 1, "h2o": 3}, "min_fields": 4, "start_byte": "\u0002",
+        "end_byte": "\n", "nominal_rate": 20})
+    assert (driver.start_byte, driver.end_byte, driver.nominal_rate) == (b'\x02', b'\n', 20)
+    assert driver.parse(b'\x02A,400.5,x,12.25\n') == (400.5, 12.25)
+    with pytest.raises(ValueError):
+        Instrument_Driver_Module.driver_from_config("logger", {"type": "xml"})
+
+
+def test_load_instrument_config(tmp_path):
+    config_path = tmp_path / "instruments.json"
+    config_path.write_text(json.dumps({
+        "drivers": {"sonic": {"type": "struct", "format": "<fff", "fields": ["u", "v", "w"]}},
+        "instruments": [{"name": "wind", "driver": "sonic", "port": "/dev/ttyUSB0", "baudrate": 115200},
+                        {"name": "gas", "driver": "HT8x00", "rx_pin": 17, "tx_pin": 18, "baudrate": 38400}]}))
+    instruments = Instrument_Driver_Module.load_instrument_config(str(config_path))
+    assert [instrument["driver"].name for instrument in instruments] == ["sonic", "HT8x00"]
+    assert instruments[0]["port"] == "/dev/ttyUSB0" and instruments[1]["rx_pin"] == 17
+    assert Instrument_Driver_Module.get_driver("sonic").fields == ["u", "v", "w"]
+
+
+def test_load_instrument_config_defaults_and_unknown_driver(tmp_path):
+    instruments = Instrument_Driver_Module.load_instrument_config(str(tmp_path / "missing.json"))
+    assert [instrument["name"] for instrument in instruments] == ["HT8x00", "wind"]
+    # The soft UART pins of the Raspberry Pi
+    assert [(instrument["rx_pin"], instrument["tx_pin"]) for instrument in instruments] == [(19, 26), (25, 8)]
+    with pytest.raises(KeyError):
+        Instrument_Driver_Module.get_driver("unknown")
+
+
+def test_shipped_configuration_matches_the_defaults():
+    config_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "instruments.json")
+    instruments = Instrument_Driver_Module.load_instrument_config(config_path)
+    assert [{key: value for key, value in instrument.items() if key != "driver"} for instrument in instruments] == \
+        [{key: value for key, value in instrument.items() if key != "driver"}
+         for instrument in Instrument_Driver_Module.DEFAULT_INSTRUMENTS]
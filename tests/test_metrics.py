@@ -0,0 +1,47 @@
+import logging
+import threading
+
+import pytest
+
+import Metrics_Module
+
+
+@pytest.fixture(autouse=True)
+def metrics():
+    """Every test starts without recorded values"""
+    Metrics_Module.reset()
+    yield
+    Metrics_Module.reset()
+
+
+def test_render_counters_gauges_and_timings():
+    Metrics_Module.increment("frames_total", instrument="wind")
+    Metrics_Module.increment("frames_total", 2, instrument="wind")
+    Metrics_Module.set_gauge("queue_length", 4)
+    Metrics_Module.observe("flux_seconds", 0.5)
+    Metrics_Module.observe("flux_seconds", 1.5)
+    lines = Metrics_Module.render().splitlines()
+    assert 'openflux_frames_total{instrument="wind"} 3' in lines
+    assert "openflux_queue_length 4" in lines
+    assert "# TYPE openflux_flux_seconds summary" in lines
+    assert "openflux_flux_seconds_count 2" in lines
+    assert "openflux_flux_seconds_sum 2.000000" in lines
+    assert "openflux_flux_seconds_max 1.500000" in lines
+
+
+def test_metrics_file_is_written_when_stopped(tmp_path):
+    path = tmp_path / "openflux.prom"
+    Metrics_Module.increment("ticks_total")
+    stop_event = threading.Event()
+    thread = Metrics_Module.start_metrics_file(stop_event, str(path), interval=60)
+    stop_event.set()
+    thread.join(5)
+    assert "openflux_ticks_total 1" in path.read_text(encoding="utf-8").splitlines()
+
+
+def test_metrics_file_errors_are_logged(tmp_path, caplog):
+    stop_event = threading.Event()
+    stop_event.set()
+    with caplog.at_level(logging.ERROR):
+        Metrics_Module.start_metrics_file(stop_event, str(tmp_path / "missing" / "openflux.prom")).join(5)
+    assert "could not be written" in caplog.text
@@ -0,0 +1,120 @@
+import logging
+import threading
+
+import numpy as np
+
+import Metrics_Module
+import OpenFlux
+import Replay_Module
+
+
+def filled_buffer(frames, size=8):
+    """Ring buffer of size slots after frames appends, frame k is received at time k with value 10 * k"""
+    buffer = OpenFlux.InstrumentRingBuffer(["a", "b"], size)
+    for k in range(frames):
+        buffer.append(float(k), [10.0 * k, -10.0 * k])
+    return buffer
+
+
+def test_latest_frame():
+    assert filled_buffer(0).latest() is None
+    count, received, values = filled_buffer(13).latest()
+    assert (count, received) == (13, 12.0)
+    np.testing.assert_array_equal(values, [120.0, -120.0])
+
+
+def test_window_selects_the_frames_of_a_time_range():
+    rows = filled_buffer(5).window(1.0, 3.0)
+    np.testing.assert_array_equal(rows, [[2.0, 20.0, -20.0], [3.0, 30.0, -30.0]])
+    assert len(filled_buffer(5).window(4.0)) == 0
+
+
+def test_window_after_the_writer_wrapped_around():
+    buffer = filled_buffer(13)
+    # The oldest slot is the next one the writer takes, so size - 1 frames are readable, oldest first
+    np.testing.assert_array_equal(buffer.window(-1.0)[:, 0], np.arange(6, 13))
+    np.testing.assert_array_equal(buffer.window(9.5, 11.0)[:, 1], [100.0, 110.0])
+
+
+def test_window_rows_are_consistent_while_the_writer_runs():
+    buffer = OpenFlux.InstrumentRingBuffer(["a", "b"], 64)
+    stop = threading.Event()
+
+    def writer():
+        k = 0
+        while not stop.is_set():
+            buffer.append(float(k), [10.0 * k, -10.0 * k])
+            k += 1
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    try:
+        for _ in range(2000):
+            rows = buffer.window(-1.0)
+            np.testing.assert_array_equal(rows[:, 1], 10 * rows[:, 0])
+            np.testing.assert_array_equal(np.diff(rows[:, 0]), 1.0)
+    finally:
+        stop.set()
+        thread.join()
+
+
+def test_raw_writer_flushes_on_the_deadline_without_new_samples(tmp_path, monkeypatch):
+    clock = Replay_Module.VirtualClock(0.0)
+    monkeypatch.setattr(OpenFlux, "clock", clock)
+    writer = OpenFlux.RawDataWriter(flush_interval=5, buffer_size=1 << 20)
+    raw_file = tmp_path / "20240101_0000.txt"
+    writer.open(str(raw_file))
+    header_size = raw_file.stat().st_size
+    writer.write(dict({column: 1.0 for column in OpenFlux.raw_data_columns}, time="2024-01-01 00:00:00.00"))
+    clock.sleep(4.9)
+    writer.flush_if_due()
+    assert raw_file.stat().st_size == header_size
+    # The sensors went quiet, the next tick still writes the buffered sample out
+    clock.sleep(0.1)
+    writer.flush_if_due()
+    assert raw_file.read_text().splitlines()[1].startswith("2024-01-01 00:00:00.00,1.0")
+    writer.close()
+
+
+def test_late_tick_goes_to_the_file_of_its_frame_time(tmp_path, monkeypatch):
+    monkeypatch.setattr(OpenFlux, "ONLINE_FLUX_CALCULATION", False)
+    monkeypatch.setattr(OpenFlux, "calculation_queue_dir", str(tmp_path / "queue"))
+    monkeypatch.setattr(OpenFlux, "raw_writer", OpenFlux.RawDataWriter())
+    monkeypatch.setattr(OpenFlux, "file_path", str(tmp_path), raising=False)
+    monkeypatch.setattr(OpenFlux, "last_file_time", None, raising=False)
+    monkeypatch.setattr(OpenFlux, "current_file", None, raising=False)
+    # The wall clock is long past the frame times, as it is just past the boundary for a late tick
+    sample = {column: 1.0 for column in OpenFlux.raw_data_columns}
+    OpenFlux.save_data_to_local(dict(sample, time="2024-01-01 00:29:59.80"))
+    OpenFlux.save_data_to_local(dict(sample, time="2024-01-01 00:29:59.90"))
+    OpenFlux.save_data_to_local(dict(sample, time="2024-01-01 00:30:00.00"))
+    OpenFlux.raw_writer.close()
+    assert len((tmp_path / "20240101_0029.txt").read_text().splitlines()) == 3
+    assert (tmp_path / "20240101_0030.txt").read_text().splitlines()[1].startswith("2024-01-01 00:30:00.00")
+
+
+def test_sampler_realigns_after_a_wall_clock_step(monkeypatch, caplog):
+    clock = Replay_Module.VirtualClock(1704067200.0)
+    stop_event = threading.Event()
+    rows = []
+
+    def advance():
+        # The wall clock is set 10 s ahead after one second, the sampler stops after two
+        if clock.monotonic() >= 1.0 and clock.start == 1704067200.0:
+            clock.start += 10.0
+        if clock.monotonic() >= 2.0:
+            stop_event.set()
+
+    clock.add_advance_hook(advance)
+    monkeypatch.setattr(OpenFlux, "clock", clock)
+    monkeypatch.setattr(OpenFlux, "stop_event", stop_event)
+    monkeypatch.setattr(OpenFlux, "instrument_fields", {})
+    monkeypatch.setattr(OpenFlux, "ONLINE_FLUX_CALCULATION", False)
+    monkeypatch.setattr(OpenFlux, "save_data_to_local", rows.append)
+    Metrics_Module.reset()
+    with caplog.at_level(logging.WARNING):
+        OpenFlux.write_data()
+    assert "openflux_clock_realign_total 1" in Metrics_Module.render().splitlines()
+    assert "Wall clock moved by +10.000 s" in caplog.text
+    # The ticks after the step are stamped with the frames of the new wall clock
+    assert [row["time"][-5:] for row in rows[9:13]] == ["01.00", "01.10", "11.20", "11.30"]
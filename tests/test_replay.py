@@ -0,0 +1,26 @@
+import os
+
+import OpenFlux
+import Calculation_Worker_Module
+import Data_Calculation_Module
+import Replay_Module
+import Results_Store_Module
+
+
+def test_replay_queues_its_raw_files_apart_from_the_live_logger(half_hour, result_dir, tmp_path, monkeypatch):
+    monkeypatch.setattr(OpenFlux, "ONLINE_FLUX_CALCULATION", False)
+    recorded = tmp_path / "20240101_0000.txt"
+    half_hour.to_csv(recorded, index=False)
+    replay_dir = tmp_path / "replay_flux"
+    Replay_Module.run_replay(Replay_Module.recorded_file_sources([str(recorded)], OpenFlux.instrument_drivers),
+                             data_dir=str(tmp_path / "replay_data"), result_dir=str(replay_dir))
+
+    assert OpenFlux.calculation_queue_dir == Calculation_Worker_Module.CALCULATION_QUEUE_DIR
+    assert OpenFlux.result_dir is None
+    assert not os.path.exists(Calculation_Worker_Module.CALCULATION_QUEUE_DIR)
+    assert Calculation_Worker_Module.pending_jobs(str(replay_dir / "calculation_queue")) == []
+    with Results_Store_Module.ResultsStore(Results_Store_Module.store_path(str(replay_dir))) as store:
+        assert store.contains("2024-01-01 00:00:00.00")
+    # The replayed lags go to the history of the replay, not of the site
+    assert os.path.exists(replay_dir / Data_Calculation_Module.LAG_HISTORY_FILE)
+    assert not os.path.exists(result_dir / Data_Calculation_Module.LAG_HISTORY_FILE)
@@ -0,0 +1,88 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import Results_Store_Module
+
+
+def result(timestamp, flux, **columns):
+    return dict({'TIMESTAMP': timestamp, 'flux': flux, 'lag': -0.3}, **columns)
+
+
+@pytest.fixture
+def database(tmp_path):
+    return str(tmp_path / Results_Store_Module.RESULTS_DATABASE)
+
+
+def test_period_start():
+    assert Results_Store_Module.period_start("2024-01-01 10:59:59.90") == "2024-01-01 10:30:00"
+    assert Results_Store_Module.period_start(pd.Timestamp("2024-01-01 00:00:00.10")) == "2024-01-01 00:00:00"
+
+
+def test_upsert_replaces_a_rerun_period(database):
+    with Results_Store_Module.ResultsStore(database) as store:
+        store.upsert(result("2024-01-01 00:30:00.00", 1.0), [1.0, 2.0, 3.0], 0.1)
+        store.upsert(result("2024-01-01 00:00:00.00", 2.0))
+        store.upsert(result("2024-01-01 00:30:00.00", 3.0, quality_flag=1), [4.0, 5.0, 6.0], 0.1)
+        results = store.query()
+        timestamps, steps, curves = store.cross_covariance()
+    assert results['TIMESTAMP'].tolist() == ["2024-01-01 00:00:00.00", "2024-01-01 00:30:00.00"]
+    assert results['flux'].tolist() == [2.0, 3.0]
+    # A column added by a later period is empty for the earlier ones
+    assert results.columns.tolist() == ['TIMESTAMP', 'flux', 'lag', 'quality_flag']
+    assert pd.isna(results['quality_flag'][0]) and results['quality_flag'][1] == 1
+    assert timestamps == ["2024-01-01 00:30:00.00"] and steps == [0.1]
+    np.testing.assert_array_equal(curves[0], [4.0, 5.0, 6.0])
+
+
+def test_rerun_with_another_first_sample_replaces_the_whole_row(database):
+    with Results_Store_Module.ResultsStore(database) as store:
+        store.upsert(result("2024-01-01 00:00:00.00", 1.0, quality_flag=2), [1.0, 2.0], 0.1)
+        # The rerun misses the first samples and has no curve nor quality flag
+        store.upsert(result("2024-01-01 00:00:00.30", 2.0))
+        results = store.query()
+        assert store.contains("2024-01-01 00:00:00.00") and store.contains("2024-01-01 00:29:59.90")
+        assert store.cross_covariance() == ([], [], [])
+    assert results['TIMESTAMP'].tolist() == ["2024-01-01 00:00:00.30"]
+    assert results['flux'].tolist() == [2.0]
+    assert pd.isna(results['quality_flag'][0])
+
+
+def test_upsert_stores_numpy_scalars_as_numbers(database):
+    with Results_Store_Module.ResultsStore(database) as store:
+        store.upsert(result("2024-01-01 00:00:00.00", np.float64(1.5), quality_flag=np.int64(2)))
+        row = store.query().iloc[0]
+        assert store.contains("2024-01-01 00:00:00.00")
+        assert not store.contains("2024-01-01 00:30:00.00")
+    assert row['flux'] == 1.5 and row['quality_flag'] == 2
+
+
+def test_query_selects_a_time_range(database):
+    with Results_Store_Module.ResultsStore(database) as store:
+        for hour in range(4):
+            store.upsert(result(f"2024-01-01 0{hour}:00:00.00", float(hour)))
+        results = store.query("2024-01-01 01", "2024-01-01 03", columns=['flux'])
+    assert results.columns.tolist() == ['TIMESTAMP', 'flux']
+    assert results['flux'].tolist() == [1.0, 2.0]
+
+
+def test_csv_round_trip(database, tmp_path):
+    curve = np.linspace(-1.0, 1.0, 21) / 3
+    with Results_Store_Module.ResultsStore(database) as store:
+        store.upsert(result("2024-01-01 00:00:00.00", 0.1 + 0.2, steady_state_blocks="001012"), curve, 0.1)
+        store.upsert(result("2024-01-01 00:30:00.00", -0.25, steady_state_blocks="000000"), curve * 2, 0.1)
+
+    csv_dir = tmp_path / "csv"
+    assert Results_Store_Module.export_csv(database, str(csv_dir)) == 2
+    header = (csv_dir / "cross_covariance_results.txt").read_text(encoding='utf-8').splitlines()[0].split("\t")
+    assert header[:3] == ["", "time", "-1.0s"] and header[-1] == "1.0s"
+
+    copy = str(tmp_path / "copy.sqlite")
+    assert Results_Store_Module.import_csv(copy, str(csv_dir)) == 2
+    with Results_Store_Module.ResultsStore(database) as original, Results_Store_Module.ResultsStore(copy) as store:
+        pd.testing.assert_frame_equal(store.query(), original.query(), check_exact=True)
+        timestamps, steps, curves = store.cross_covariance()
+    assert timestamps == ["2024-01-01 00:00:00.00", "2024-01-01 00:30:00.00"]
+    assert steps == [0.1, 0.1]
+    np.testing.assert_array_equal(curves[0], curve)
+    np.testing.assert_array_equal(curves[1], curve * 2)